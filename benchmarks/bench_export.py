@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+usage = '''USAGE:
+    python3 benchmarks/bench_export.py [--repeat <n>] [--records <n>]
+
+Times marcout_exporter.export_records_per_marcdef for the records of
+examples/unified-json.json, against MARCout export definitions with growing
+numbers of field templates (the FIELD templates of
+examples/export_define.marcout, repeated).
+
+For comparison, it also times, and measures the memory of, the template
+copies the exporter used to make for every record: a copy.deepcopy of the
+whole template list, and another of each template as it was exported.
+Export no longer makes these copies (templates are only read, and each
+exported field is built fresh), so that column is the per-record cost
+that has been removed.
+
+    --repeat <n>: time each size n times and keep the best (default 5).
+    --records <n>: number of records exported per run (default 300).
+'''
+
+import copy
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# this script lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout_exporter as exporter
+import marcout_parser as parser
+
+
+# =============================================================================
+#
+# ================== CONSTANTS ================================================
+
+example_path = os.path.join(repo_dir, 'examples', 'export_define.marcout')
+unified_json_path = os.path.join(repo_dir, 'examples', 'unified-json.json')
+
+# number of copies of the example's FIELD templates per definition
+sizes = (1, 4, 16)
+
+
+
+# =============================================================================
+#
+# ================== FUNCTIONS ================================================
+
+
+def scaled_definition(example_lines, copies):
+    '''Returns the lines of a MARCout definition with the example's FIELD
+    templates (everything after the LDR) repeated `copies` times.
+    '''
+    templates_start = example_lines.index('FIELD: 001')
+    head = example_lines[:templates_start]
+    fields = example_lines[templates_start:] + ['']
+    return head + fields * copies
+
+
+def best_time(func, repeat):
+    '''Returns the best wall clock time of `repeat` calls to func().'''
+    best = None
+    for count in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def removed_copies(templates):
+    '''Makes the template copies that the exporter once made per record.'''
+    copies = []
+    for template in copy.deepcopy(templates):
+        copies.append(copy.deepcopy(template))
+    return copies
+
+
+def copied_bytes(templates):
+    '''Returns the bytes of memory held by one record's removed copies.'''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    copies = removed_copies(templates)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del copies
+    return after - before
+
+
+def run(repeat, record_count):
+    with open(example_path) as example_file:
+        example_lines = example_file.read().split('\n')
+    with open(unified_json_path) as json_file:
+        unified = json.load(json_file)
+
+    records = unified['records']
+    records = (records * (record_count // len(records) + 1))[:record_count]
+
+    print('%d records per run' % len(records))
+    print('  templates   export us/record   removed deepcopy us/record   '
+        'removed deepcopy KiB/record')
+    for copies in sizes:
+        engine = parser.parse_marcexport_deflines(scaled_definition(example_lines, copies))
+        workset = {'marcout_engine': engine,
+            'collection_info': unified['collection_info'],
+            'records_to_export': records,
+        }
+        templates = engine['marc_field_templates']
+
+        export_time = best_time(
+            lambda: exporter.export_records_per_marcdef(workset, False), repeat)
+        copy_time = best_time(
+            lambda: [removed_copies(templates) for record in records], repeat)
+        print('  %9d  %17.1f  %27.1f  %28.1f' % (len(templates),
+            export_time / len(records) * 1e6, copy_time / len(records) * 1e6,
+            copied_bytes(templates) / 1024))
+    return 0
+
+
+
+# =============================================================================
+#
+# ================== EXECUTE ==================================================
+
+if __name__ == '__main__':
+    if '--help' in sys.argv:
+        print(usage)
+        exit(0)
+
+    repeat = 5
+    if '--repeat' in sys.argv:
+        repeat = int(sys.argv[sys.argv.index('--repeat') + 1])
+    record_count = 300
+    if '--records' in sys.argv:
+        record_count = int(sys.argv[sys.argv.index('--records') + 1])
+
+    exit(run(repeat, record_count))
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+usage = '''USAGE:
+    python3 benchmarks/bench_parse.py [--repeat <n>]
+
+Times marcout_parser against MARCout export definitions of growing size,
+built by repeating the FIELD templates of examples/export_define.marcout,
+and against a file of many concatenated definitions. Prints time per source
+line for each size, and exits with status 1 if time per line at the
+largest size is more than twice that at the smallest: parse time should
+scale linearly with definition size.
+
+    --repeat <n>: time each size n times and keep the best (default 5).
+'''
+
+import os
+import sys
+import time
+
+# this script lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout_parser as parser
+
+
+# =============================================================================
+#
+# ================== CONSTANTS ================================================
+
+example_path = os.path.join(repo_dir, 'examples', 'export_define.marcout')
+
+# number of copies of the example's FIELD templates per definition
+sizes = (1, 4, 16, 64, 256)
+
+# number of definitions in the concatenated file
+concatenated_count = 64
+
+# tolerated growth in per-line parse time from smallest to largest size
+max_per_line_ratio = 2.0
+
+
+
+# =============================================================================
+#
+# ================== FUNCTIONS ================================================
+
+
+def scaled_definition(example_lines, copies):
+    '''Returns the lines of a MARCout definition with the example's FIELD
+    templates (everything after the LDR) repeated `copies` times.
+    '''
+    templates_start = example_lines.index('FIELD: 001')
+    head = example_lines[:templates_start]
+    fields = example_lines[templates_start:] + ['']
+    return head + fields * copies
+
+
+def best_time(func, repeat):
+    '''Returns the best wall clock time of `repeat` calls to func().'''
+    best = None
+    for count in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(repeat):
+    with open(example_path) as example_file:
+        example_lines = example_file.read().split('\n')
+
+    print('single definitions:')
+    print('  copies      lines   templates     total ms   us/line')
+    per_line = []
+    for copies in sizes:
+        lines = scaled_definition(example_lines, copies)
+        engine = parser.parse_marcexport_deflines(lines)
+        elapsed = best_time(lambda: parser.parse_marcexport_deflines(lines), repeat)
+        per_line.append(elapsed / len(lines))
+        print('  %6d  %9d  %10d  %11.2f  %8.2f' % (copies, len(lines),
+            len(engine['marc_field_templates']), elapsed * 1000,
+            elapsed / len(lines) * 1e6))
+
+    lines = example_lines * concatenated_count
+    elapsed = best_time(lambda: list(parser.parse_marcexport_definitions(lines)), repeat)
+    print()
+    print('concatenated definitions:')
+    print('  %d definitions, %d lines: %.2f ms, %.2f us/line' % (concatenated_count,
+        len(lines), elapsed * 1000, elapsed / len(lines) * 1e6))
+
+    ratio = per_line[-1] / per_line[0]
+    print()
+    print('per-line time, largest / smallest definition: %.2f' % ratio)
+    if ratio > max_per_line_ratio:
+        print('FAIL: parse time grows faster than definition size.')
+        return 1
+    print('OK: parse time scales linearly with definition size.')
+    return 0
+
+
+
+# =============================================================================
+#
+# ================== EXECUTE ==================================================
+
+if __name__ == '__main__':
+    if '--help' in sys.argv:
+        print(usage)
+        exit(0)
+
+    repeat = 5
+    if '--repeat' in sys.argv:
+        repeat = int(sys.argv[sys.argv.index('--repeat') + 1])
+
+    exit(run(repeat))
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+
+usage = '''USAGE:
+    python3 benchmarks/bench_suite.py [--records <n>[,<n>...]]
+        [--tracks <n>[,<n>...]] [--seed <n>] [--repeat <n>]
+        [--baseline <path>] [--save-baseline] [--tolerance <ratio>]
+
+Benchmarks each stage of a MARCout export separately, for synthetic album
+records (see synthetic_albums.py) exported with the MARCout definition of
+examples/unified-json.json:
+
+    parse       parsing the MARCout definition into an engine
+    extract     computing every JSON extracted property of every record
+    export      exporting every record (this includes its extraction)
+    serialize   serializing the exported records, once per serialization
+
+For each combination of record count and track count, prints each stage's
+time, throughput and time per record, and the peak resident set size of
+the process that ran it (each combination runs in a new process).
+Records are generated, exported and serialized a chunk at a time, so any
+record count (up to 1M and beyond) runs in bounded memory; generating
+records is not counted in any stage.
+
+Results are then compared with the stored baseline for the same
+combination: if any stage is more than <ratio> times slower per record,
+or peak RSS grows by more than a quarter, the regression is printed and
+the suite exits with status 1.
+
+    --records <n>[,<n>...]: record counts (default 1000,10000).
+    --tracks <n>[,<n>...]: tracks per album (default 12,100).
+    --seed <n>: seed of the record generator (default 0).
+    --repeat <n>: run each combination n times and keep the best time of
+        each stage (default 3).
+    --baseline <path>: baseline file (default benchmarks/baseline.json).
+    --save-baseline: store these results in the baseline file, replacing
+        those of the same combinations, instead of comparing with them.
+    --tolerance <ratio>: tolerated slowdown per record (default 1.5).
+
+Baselines are only comparable on the machine they were saved on: save one
+before a change, then run the suite again after it.
+'''
+
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+# this script lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout
+import marcout_exporter as exporter
+import marcout_parser as parser
+import marcout_serializer as serializer
+
+import synthetic_albums
+
+
+# =============================================================================
+#
+# ================== CONSTANTS ================================================
+
+default_baseline_path = os.path.join(repo_dir, 'benchmarks', 'baseline.json')
+
+default_record_counts = (1000, 10000)
+default_track_counts = (12, 100)
+
+# serializations benchmarked ('marc-xml' is not implemented)
+benchmarked_serializations = ('marc-text', 'iso2709', 'raw-datastructure')
+
+# tolerated growth, current / baseline, before a result is a regression
+default_time_tolerance = 1.5
+rss_tolerance = 1.25
+
+
+
+# =============================================================================
+#
+# ================== FUNCTIONS ================================================
+
+
+def best_time(func, repeat):
+    '''Returns the best wall clock time of `repeat` calls to func().'''
+    best = None
+    for count in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def time_stages(workset, record_count, track_count, seed):
+    '''Exports `record_count` synthetic records through every stage, a
+    chunk at a time, and returns the seconds spent in each stage.
+    '''
+    engine = workset['marcout_engine']
+    extractors = engine['json_extracted_properties']
+    seconds = dict.fromkeys(['extract', 'export'] + ['serialize ' + sz_name
+        for sz_name in benchmarked_serializations], 0.0)
+
+    records = synthetic_albums.iter_album_records(record_count, track_count, seed)
+    while True:
+        chunk = list(itertools.islice(records, exporter.extract_chunksize))
+        if not chunk:
+            return seconds
+
+        start = time.perf_counter()
+        columns = exporter.ExtractColumns(chunk, extractors,
+            engine['compiled_expressions'], False, engine['extractor_paths'])
+        for name in extractors:
+            columns[name]
+        seconds['extract'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        exported = list(exporter.iter_export_records_per_marcdef(
+            dict(workset, records_to_export=chunk)))
+        seconds['export'] += time.perf_counter() - start
+
+        for sz_name in benchmarked_serializations:
+            start = time.perf_counter()
+            for serialized in serializer.iter_serialize_records(exported, sz_name):
+                pass
+            seconds['serialize ' + sz_name] += time.perf_counter() - start
+
+
+def run_combination(record_count, track_count, seed, repeat):
+    '''Benchmarks one combination of record and track counts, and returns
+    its results: the parse time, each stage's time, throughput and time
+    per record, and the peak RSS of this process.
+    '''
+    request = synthetic_albums.example_request()
+    lines = request['marcout_sourcecode'].split('\n')
+    parse_time = best_time(lambda: parser.parse_marcexport_deflines(lines), repeat)
+
+    workset = marcout.resolve_unified_json(dict(request, records=[]))
+    best = None
+    for count in range(repeat):
+        seconds = time_stages(workset, record_count, track_count, seed)
+        if best is None:
+            best = seconds
+        else:
+            best = {stage: min(best[stage], seconds[stage]) for stage in best}
+
+    stages = {}
+    for stage in best:
+        stages[stage] = {'seconds': best[stage],
+            'records_per_second': record_count / best[stage] if best[stage] else None,
+            'us_per_record': best[stage] / record_count * 1e6,
+        }
+    # ru_maxrss is in KiB on Linux
+    return {'records': record_count,
+        'tracks': track_count,
+        'seed': seed,
+        'parse_ms': parse_time * 1000,
+        'stages': stages,
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def combination_name(record_count, track_count):
+    return str(record_count) + ' records x ' + str(track_count) + ' tracks'
+
+
+def format_results(results):
+    '''Returns the results of one combination as a table.'''
+    lines = [combination_name(results['records'], results['tracks'])
+        + ': parse %.2f ms, peak RSS %.1f MiB' % (results['parse_ms'],
+            results['peak_rss_kib'] / 1024),
+        '  %-30s %12s %14s %14s' % ('stage', 'seconds', 'records/s', 'us/record'),
+    ]
+    for stage, result in results['stages'].items():
+        lines.append('  %-30s %12.3f %14.0f %14.1f' % (stage, result['seconds'],
+            result['records_per_second'] or 0, result['us_per_record']))
+    return '\n'.join(lines)
+
+
+def regressions(results, baseline, time_tolerance):
+    '''Returns a message for each measure of `results` that has regressed
+    beyond tolerance from `baseline`, the stored results of the same
+    combination.
+    '''
+    retval = []
+    measures = [('parse ms', results['parse_ms'], baseline['parse_ms'],
+        time_tolerance)]
+    for stage, result in results['stages'].items():
+        if stage in baseline['stages']:
+            measures.append((stage + ' us/record', result['us_per_record'],
+                baseline['stages'][stage]['us_per_record'], time_tolerance))
+    measures.append(('peak RSS KiB', results['peak_rss_kib'],
+        baseline['peak_rss_kib'], rss_tolerance))
+    for measure, current, stored, tolerance in measures:
+        if stored and current / stored > tolerance:
+            retval.append('%s: %.1f, baseline %.1f (x%.2f, tolerance x%.2f)' % (
+                measure, current, stored, current / stored, tolerance))
+    return retval
+
+
+def load_baseline(baseline_path):
+    if not os.path.exists(baseline_path):
+        return {}
+    with open(baseline_path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def run(record_counts, track_counts, seed, repeat, baseline_path, save_baseline,
+        time_tolerance):
+    baseline = load_baseline(baseline_path)
+    status = 0
+    for record_count in record_counts:
+        for track_count in track_counts:
+            # a new process per combination, so that its peak RSS is its own
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(1) as pool:
+                results = pool.apply(run_combination,
+                    (record_count, track_count, seed, repeat))
+            print(format_results(results))
+
+            name = combination_name(record_count, track_count)
+            if save_baseline:
+                baseline[name] = results
+            elif name not in baseline:
+                print('  no baseline for ' + name)
+            else:
+                problems = regressions(results, baseline[name], time_tolerance)
+                for problem in problems:
+                    print('  REGRESSION ' + problem)
+                if problems:
+                    status = 1
+                else:
+                    print('  OK: within tolerance of the baseline')
+            print()
+
+    if save_baseline:
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print('baseline saved to ' + baseline_path)
+    elif status:
+        print('FAIL: performance has regressed from the baseline.')
+    return status
+
+
+
+# =============================================================================
+#
+# ================== EXECUTE ==================================================
+
+if __name__ == '__main__':
+    if '--help' in sys.argv:
+        print(usage)
+        exit(0)
+
+    record_counts = default_record_counts
+    if '--records' in sys.argv:
+        record_counts = [int(count) for count in
+            sys.argv[sys.argv.index('--records') + 1].split(',')]
+    track_counts = default_track_counts
+    if '--tracks' in sys.argv:
+        track_counts = [int(count) for count in
+            sys.argv[sys.argv.index('--tracks') + 1].split(',')]
+    seed = 0
+    if '--seed' in sys.argv:
+        seed = int(sys.argv[sys.argv.index('--seed') + 1])
+    repeat = 3
+    if '--repeat' in sys.argv:
+        repeat = int(sys.argv[sys.argv.index('--repeat') + 1])
+    baseline_path = default_baseline_path
+    if '--baseline' in sys.argv:
+        baseline_path = sys.argv[sys.argv.index('--baseline') + 1]
+    time_tolerance = default_time_tolerance
+    if '--tolerance' in sys.argv:
+        time_tolerance = float(sys.argv[sys.argv.index('--tolerance') + 1])
+
+    exit(run(record_counts, track_counts, seed, repeat, baseline_path,
+        '--save-baseline' in sys.argv, time_tolerance))
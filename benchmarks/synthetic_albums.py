@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+usage = '''USAGE:
+    python3 benchmarks/synthetic_albums.py [--records <n>] [--tracks <n>]
+        [--seed <n>] > <unified-json-filepath>
+
+Writes a unified JSON export request to stdout, for test-marcout or the
+webservice: the MARCout definition, collection info and serialization of
+examples/unified-json.json, with <n> synthetic album records shaped like
+that file's records. The same arguments always write the same file.
+Records are written as they are generated, so any number fits in memory.
+
+    --records <n>: number of album records (default 1000).
+    --tracks <n>: number of tracks per album (default 12).
+    --seed <n>: seed of the generator (default 0).
+'''
+
+import json
+import os
+import random
+import sys
+
+# this script lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+unified_json_path = os.path.join(repo_dir, 'examples', 'unified-json.json')
+
+
+# =============================================================================
+#
+# ================== CONSTANTS ================================================
+
+words = ('blaze', 'glory', 'children', 'dragon', 'parable', 'river', 'stay',
+    'present', 'grow', 'clarity', 'prayer', 'road', 'night', 'morning', 'city',
+    'song', 'broken', 'heart', 'golden', 'highway', 'summer', 'rain', 'fire',
+    'home', 'lonesome', 'electric', 'midnight', 'blue', 'wild', 'silver')
+
+genres = ('Rap & Hip Hop', 'Country', 'Rock', 'Folk', 'Jazz', 'Blues',
+    'Electronic', 'Pop', 'Soul & R&B', 'Americana')
+
+labels = ('Independent', 'Sub Pop', 'Thirty Tigers', 'Barsuk', 'Light in the Attic')
+
+languages = ('English', 'Spanish', 'English, Spanish', 'Amharic', 'French')
+
+rounds = ('playback-spring-2016', 'playback-fall-2016', 'boombox-fall-2016',
+    'boombox-spring-2017')
+
+hosts = ('https://playback-jsfs.spl.org', 'https://boombox-jsfs.library.nashville.org')
+
+# optional album properties: each is missing from about one record in four,
+# as in the example records, so that ::DEFAULT extracts are exercised
+optional_properties = ('auth_required_to_stream', 'badge_image', 'badge_tag',
+    'artist_is_group')
+
+
+
+# =============================================================================
+#
+# ================== FUNCTIONS ================================================
+
+
+def slug(text):
+    return '-'.join(text.lower().replace('&', 'and').split())
+
+
+def title(rng, word_count):
+    return ' '.join(rng.choice(words).capitalize() for count in range(word_count))
+
+
+def album_tracks(rng, album_id, host, track_count):
+    '''Returns `track_count` tracks for album `album_id`, in shuffled
+    position order as in the example records.
+    '''
+    tracks = []
+    for position in range(1, track_count + 1):
+        track_title = title(rng, rng.randint(1, 5))
+        filename = '%02d %s.mp3' % (position, track_title)
+        tracks.append({'position': position,
+            'duration': rng.uniform(60.0, 480.0),
+            'filename': filename,
+            'access_token': '%040x' % rng.getrandbits(160),
+            'title': track_title,
+            'url': host + '/complete-submission/' + album_id + '/'
+                + '%02d-%s--1467324941000.mp3' % (position, slug(track_title)),
+        })
+    rng.shuffle(tracks)
+    return tracks
+
+
+def album_record(rng, index, track_count):
+    '''Returns synthetic album record number `index`, with `track_count`
+    tracks, drawing from random.Random `rng`.
+    '''
+    artist_name = title(rng, rng.randint(1, 3))
+    album_title = title(rng, rng.randint(1, 4))
+    album_id = slug(artist_name) + '-' + slug(album_title) + '-' + str(index)
+    host = rng.choice(hosts)
+    album = {'front_cover_art': host + '/complete-submission/albums/' + album_id
+            + '/cover.jpg',
+        'record_label': rng.choice(labels),
+        'auth_required_to_stream': rng.random() < 0.5,
+        'badge_image': None,
+        'genre': rng.choice(genres),
+        'upc': None,
+        'main_artist_name': artist_name,
+        'main_artist': slug(artist_name),
+        'artist_is_group': rng.random() < 0.5,
+        'title': album_title,
+        'badge_tag': None,
+        'id': album_id,
+        'asset_type': 'album',
+        'spoken_languages': rng.choice(languages),
+        'tracks': album_tracks(rng, album_id, host, track_count),
+        'release_date': '%04d-%02d-%02dT07:00:00.000Z' % (rng.randint(1960, 2017),
+            rng.randint(1, 12), rng.randint(1, 28)),
+        'round': rng.choice(rounds),
+    }
+    if rng.random() < 0.25:
+        for propname in optional_properties:
+            del album[propname]
+    return {'album': album, 'owner': '%040x' % rng.getrandbits(160)}
+
+
+def iter_album_records(record_count, track_count=12, seed=0):
+    '''Yields `record_count` synthetic album records with `track_count`
+    tracks each. The records depend only on the arguments.
+    '''
+    rng = random.Random(seed)
+    for index in range(record_count):
+        yield album_record(rng, index, track_count)
+
+
+def example_request():
+    '''Returns examples/unified-json.json, without its records.'''
+    with open(unified_json_path) as json_file:
+        unified = json.load(json_file)
+    del unified['records']
+    return unified
+
+
+def write_unified_json(outfile, record_count, track_count=12, seed=0):
+    '''Writes the example request to `outfile` with synthetic records (see
+    `iter_album_records`) in place of its own, one record at a time.
+    '''
+    unified = example_request()
+    outfile.write(json.dumps(unified)[:-1] + ', "records": [')
+    for index, record in enumerate(iter_album_records(record_count, track_count, seed)):
+        if index:
+            outfile.write(',')
+        outfile.write('\n' + json.dumps(record))
+    outfile.write('\n]}\n')
+
+
+
+# =============================================================================
+#
+# ================== EXECUTE ==================================================
+
+if __name__ == '__main__':
+    if '--help' in sys.argv:
+        print(usage)
+        exit(0)
+
+    record_count = 1000
+    if '--records' in sys.argv:
+        record_count = int(sys.argv[sys.argv.index('--records') + 1])
+    track_count = 12
+    if '--tracks' in sys.argv:
+        track_count = int(sys.argv[sys.argv.index('--tracks') + 1])
+    seed = 0
+    if '--seed' in sys.argv:
+        seed = int(sys.argv[sys.argv.index('--seed') + 1])
+
+    write_unified_json(sys.stdout, record_count, track_count, seed)
@@ -2,6 +2,9 @@
 # marcout is the module that does the export work. Its
 # entry point is the "export_records" function.
 import marcout
+import marcout_tracing as tracing
+
+import os
 
 # import app and request modules from the flask package
 from flask import Flask, request
@@ -10,6 +13,19 @@ app = Flask(__name__)
 
 verbose_in_export = False
 
+# Preload precompiled MARCout Engine artifacts (written by
+# `parse-marcout --emit`) named in MARCOUT_ENGINE_FILES, separated
+# by os.pathsep. Requests whose MARCout source matches a preloaded engine
+# are never parsed.
+for engine_filepath in os.environ.get('MARCOUT_ENGINE_FILES', '').split(os.pathsep):
+    if engine_filepath:
+        marcout.preload_engine(engine_filepath)
+
+# Write tracing spans (see marcout_tracing.py) of every export, as
+# OpenTelemetry JSON lines, to the file named in MARCOUT_TRACE_FILE.
+if os.environ.get('MARCOUT_TRACE_FILE'):
+    tracing.open_span_file(os.environ['MARCOUT_TRACE_FILE'], 'marcout-webservice')
+
 # t\This decorator is the Flask pattern matcher for this path and
 # these methods. If GET is defined, HEAD will be provided for
 # free. The decorator applies to the "marcout_export" view function.
@@ -1,11 +1,21 @@
 #!/usr/bin/python3
 
+import marcout_artifact as artifact
+import marcout_codegen as codegen_module
 import marcout_common as common
 import marcout_parser as parser
 import marcout_exporter as exporter
+import marcout_expressions as expressions
+import marcout_record_cache as record_cache
 import marcout_serializer as serializer
+import marcout_tracing as tracing
 
+import collections
+import itertools
 import json
+import multiprocessing
+import threading
+import time
 
 
 # =============================================================================
@@ -13,7 +23,45 @@ import json
 # ================== CONSTANTS ================================================
 
 
+# Parsed MARCout Engines, keyed by marcout_parser.source_hash() of their
+# source, in least- to most-recently-used order. Callers send the same
+# export definition over and over: parse it once. Engines specialized to
+# a collection (see get_specialized_engine) share the cache.
+engine_cache = collections.OrderedDict()
+engine_cache_size = 32
+engine_cache_stats = {'hits': 0, 'misses': 0}
+engine_cache_lock = threading.Lock()
 
+# number of records `preflight` samples by default
+preflight_sample_size = 20
+
+# number of records sent to an export worker process at a time, by default
+export_chunksize = 64
+
+# records served from, and missing from, persistent record caches (see
+# marcout_record_cache.py) by this process
+record_cache_stats = {'hits': 0, 'misses': 0}
+
+# records exported, and records skipped because they could not be, by
+# skip-and-continue exports (see `iter_export`) in this process
+export_error_stats = {'exported': 0, 'failed': 0}
+
+# records read, and duplicates among them exported only once, by
+# deduplicating exports (see `iter_export`) in this process
+deduplication_stats = {'records': 0, 'duplicates': 0}
+
+# number of distinct records whose output a deduplicating export keeps
+# for duplicates still to come: a duplicate of a record further back is
+# exported again
+deduplicate_window = 16384
+
+# the export profile (see exporter.new_profile) of the latest export run
+# with `profile` in this process
+last_profile = None
+
+# the Export Workset (without records) of an export worker process: set
+# once per worker by `init_export_worker`
+worker_workset = None
 
 
 
@@ -59,14 +107,142 @@ def parse_unified_json(param, verbose=False):
     return jsonobj
 
 
-def resolve_unified_json(unified_jsonobj, verbose=False):
+def configure_engine_cache(size):
+    '''Sets the maximum number of parsed MARCout Engines kept in the engine
+    cache, evicting least recently used engines as necessary. A size of 0
+    disables caching.
+    '''
+    global engine_cache_size
+    if size < 0:
+        raise ValueError('Engine cache size must not be negative.')
+    with engine_cache_lock:
+        engine_cache_size = size
+        while len(engine_cache) > engine_cache_size:
+            engine_cache.popitem(last=False)
+
+
+def clear_engine_cache():
+    '''Empties the engine cache and resets its hit/miss counters.'''
+    with engine_cache_lock:
+        engine_cache.clear()
+        engine_cache_stats['hits'] = 0
+        engine_cache_stats['misses'] = 0
+
+
+def engine_cache_info():
+    '''Returns a dict with the engine cache's hits, misses, current size,
+    and maximum size.
+    '''
+    with engine_cache_lock:
+        return {'hits': engine_cache_stats['hits'],
+            'misses': engine_cache_stats['misses'],
+            'size': len(engine_cache),
+            'maxsize': engine_cache_size,
+        }
+
+
+def cache_engine(key, marcout_engine):
+    '''Adds `marcout_engine` to the engine cache under `key`, evicting the
+    least recently used engine if the cache is full.
+    '''
+    with engine_cache_lock:
+        if engine_cache_size:
+            engine_cache[key] = marcout_engine
+            engine_cache.move_to_end(key)
+            while len(engine_cache) > engine_cache_size:
+                engine_cache.popitem(last=False)
+
+
+def get_marcout_engine(marcout_lines=None, engine_filepath=None):
+    '''Returns the MARCout Engine for MARCout source, as a list of lines,
+    and/or a MARCout Engine artifact file (see marcout_artifact.py).
+    With both, the artifact is used unless it is stale, in which case it
+    is rebuilt from the source.
+
+    Engines are cached by a hash of their normalized source, so
+    definitions that differ only in comments or trailing whitespace share
+    one parsed engine. Cached engines are shared: treat them as read-only.
+    '''
+    key = None
+    if marcout_lines is not None:
+        key = parser.source_hash(marcout_lines)
+
+        with engine_cache_lock:
+            if key in engine_cache:
+                engine_cache_stats['hits'] += 1
+                engine_cache.move_to_end(key)
+                return engine_cache[key]
+            engine_cache_stats['misses'] += 1
+
+    # parse or load outside the lock: a concurrent miss on the same
+    # source just does the work twice.
+    if engine_filepath:
+        marcout_engine = artifact.load_engine_artifact(engine_filepath, marcout_lines)
+    else:
+        marcout_engine = parser.parse_marcexport_deflines(marcout_lines)
+
+    if key is None:
+        # artifact only: it carries its own source hash
+        key = marcout_engine['source_hash']
+        with engine_cache_lock:
+            if key in engine_cache:
+                engine_cache_stats['hits'] += 1
+                engine_cache.move_to_end(key)
+                return engine_cache[key]
+            engine_cache_stats['misses'] += 1
+
+    cache_engine(key, marcout_engine)
+
+    return marcout_engine
+
+
+def preload_engine(engine_filepath):
+    '''Loads a MARCout Engine artifact file into the engine cache, so
+    that requests carrying the same MARCout source never parse it.
+    Returns the engine.
+    '''
+    marcout_engine = artifact.read_engine_artifact(engine_filepath)
+    cache_engine(marcout_engine['source_hash'], marcout_engine)
+    return marcout_engine
+
+
+def get_specialized_engine(marcout_engine, collection_info):
+    '''Returns `marcout_engine` specialized to `collection_info` (see
+    exporter.specialize_engine). Specialized engines share the engine
+    cache, keyed by (engine source hash, collection_info hash): a workset
+    for a known collection reuses the work of binding its parameters.
+    '''
+    key = (marcout_engine['source_hash'], exporter.collection_info_hash(collection_info))
+
+    with engine_cache_lock:
+        if key in engine_cache:
+            engine_cache_stats['hits'] += 1
+            engine_cache.move_to_end(key)
+            return engine_cache[key]
+        engine_cache_stats['misses'] += 1
+
+    specialized = exporter.specialize_engine(marcout_engine, collection_info)
+    cache_engine(key, specialized)
+
+    return specialized
+
+
+def resolve_unified_json(unified_jsonobj, verbose=False, engine_file=None):
     '''This function accepts a parsed JSON object, interprets it,
     and returns a dictionary containing four items:
-        - the MARCout Engine parsed from "marcout_sourcecode";
+        - the MARCout Engine parsed from "marcout_sourcecode", or loaded
+            from the MARCout Engine artifact file `engine_file` (rebuilt
+            from "marcout_sourcecode" if both are present and the
+            artifact is stale);
         - the requested serialization, by name;
         - the collection info;
         - the list of records to be exported.
     Obvious missing, wrong, or inconsistent elements raise a ValueError.
+
+    `engine_file` is the caller's to choose, never the unified JSON's:
+    unified JSON may come from a remote client, and an artifact is read
+    with marshal, and rewritten when stale. A unified JSON naming a
+    "marcout_engine_file" raises a ValueError.
     '''
     retval = {}
 
@@ -82,17 +258,22 @@ def resolve_unified_json(unified_jsonobj, verbose=False):
 
     # extract unified content into discrete variables
     errors = []
-    json_contentnames = ('marcout_sourcecode', 'requested_serialization', 
+    json_contentnames = ('requested_serialization', 
         'collection_info', 'records',)
     
     for contentname in json_contentnames:
         if not contentname in unified_jsonobj:
             errors.append('Missing "' + contentname + '" in Unified JSON.')
+    if 'marcout_sourcecode' not in unified_jsonobj and not engine_file:
+        errors.append('Missing "marcout_sourcecode" in Unified JSON.')
+    if 'marcout_engine_file' in unified_jsonobj:
+        errors.append('"marcout_engine_file" is not accepted in Unified JSON: '
+            + 'MARCout Engine files are named by the operator (see preload_engine).')
     if errors:
         raise ValueError('\n'.join(errors) + '\n')
 
     # populate convenience variables
-    marcout_sourcecode = unified_jsonobj['marcout_sourcecode']
+    marcout_sourcecode = unified_jsonobj.get('marcout_sourcecode')
     requested_serialization = unified_jsonobj['requested_serialization']
     collection_info = unified_jsonobj['collection_info']
     records_to_export = unified_jsonobj['records']
@@ -105,18 +286,24 @@ def resolve_unified_json(unified_jsonobj, verbose=False):
         raise ValueError('Requested serialization `' + sz_name + '` not known.')
 
     # ------------- PARSE MARCout text ----------------
-    # unescape characters escaped for JSON
-    marcout_sourcecode = marcout_sourcecode.replace('\\n', '\n')
-    marcout_sourcecode = marcout_sourcecode.replace('\\"', '"')
+    marcout_lines = None
+    if marcout_sourcecode is not None:
+        # unescape characters escaped for JSON
+        marcout_sourcecode = marcout_sourcecode.replace('\\n', '\n')
+        marcout_sourcecode = marcout_sourcecode.replace('\\"', '"')
+
+        # Parser is line-oriented. Cut the text clob into array of lines.
+        marcout_lines = marcout_sourcecode.split('\n')
 
     # one of the returned values. The MARCout Engine is a set of
     # statements to govern selection, content, and formatting for
     # exported MARC record fields.
-
-    # Parser is line-oriented. Cut the text clob into array of lines,
-    # and parse
-    marcout_lines = marcout_sourcecode.split('\n')
-    marcout_engine = parser.parse_marcexport_deflines(marcout_lines)
+    # Parse (or reuse the engine already parsed from this source, or
+    # load the precompiled artifact)
+    try:
+        marcout_engine = get_marcout_engine(marcout_lines, engine_file)
+    except OSError as e:
+        raise ValueError('Unable to read MARCout Engine file: ' + str(e))
 
     # Sanity:
     # (This is a likely mistake when composing unified JSON parameter.)
@@ -143,6 +330,11 @@ def resolve_unified_json(unified_jsonobj, verbose=False):
 
     # We're still here, so the JSON was broadly OK: Not validated,
     # but at least claims to have the right content.
+
+    # collection_info is fixed for the whole workset: bind it into the
+    # engine once, rather than looking it up for every record.
+    marcout_engine = get_specialized_engine(marcout_engine, collection_info)
+
     # This is the Export Workset datastructure.
     retval = {'marcout_engine': marcout_engine,
         'serialization': sz_name,
@@ -153,26 +345,679 @@ def resolve_unified_json(unified_jsonobj, verbose=False):
     return retval
 
 
-def export_records(unified_jsonobj, as_string=False, verbose=False):
+def init_export_worker(export_workset, codegen):
+    '''Initializes an export worker process with the engine, collection
+    info and serialization of `export_workset`, which has no records.
+    Runs once per worker, so the engine is shipped once per worker rather
+    than once per record.
+    '''
+    global worker_workset
+    worker_workset = dict(export_workset, codegen=codegen)
+    # hooks (and span files) inherited from the parent process are the
+    # parent's: spans are not reported from worker processes.
+    del tracing.hooks[:]
+
+
+def export_in_worker(record):
+    '''Exports and serializes one record in an export worker process.'''
+    export_workset = dict(worker_workset, records_to_export=[record])
+    if worker_workset['codegen']:
+        exported = codegen_module.iter_export_records_per_module(export_workset)
+    else:
+        exported = exporter.iter_export_records_per_marcdef(export_workset)
+    return next(serializer.iter_serialize_records(exported,
+        worker_workset['serialization']))
+
+
+def export_in_worker_skipping(indexed_record):
+    '''Skip-and-continue form of `export_in_worker`: exports and serializes
+    the record of (index, record) `indexed_record`, and returns
+    (serialized record, None), or (None, its error entry).
+    '''
+    recordno, record = indexed_record
+    errors = []
+    serialized = next(iter_serialized(dict(worker_workset, records_to_export=[record]),
+        codegen=worker_workset['codegen'], errors=errors))
+    if not errors:
+        return serialized, None
+    errors[0]['record_index'] = recordno
+    return None, errors[0]
+
+
+def iter_export_in_workers(export_workset, workers, chunksize, codegen, errors=None):
+    '''Yields the serialized records of `export_workset`, in input order,
+    exported by a pool of `workers` processes in chunks of `chunksize`
+    records. `errors` is as for `iter_serialized`.
+    Records are read a window of `workers` * `chunksize` at a time, and
+    each window is drained before the next is read. The pool's task
+    thread would otherwise read the whole input ahead of the consumer,
+    and in that thread, not the consumer's. That would defeat
+    bounded-memory streaming, and drive any record generator beneath
+    (such as those of the record cache or deduplication) from the wrong
+    thread.
+    '''
+    records = iter(export_workset['records_to_export'])
+    window = workers * chunksize
+    shipped = dict(export_workset, records_to_export=None)
+    with multiprocessing.Pool(workers, init_export_worker, (shipped, codegen)) as pool:
+        recordno = 0
+        while True:
+            batch = list(itertools.islice(records, window))
+            if not batch:
+                return
+
+            if errors is None:
+                for serialized in pool.imap(export_in_worker, batch, chunksize):
+                    yield serialized
+            else:
+                for serialized, error in pool.imap(export_in_worker_skipping,
+                        enumerate(batch, recordno), chunksize):
+                    if error is not None:
+                        errors.append(error)
+                    yield serialized
+            recordno += len(batch)
+
+
+def iter_serialize_skipping(exported, records, sz_name, verbose, errors):
+    '''Skip-and-continue form of serializer.iter_serialize_records: yields
+    each of `exported` (which yields None for records that could not be
+    exported) serialized, or None if it could not be, appending its
+    error entry to `errors`. `records` holds the records being exported,
+    oldest first, and gives up one for each record serialized.
+    '''
+    serialize = serializer.serializations[sz_name]
+    for recordno, marc_record in enumerate(exported):
+        record = records.popleft()
+        if marc_record is None:
+            yield None
+            continue
+        span = None
+        if tracing.hooks:
+            span = tracing.start_span('marcout.serialize', {'record_index': recordno,
+                'serialization': sz_name})
+        try:
+            serialized = serialize(marc_record, verbose)
+        except Exception as ex:
+            errors.append(exporter.record_error(recordno, record, 'serialize', ex))
+            serialized = None
+        if span is not None:
+            tracing.end_span(span, {'skipped': serialized is None})
+        yield serialized
+
+
+def iter_serialized(export_workset, verbose=False, codegen=False, workers=None,
+        chunksize=None, errors=None, profile=None):
+    '''Returns an iterator that yields the serialized records of
+    `export_workset`, in order. See `iter_export` for the options.
+    If `errors` is a list, a record that cannot be exported or serialized
+    does not abort the batch: its error entry (see
+    exporter.record_error) is appended to `errors`, and None is yielded
+    in its place. If `profile` is an export profile (see
+    exporter.new_profile), the export is profiled in it.
+    '''
+    if workers is not None and workers > 1:
+        if chunksize is None:
+            chunksize = export_chunksize
+        return iter_export_in_workers(export_workset, workers, chunksize, codegen, errors)
 
-    unified_jsonobj = parse_unified_json(unified_jsonobj, verbose)
+    # records pulled by the exporter and not yet serialized, for the
+    # error entries of records that fail to serialize
+    records = None
+    if errors is not None:
+        records = collections.deque()
 
-    # turn the JSON into the Export Workset, with parsed MARCout Engine,
-    # records in the anticipated JSON form, and export directives &
-    # collection-specific metadata.
-    export_workset = resolve_unified_json(unified_jsonobj, verbose)
+        def remember(batch):
+            for record in batch:
+                records.append(record)
+                yield record
+
+        export_workset = dict(export_workset,
+            records_to_export=remember(export_workset['records_to_export']))
 
     # The Export Workset, without external data dependencies, contains sufficient
-    # information to generate a list of exported record datastructures.
-    export_list = exporter.export_records_per_marcdef(export_workset, verbose)
+    # information to generate exported record datastructures, one at a time.
+    if codegen:
+        exported = codegen_module.iter_export_records_per_module(export_workset, verbose,
+            errors)
+    else:
+        exported = exporter.iter_export_records_per_marcdef(export_workset, verbose,
+            errors, profile)
 
     # apply requested serialization
     sz_name = export_workset['serialization']
-    export_list = serializer.serialize_records(export_list, sz_name, verbose)
+    if errors is not None:
+        return iter_serialize_skipping(exported, records, sz_name, verbose, errors)
+    return serializer.iter_serialize_records(exported, sz_name, verbose)
+
+
+def take_error(inner_errors, inner_index, record_index):
+    '''Returns the error entry of a record skipped by an export wrapped by
+    another (such as `iter_export_cached`), which exports only some of
+    its records. The entry is taken from `inner_errors`, the wrapped
+    export's error entries, by `inner_index`, the record's position among
+    the wrapped export's records; and renumbered `record_index`, its
+    position among the wrapper's own. Returns None if there is none.
+    '''
+    while inner_errors:
+        entry = inner_errors.popleft()
+        if entry['record_index'] == inner_index:
+            entry['record_index'] = record_index
+            return entry
+    return None
+
+
+def iter_export_cached(export_workset, cache_filepath, export, errors=None):
+    '''Yields the serialized records of `export_workset`, in order, taking
+    each from the record cache at `cache_filepath` if it is there. Only
+    the records missing from the cache are exported, by
+    `export(workset, errors)` (see `iter_serialized`), and their output
+    is added to the cache. Hits and misses are added to
+    `record_cache_stats`.
+    If `errors` is a list, the export skips and continues: the error
+    entry of each skipped record, numbered by its position in
+    `export_workset`, is appended to `errors` just before its None is
+    yielded.
+    '''
+    marcout_engine = export_workset['marcout_engine']
+    engine_hash = marcout_engine['source_hash']
+    collection_hash = (marcout_engine.get('collection_hash')
+        or exporter.collection_info_hash(export_workset['collection_info']))
+    sz_name = export_workset['serialization']
+
+    cache = record_cache.open_record_cache(cache_filepath)
+    inner_errors = None
+    if errors is not None:
+        inner_errors = collections.deque()
+
+    # (index, key, cached output or None) for each record looked up, in
+    # order. The key is computed when the record is read, since looking
+    # it up decides whether the record is exported at all, and kept to
+    # store its output once it is.
+    pending = collections.deque()
+
+    def miss_records():
+        for recordno, record in enumerate(export_workset['records_to_export']):
+            key = record_cache.record_key(engine_hash, collection_hash, record)
+            output = record_cache.read_cached(cache, key, sz_name)
+            pending.append((recordno, key, output))
+            if output is None:
+                yield record
+
+    try:
+        exported = export(dict(export_workset, records_to_export=miss_records()),
+            inner_errors)
+        for missno, output in enumerate(exported):
+            # the records before this one were cache hits
+            while pending[0][2] is not None:
+                yield pending.popleft()[2]
+            recordno, key, cached = pending.popleft()
+            if output is None:
+                # a record skipped by a skip-and-continue export
+                entry = take_error(inner_errors, missno, recordno)
+                if entry is not None:
+                    errors.append(entry)
+            else:
+                record_cache.write_cached(cache, key, sz_name, output)
+            yield output
+        while pending:
+            yield pending.popleft()[2]
+    finally:
+        record_cache_stats['hits'] += cache['hits']
+        record_cache_stats['misses'] += cache['misses']
+        record_cache.close_record_cache(cache)
+
+
+def iter_export_deduplicated(export_workset, export, collapse=False, errors=None):
+    '''Yields the serialized records of `export_workset`, in order,
+    exporting each distinct record (by record_cache.record_fingerprint,
+    so equal as JSON whatever its key order) only once, by
+    `export(workset, errors)` (see `iter_serialized`). A duplicate
+    yields the output of its first occurrence, in its own position, or
+    with `collapse` is left out. Only the outputs of the last
+    `deduplicate_window` distinct records are kept for their duplicates.
+    Records read and duplicates are added to `deduplication_stats`.
+    If `errors` is a list, the export skips and continues: the error
+    entry of each skipped record, numbered by its position in
+    `export_workset`, is appended to `errors` just before its None is
+    yielded. A duplicate kept in its position of a skipped record gets
+    an entry of its own.
+    '''
+    # fingerprint: slot of the distinct records in the window, least- to
+    # most-recently seen; with `collapse`, just every fingerprint seen
+    window = collections.OrderedDict()
+    seen = set()
+
+    # (index, slot) of each record to be yielded, in order. A slot is
+    # empty until the record's first occurrence has been exported, then
+    # holds its output and error entry (None unless it was skipped).
+    pending = collections.deque()
+    counts = {'records': 0, 'duplicates': 0}
+    inner_errors = None
+    if errors is not None:
+        inner_errors = collections.deque()
+
+    def distinct_records():
+        for recordno, record in enumerate(export_workset['records_to_export']):
+            counts['records'] += 1
+            fingerprint = record_cache.record_fingerprint(record)
+            if collapse:
+                if fingerprint in seen:
+                    counts['duplicates'] += 1
+                    continue
+                seen.add(fingerprint)
+                pending.append((recordno, None))
+                yield record
+                continue
+
+            slot = window.get(fingerprint)
+            if slot is not None:
+                counts['duplicates'] += 1
+                window.move_to_end(fingerprint)
+                pending.append((recordno, slot))
+                continue
+            slot = []
+            window[fingerprint] = slot
+            if len(window) > deduplicate_window:
+                window.popitem(last=False)
+            pending.append((recordno, slot))
+            yield record
+
+    def duplicate_output(recordno, slot):
+        output, entry = slot
+        if entry is not None:
+            errors.append(dict(entry, record_index=recordno))
+        return output
+
+    try:
+        exported = export(dict(export_workset, records_to_export=distinct_records()),
+            inner_errors)
+        for distinctno, output in enumerate(exported):
+            # the records before this one were duplicates, of records
+            # already exported
+            while pending[0][1]:
+                yield duplicate_output(*pending.popleft())
+            recordno, slot = pending.popleft()
+            entry = None
+            if output is None:
+                # a record skipped by a skip-and-continue export
+                entry = take_error(inner_errors, distinctno, recordno)
+                if entry is not None:
+                    errors.append(entry)
+            if slot is not None:
+                slot.extend((output, entry))
+            yield output
+        while pending:
+            yield duplicate_output(*pending.popleft())
+    finally:
+        deduplication_stats['records'] += counts['records']
+        deduplication_stats['duplicates'] += counts['duplicates']
+
+
+def iter_recording_errors(outputs, errors, error_file):
+    '''Yields the serialized records of `outputs`, leaving out the None of
+    each record that could not be exported. Each entry appended to
+    `errors` is written to `error_file` as a line of JSON as soon as it
+    appears, and the file ends with a line holding the batch's summary:
+    {"summary": {"records": ..., "exported": ..., "failed": ...,
+    "failed_by_tag": {tag: count, ...}}}.
+    The counts are added to `export_error_stats`.
+    '''
+    summary = {'records': 0, 'exported': 0, 'failed': 0, 'failed_by_tag': {}}
+
+    def write_errors(sidecar):
+        while errors:
+            error = errors.popleft()
+            sidecar.write(json.dumps(error) + '\n')
+            tag = str(error['tag'])
+            summary['failed_by_tag'][tag] = summary['failed_by_tag'].get(tag, 0) + 1
+
+    with open(error_file, 'w') as sidecar:
+        try:
+            for output in outputs:
+                summary['records'] += 1
+                write_errors(sidecar)
+                if output is None:
+                    summary['failed'] += 1
+                    continue
+                summary['exported'] += 1
+                yield output
+            write_errors(sidecar)
+            sidecar.write(json.dumps({'summary': summary}) + '\n')
+        finally:
+            export_error_stats['exported'] += summary['exported']
+            export_error_stats['failed'] += summary['failed']
+
+
+def export_error_info():
+    '''Returns a dict with the numbers of records exported, and skipped
+    because they could not be, by the skip-and-continue exports of this
+    process.
+    '''
+    return dict(export_error_stats)
+
+
+def deduplication_info():
+    '''Returns a dict with the numbers of records read, and of duplicates
+    among them exported only once, by the deduplicating exports of this
+    process.
+    '''
+    return dict(deduplication_stats)
+
+
+def record_cache_info():
+    '''Returns a dict with the hits and misses of every record cache used
+    by this process.
+    '''
+    return dict(record_cache_stats)
+
+
+def iter_export(unified_jsonobj, records=None, verbose=False, codegen=False,
+        workers=None, chunksize=None, record_cache_file=None, error_file=None,
+        profile=False, deduplicate=False, collapse_duplicates=False, engine_file=None):
+    '''Exports and serializes the records in the unified JSON parameter.
+    Returns an iterator that yields each serialized record as soon as it
+    is produced. Nothing is accumulated, so output can be written as the
+    export proceeds. The unified JSON is resolved (and any error in it
+    raised) before this returns.
+    `records`, if supplied, replaces the unified JSON's "records": it
+    may be any iterable, such as a generator reading records from a file,
+    so that a batch of any size is exported in bounded memory.
+    With `codegen`, records are exported by a Python module generated
+    for the MARCout Engine (see marcout_codegen.py).
+    With `workers` greater than 1, records are exported and serialized by
+    a pool of that many processes, `chunksize` records at a time (default
+    `export_chunksize`). Records are still yielded in input order, and
+    are identical to those exported in this process.
+    With `record_cache_file`, the path of a record cache (see
+    marcout_record_cache.py), records unchanged since they were last
+    exported with the same engine and collection info are taken from the
+    cache instead of being exported again (see `record_cache_info`).
+    With `error_file`, the export skips and continues: a record that
+    cannot be exported or serialized is left out of the output instead of
+    aborting the batch, and its error entry (see exporter.record_error)
+    is written to the JSON Lines file `error_file`, which ends with a
+    summary of the batch (see `iter_recording_errors`).
+    With `profile`, the export of each field template, and the computation
+    of each extractor, are timed and counted (see exporter.new_profile).
+    The profile is `profile_info()` once the records have been exported;
+    `format_profile_report` renders it as a table. Profiling measures the
+    exporter itself: it cannot be combined with `codegen` or `workers`.
+    While a tracing hook is registered (see marcout_tracing.py), the
+    export is one trace, with spans for parsing, and for the extraction,
+    export and serialization of records in this process.
+    With `deduplicate`, records that are equal as JSON are exported once,
+    and each duplicate yields its first occurrence's output in its own
+    position; with `collapse_duplicates`, duplicates are left out of the
+    output instead (see `iter_export_deduplicated`). The duplicates found
+    are counted in `deduplication_info()`.
+    With `engine_file`, the path of a MARCout Engine artifact file (see
+    marcout_artifact.py), the engine is loaded from it instead of being
+    parsed (see `resolve_unified_json`). Only the caller names it: a
+    unified JSON cannot.
+    '''
+    global last_profile
+    if profile and (codegen or (workers is not None and workers > 1)):
+        raise ValueError('Export profiling cannot be combined with codegen or workers.')
+    if tracing.hooks:
+        tracing.new_trace()
+
+    unified_jsonobj = parse_unified_json(unified_jsonobj, verbose)
+    if records is not None:
+        unified_jsonobj = dict(unified_jsonobj, records=records)
+
+    # turn the JSON into the Export Workset, with parsed MARCout Engine,
+    # records in the anticipated JSON form, and export directives &
+    # collection-specific metadata.
+    export_workset = resolve_unified_json(unified_jsonobj, verbose, engine_file)
+
+    errors = None
+    if error_file:
+        errors = collections.deque()
+    profile_report = None
+    if profile:
+        profile_report = exporter.new_profile(export_workset['marcout_engine'])
+        last_profile = profile_report
+
+    def export(workset, errors):
+        return iter_serialized(workset, verbose, codegen, workers, chunksize, errors,
+            profile_report)
+
+    def export_cached(workset, errors):
+        if record_cache_file:
+            return iter_export_cached(workset, record_cache_file, export, errors)
+        return export(workset, errors)
+
+    if deduplicate or collapse_duplicates:
+        outputs = iter_export_deduplicated(export_workset, export_cached,
+            collapse_duplicates, errors)
+    else:
+        outputs = export_cached(export_workset, errors)
+    if error_file:
+        return iter_recording_errors(outputs, errors, error_file)
+    return outputs
+
+
+def export_records(unified_jsonobj, as_string=False, verbose=False, codegen=False,
+        workers=None, chunksize=None, record_cache_file=None, error_file=None,
+        profile=False, deduplicate=False, collapse_duplicates=False, engine_file=None):
+    '''Exports and serializes the records in the unified JSON parameter.
+    With `codegen`, records are exported by a Python module generated
+    for the MARCout Engine (see marcout_codegen.py) instead of by the
+    general-purpose exporter. With `workers` greater than 1, records are
+    exported by a pool of that many processes, `chunksize` records at a
+    time. With `record_cache_file`, unchanged records are taken from a
+    persistent record cache (see `iter_export`). The output is the same.
+    With `error_file`, records that cannot be exported are left out, and
+    reported in that file (see `iter_export`). With `profile`, the export
+    is profiled (see `profile_info`). With `deduplicate` or
+    `collapse_duplicates`, duplicate records are exported once (see
+    `iter_export`). With `engine_file`, the engine is loaded from that
+    MARCout Engine artifact file (see `iter_export`).
+    '''
+    export_list = iter_export(unified_jsonobj, verbose=verbose, codegen=codegen,
+        workers=workers, chunksize=chunksize, record_cache_file=record_cache_file,
+        error_file=error_file, profile=profile, deduplicate=deduplicate,
+        collapse_duplicates=collapse_duplicates, engine_file=engine_file)
 
     if as_string:
-        export_list = '\n'.join(export_list)
+        return '\n'.join(export_list)
+
+    return list(export_list)
 
-    return export_list
+
+def profile_info():
+    '''Returns the export profile (see exporter.new_profile) of the latest
+    export run with `profile` in this process, or None. It is plain data:
+    json.dumps() gives its JSON form.
+    '''
+    return last_profile
 
 
+def format_profile_report(report):
+    '''Returns an export profile as human-readable text: a table of the
+    field templates, and one of the extractors, each most costly first.
+    '''
+    lines = []
+    lines.append('PROFILE: ' + str(report['records']) + ' records processed.')
+    lines.append('')
+    lines.append('  template  tag     calls    total ms  max ms  foreach ms  '
+        'passed    failed  raised')
+
+    templates = list(enumerate(report['templates']))
+    templates.sort(key=lambda pair: pair[1]['seconds'], reverse=True)
+    for indx, template in templates:
+        passed = '-'
+        if template['conditional']:
+            passed = format(template['passed'] * 100.0 / template['conditional'], '.0f') + '%'
+        lines.append('  ' + str(indx).rjust(8) + '  ' + template['tag'].ljust(5)
+            + str(template['calls']).rjust(8)
+            + format(template['seconds'] * 1000, '.2f').rjust(12)
+            + format(template['max_seconds'] * 1000, '.3f').rjust(8)
+            + format(template['foreach_seconds'] * 1000, '.2f').rjust(12)
+            + passed.rjust(8)
+            + str(template['failed_expressions']).rjust(10)
+            + str(template['exceptions']).rjust(8))
+
+    lines.append('')
+    lines.append('  extractor                        calls    total ms  max ms  defaulted')
+    extractors = sorted(report['extractors'].items(), key=lambda pair: pair[1]['seconds'],
+        reverse=True)
+    for name, extractor in extractors:
+        lines.append('  ' + name.ljust(30)
+            + str(extractor['calls']).rjust(8)
+            + format(extractor['seconds'] * 1000, '.2f').rjust(12)
+            + format(extractor['max_seconds'] * 1000, '.3f').rjust(8)
+            + str(extractor['defaulted']).rjust(11))
+
+    return '\n'.join(lines)
+
+
+def sample_records(records, sample):
+    '''Returns at most `sample` records, evenly spaced through `records`,
+    so that a sample sees the start, middle, and end of a batch. A
+    `sample` of less than 1 raises a ValueError.
+    '''
+    if sample < 1:
+        raise ValueError('Preflight sample size must be at least 1, not ' + str(sample) + '.')
+    if sample >= len(records):
+        return list(records)
+    step = len(records) / sample
+    return [records[int(indx * step)] for indx in range(sample)]
+
+
+def count_error(errors, ex):
+    '''Tallies exception `ex` in the dict `errors`, keyed by its message.'''
+    message = type(ex).__name__ + ': ' + str(ex)
+    errors[message] = errors.get(message, 0) + 1
+
+
+def preflight(export_workset, sample=None):
+    '''Dry-runs `export_workset` (see `resolve_unified_json`) against a
+    sample of its records, before committing to the whole batch. Every
+    JSON extracted property is computed, and every field template is
+    exported, for each sampled record, whether or not the record's fields
+    would use them.
+
+    Returns a report dict:
+        - 'records_sampled', 'records_total': sample and batch sizes.
+        - 'extractors': per extracted property name, a dict of
+            'defaulted' (how many sampled records fell back to its
+            `::DEFAULT`), 'seconds' (total time), and 'errors' (a count of
+            each distinct error message).
+        - 'templates': per field template, in order, a dict of 'tag',
+            'failed_expressions' (expressions that evaluated to '' because
+            they could not be evaluated), 'raised' (records for which the
+            template could not be exported at all), 'seconds', and
+            'errors'.
+        - 'problems': the number of extractors that fell back to their
+            `::DEFAULT` for every sampled record (a default for some
+            records is what `::DEFAULT` is for; for all of them, the
+            extractor is probably wrong), plus the number of templates
+            with failed expressions or raises. Zero means the sample
+            exported cleanly.
+    A `sample` of less than 1 raises a ValueError.
+    '''
+    if sample is None:
+        sample = preflight_sample_size
+
+    marcout_engine = export_workset['marcout_engine']
+    extractors = marcout_engine['json_extracted_properties']
+    templates = marcout_engine['marc_field_templates']
+    compiled_exprs = marcout_engine.get('compiled_expressions')
+    collection_info = export_workset['collection_info']
+    records = export_workset['records_to_export']
+    sampled = sample_records(records, sample)
+    functions = exporter.engine_functions(marcout_engine.get('pure_functions', ()))
+
+    extractor_report = collections.OrderedDict()
+    for name in extractors:
+        if name:
+            extractor_report[name] = {'defaulted': 0, 'seconds': 0.0, 'errors': {}}
+    template_report = []
+    for template in templates:
+        template_report.append({'tag': template['tag'], 'failed_expressions': 0,
+            'raised': 0, 'seconds': 0.0, 'errors': {}})
+
+    for record in sampled:
+        namespace = exporter.RecordNamespace(record, extractors, collection_info,
+            compiled_exprs, functions=functions)
+        record_namespace = {'album_json': record}
+
+        for name in extractor_report:
+            report = extractor_report[name]
+            failures = []
+            started = time.perf_counter()
+            value = exporter.compute_extract(extractors[name], record_namespace,
+                compiled_exprs, failures=failures)
+            report['seconds'] += time.perf_counter() - started
+            if failures:
+                report['defaulted'] += 1
+                count_error(report['errors'], failures[0])
+            # as RecordNamespace does
+            if value is None:
+                value = expressions.marcout_null
+            namespace[name] = value
+
+        for indx, template in enumerate(templates):
+            report = template_report[indx]
+            failures = []
+            started = time.perf_counter()
+            try:
+                exporter.export_marc_field(template, namespace, compiled_exprs, failures)
+            except Exception as ex:
+                report['raised'] += 1
+                count_error(report['errors'], ex)
+            report['seconds'] += time.perf_counter() - started
+            report['failed_expressions'] += len(failures)
+            for expr, ex in failures:
+                count_error(report['errors'], ex)
+
+    problems = 0
+    for name in extractor_report:
+        if sampled and extractor_report[name]['defaulted'] == len(sampled):
+            problems += 1
+    for report in template_report:
+        if report['failed_expressions'] or report['raised']:
+            problems += 1
+
+    return {'records_sampled': len(sampled),
+        'records_total': len(records),
+        'extractors': extractor_report,
+        'templates': template_report,
+        'problems': problems,
+    }
+
+
+def format_preflight_report(report):
+    '''Returns a `preflight` report as human-readable text, listing only
+    the extractors and templates that had problems.
+    '''
+    lines = []
+    lines.append('PREFLIGHT: ' + str(report['records_sampled']) + ' of '
+        + str(report['records_total']) + ' records sampled, '
+        + str(report['problems']) + ' problems.')
+
+    def add_errors(errors):
+        for message in sorted(errors, key=errors.get, reverse=True):
+            lines.append('      ' + str(errors[message]) + 'x ' + message)
+
+    for name in report['extractors']:
+        extractor = report['extractors'][name]
+        if extractor['defaulted']:
+            line = ('  extractor `' + name + '`: fell back to ::DEFAULT for '
+                + str(extractor['defaulted']) + ' records ('
+                + format(extractor['seconds'] * 1000, '.2f') + ' ms)')
+            if extractor['defaulted'] == report['records_sampled']:
+                line += ': EVERY RECORD'
+            lines.append(line)
+            add_errors(extractor['errors'])
+
+    for indx, template in enumerate(report['templates']):
+        if template['failed_expressions'] or template['raised']:
+            lines.append('  template ' + str(indx) + ' (' + template['tag'] + '): '
+                + str(template['failed_expressions']) + ' failed expressions, '
+                + str(template['raised']) + ' records not exported ('
+                + format(template['seconds'] * 1000, '.2f') + ' ms)')
+            add_errors(template['errors'])
+
+    return '\n'.join(lines)
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+# This module reads and writes MARCout Engine artifact files (".mcx"):
+#  a parsed, precompiled MARCout Engine that loads without re-parsing
+#  the MARCout export definition source.
+#
+# An artifact is a short header followed by the marshalled engine.
+# Compiled expressions are ASTs of plain tuples (see marcout_expressions.py),
+# so the engine is plain data that `marshal` stores compactly. The marshal
+# format may change between Python versions, so the header records the
+# version that wrote it too.
+#
+# Loading an artifact never executes code: its expressions can only call
+# the MARCout builtin functions. Still, only load artifacts you would
+# trust as MARCout source.
+
+import importlib.util
+import marshal
+import os
+
+import marcout_parser as parser
+
+
+# =============================================================================
+#
+# ================== CONSTANTS ================================================
+
+artifact_magic = b'MCX'
+# bump this whenever the engine datastructure changes shape
+artifact_format_version = 7
+
+artifact_header = (artifact_magic + bytes([artifact_format_version])
+    + importlib.util.MAGIC_NUMBER)
+
+
+
+# =============================================================================
+#
+# ================== FUNCTIONS ================================================
+
+
+def write_engine_artifact(marcout_engine, filepath):
+    '''Writes `marcout_engine` to `filepath` as an artifact file. The file is
+    written to a temporary name and then moved into place, so concurrent
+    readers never see a partial artifact.
+    '''
+    payload = marshal.dumps(marcout_engine)
+    temppath = filepath + '.tmp' + str(os.getpid())
+    with open(temppath, 'wb') as artifact_file:
+        artifact_file.write(artifact_header)
+        artifact_file.write(payload)
+    os.replace(temppath, filepath)
+
+
+def read_engine_artifact(filepath):
+    '''Returns the MARCout Engine stored in artifact file `filepath`.
+    Raises a ValueError if the file is not an artifact, or was written by
+    an incompatible artifact format or Python version.
+    '''
+    with open(filepath, 'rb') as artifact_file:
+        content = artifact_file.read()
+
+    if not content.startswith(artifact_magic):
+        raise ValueError('"' + filepath + '" is not a MARCout Engine artifact.')
+    if not content.startswith(artifact_header):
+        raise ValueError('MARCout Engine artifact "' + filepath 
+            + '" was written by an incompatible MARCout or Python version.')
+
+    try:
+        marcout_engine = marshal.loads(content[len(artifact_header):])
+    except (EOFError, ValueError, TypeError) as e:
+        raise ValueError('MARCout Engine artifact "' + filepath + '" is corrupt: ' + str(e))
+
+    if not isinstance(marcout_engine, dict) or 'source_hash' not in marcout_engine:
+        raise ValueError('MARCout Engine artifact "' + filepath + '" is corrupt.')
+
+    return marcout_engine
+
+
+def load_engine_artifact(filepath, marcout_lines=None):
+    '''Returns the MARCout Engine in artifact file `filepath`.
+
+    If `marcout_lines` (the MARCout source, as a list of lines) is supplied,
+    the artifact must have been built from that source: a missing,
+    unreadable, incompatible, or stale artifact (one whose source hash does
+    not match) is rebuilt from `marcout_lines` and rewritten in place.
+    Without `marcout_lines`, an unusable artifact raises a ValueError.
+    '''
+    if marcout_lines is None:
+        return read_engine_artifact(filepath)
+
+    expected_hash = parser.source_hash(marcout_lines)
+    try:
+        marcout_engine = read_engine_artifact(filepath)
+        if marcout_engine['source_hash'] == expected_hash:
+            return marcout_engine
+    except (OSError, ValueError):
+        # missing or unusable. Rebuild.
+        pass
+
+    marcout_engine = parser.parse_marcexport_deflines(marcout_lines)
+    try:
+        write_engine_artifact(marcout_engine, filepath)
+    except OSError:
+        # an unwritable artifact location costs a re-parse next time,
+        # but must not cost this export.
+        pass
+
+    return marcout_engine
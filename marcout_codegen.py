@@ -0,0 +1,448 @@
+#!/usr/bin/python3
+
+# This module turns a MARCout Engine into a specialized Python module:
+#  straight-line Python source with one function per MARC field template,
+#  and an `export_record(album_json, collection_info)` entry point that
+#  returns the same exported record datastructure as
+#  marcout_exporter.export_records_per_marcdef does for one record.
+#
+# Generated modules are written to a cache directory (by default
+# `__marcoutcache__` beside this file), named for the engine's source hash
+# and the generator version, and imported with importlib. Python caches
+# their bytecode in the usual `__pycache__` beneath that directory.
+
+import importlib.util
+import keyword
+import os
+
+import marcout_exporter as exporter
+import marcout_expressions as expressions
+import marcout_fields as fields
+import marcout_parser as parser
+
+
+# =============================================================================
+#
+# ================== CONSTANTS ================================================
+
+# bump this whenever generated source changes: it is part of the module name,
+# so modules generated by an older generator are never reused.
+codegen_version = 6
+
+default_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '__marcoutcache__')
+
+# names the generated export_record function uses for itself
+reserved_names = ('album_json', 'collection_info', 'eachitem')
+
+# generated modules already imported in this process, keyed by module
+# name; None for engines that cannot be generated (see load_engine_module)
+loaded_modules = {}
+
+
+
+# =============================================================================
+#
+# ================== SOURCE GENERATION FUNCTIONS ==============================
+
+
+def python_name(name, description):
+    '''Returns `name` if generated source can use it as a variable name:
+    a Python identifier that is not a keyword, not reserved by the
+    generated code, and not private. Otherwise raises a ValueError.
+    Names from the MARCout definition are only ever spliced into
+    generated source after this check; everything else goes through
+    repr().
+    '''
+    if (not isinstance(name, str) or not name.isidentifier() or keyword.iskeyword(name)
+            or name in reserved_names or name.startswith('_')):
+        raise ValueError(description + ' `' + str(name)
+            + '` cannot be used in a generated MARCout module.')
+    return name
+
+
+def compile_node(expr, eachitem=None):
+    '''Returns the AST of template expression `expr` (see
+    marcout_expressions.py), compiled in the context of FOR EACH item
+    `eachitem`, if any.
+    '''
+    return parser.compile_expr(expr, eachitem)
+
+
+def referenced_names(expr, eachitem=None):
+    '''Returns the set of names, including function names, that MARCout
+    expression `expr` reads.
+    '''
+    names, funcnames = expressions.referenced_names(compile_node(expr, eachitem))
+    return names | funcnames
+
+
+def literal_value(expr):
+    '''Returns (True, value) if `expr` is a constant MARCout expression,
+    such as a quoted string; otherwise (False, None).
+    '''
+    node = compile_node(expr)
+    if node[0] == 'const':
+        return True, node[1]
+    return False, None
+
+
+def emit_computed(lines, indent, varname, expr):
+    '''Appends source lines assigning the value of template expression
+    `expr` to `varname`, with the semantics of exporter.compute_expr:
+    an expression that cannot be evaluated yields ''.
+    '''
+    if not expr.strip():
+        lines.append(indent + varname + " = ''")
+        return
+
+    node = compile_node(expr)
+    if node[0] == 'const':
+        lines.append(indent + varname + ' = ' + repr(node[1]))
+        return
+
+    lines.append(indent + 'try:')
+    lines.append(indent + '    ' + varname + ' = ' + expressions.to_python(node))
+    lines.append(indent + 'except Exception:')
+    lines.append(indent + '    ' + varname + " = ''")
+
+
+def template_exprs(template):
+    '''Returns the list of (expression, eachitem) pairs in a field
+    template, where `eachitem` names the FOR EACH item of a FOR EACH
+    subfield, and is None otherwise.
+    '''
+    exprs = []
+    for propname in ('content', 'export_if', 'export_if_not'):
+        if template.get(propname):
+            exprs.append((template[propname], None))
+
+    for subfield_dict in template.get('subfields', []):
+        for subfield_code in subfield_dict:
+            exprs.append((subfield_dict[subfield_code], None))
+
+    if 'foreach' in template:
+        foreach = template['foreach']
+        for subfield_dict in foreach.get('subfields', []):
+            for subfield_code in subfield_dict:
+                exprs.append((subfield_dict[subfield_code], foreach['eachitem']))
+        for sortby in foreach.get('sortby', []):
+            exprs.append((sortby, foreach['eachitem']))
+        for propname in ('prefix', 'suffix', 'demarcator'):
+            if foreach.get(propname):
+                exprs.append((foreach[propname], None))
+
+    return [(expr, eachitem) for expr, eachitem in exprs if expr.strip()]
+
+
+def generate_foreach(lines, foreach):
+    '''Appends source lines computing `_groups`, the rendered FOR EACH groups,
+    with the semantics of exporter.evaluate_foreach.
+    '''
+    indent = ' ' * 4
+
+    # each demarcator's value: a constant, or computed once for the block.
+    # Empty demarcators are absent, as in exporter.evaluate_foreach.
+    demarcators = {}
+    for propname in ('prefix', 'suffix', 'demarcator'):
+        demarcators[propname] = 'None'
+        expr = foreach.get(propname)
+        if not expr:
+            continue
+        is_literal, value = literal_value(expr)
+        if is_literal:
+            demarcators[propname] = repr(value)
+        else:
+            lines.append(indent + '_' + propname + ' = '
+                + expressions.to_python(compile_node(expr)))
+            demarcators[propname] = '_' + propname
+
+    if 'sortby' not in foreach:
+        # as exporter.evaluate_foreach: FOR EACH requires SORT BY
+        lines.append(indent + "raise KeyError('sortby')")
+        return
+    # cascading sort on the SORT BY keys; the itemsource is not reordered
+    sortkeys = [expressions.to_python(compile_node(sortby, foreach['eachitem']))
+        for sortby in foreach['sortby']]
+    lines.append(indent + '_items = sorted('
+        + python_name(foreach['itemsource'], 'FOR EACH item source')
+        + ', key=lambda eachitem: (' + ', '.join(sortkeys) + ',))')
+    lines.append(indent + '_groups = []')
+    lines.append(indent + 'for eachitem in _items:')
+
+    subfield_items = []
+    for subfield_dict in foreach.get('subfields', []):
+        for subfield_code in subfield_dict:
+            node = compile_node(subfield_dict[subfield_code], foreach['eachitem'])
+            subfield_items.append('_Subfield(' + repr(subfield_code) + ', '
+                + expressions.to_python(node) + ')')
+
+    lines.append(indent + '    _groups.append(_ForeachGroup([' + ', '.join(subfield_items)
+        + '], ' + demarcators['prefix'] + ', ' + demarcators['suffix'] + ', '
+        + demarcators['demarcator'] + '))')
+
+
+def generate_field_function(funcname, template, arg_names, keys_name):
+    '''Returns the source of a function that exports one MARC field per
+    `template`, or returns None if the template's export conditions
+    exclude the field. `keys_name` is the module global holding the
+    tuple of the template's property names.
+    '''
+    indent = ' ' * 4
+    lines = []
+    lines.append('def ' + funcname + '(' + ', '.join(arg_names) + '):')
+    lines.append(indent + '# ' + repr(template['tag']))
+
+    values = {}
+
+    if 'export_if' in template:
+        emit_computed(lines, indent, '_export_if', template['export_if'])
+        lines.append(indent + 'if not _export_if:')
+        lines.append(indent + '    return None')
+        values['export_if'] = '_export_if'
+
+    if 'export_if_not' in template:
+        emit_computed(lines, indent, '_export_if_not', template['export_if_not'])
+        lines.append(indent + 'if _export_if_not:')
+        lines.append(indent + '    return None')
+        values['export_if_not'] = '_export_if_not'
+
+    if 'content' in template:
+        emit_computed(lines, indent, '_content', template['content'])
+        values['content'] = '_content'
+
+    if 'subfields' in template:
+        subfield_values = []
+        for indx, subfield_dict in enumerate(template['subfields']):
+            for subfield_code in subfield_dict:
+                varname = '_sub' + str(indx)
+                emit_computed(lines, indent, varname, subfield_dict[subfield_code])
+                subfield_values.append('_Subfield(' + repr(subfield_code) + ', ' + varname + ')')
+        values['subfields'] = '[' + ', '.join(subfield_values) + ']'
+
+    if 'foreach' in template:
+        generate_foreach(lines, template['foreach'])
+        values['foreach'] = '_groups'
+
+    # the exported field has the template's properties (see marcout_fields.py)
+    args = [keys_name, repr(template['tag'])]
+    for propname in template:
+        if propname == 'tag':
+            continue
+        if propname not in fields.MarcField.__slots__ or propname == 'keys':
+            raise ValueError('Field template property `' + str(propname)
+                + '` cannot be used in a generated MARCout module.')
+        if propname in values:
+            args.append(propname + '=' + values[propname])
+        else:
+            args.append(propname + '=' + repr(template[propname]))
+    lines.append(indent + 'return _MarcField(' + ', '.join(args) + ')')
+
+    return '\n'.join(lines) + '\n'
+
+
+def generate_engine_source(marcout_engine):
+    '''Returns Python source for a module specialized to `marcout_engine`,
+    exposing `export_record(album_json, collection_info)`.
+    Raises a ValueError if the engine uses a name that generated source
+    cannot (see `python_name`), or reads a name that is neither extracted,
+    a collection parameter, nor a MARCout function: generated source must
+    not resolve it to a Python builtin where the exporter would not.
+    '''
+    indent = ' ' * 4
+    extractors = marcout_engine['json_extracted_properties']
+    templates = marcout_engine['marc_field_templates']
+
+    extract_names = [python_name(name, 'Extracted property name')
+        for name in extractors if name]
+    param_names = [python_name(name, 'Collection parameter name')
+        for name in marcout_engine['known_parameters'] if name not in extract_names]
+    local_names = set(extract_names) | set(param_names)
+
+    # everything a template reads that is neither extracted nor a
+    # collection parameter resolves to a MARCout builtin
+    global_names = set()
+    template_args = []
+    for template in templates:
+        names = set()
+        for expr, eachitem in template_exprs(template):
+            names |= referenced_names(expr, eachitem)
+        if 'foreach' in template:
+            names.add(template['foreach']['itemsource'])
+        template_args.append(sorted(names & local_names))
+        global_names |= names - local_names
+
+    extractor_exprs = {}
+    for name in extract_names:
+        varval_expr, default = parser.split_default(str(extractors[name]))
+        extractor_exprs[name] = (expressions.to_python(compile_node(varval_expr)),
+            expressions.to_python(parser.compile_default(default)))
+        global_names |= referenced_names(varval_expr) - set(reserved_names) - local_names
+
+    unknown_names = global_names - set(exporter.builtin_functions)
+    if unknown_names:
+        raise ValueError('Name `' + sorted(unknown_names)[0]
+            + '` cannot be used in a generated MARCout module.')
+
+    # MARCout functions are bound from the engine's function table (see
+    # exporter.engine_functions), the same functions that evaluated
+    # engines call, memoized where the engine declares them PURE
+    imports = sorted(name for name in global_names if name in exporter.builtin_functions)
+
+    lines = []
+    lines.append('# MARCout Engine module generated by marcout_codegen version '
+        + str(codegen_version) + '.')
+    lines.append('# Source hash: ' + marcout_engine['source_hash'])
+    lines.append('# DO NOT EDIT: regenerated whenever the MARCout source changes.')
+    lines.append('')
+    lines.append('from marcout_exporter import engine_functions as _engine_functions')
+    lines.append('from marcout_expressions import marcout_null as _marcout_null')
+    lines.append('from marcout_fields import ForeachGroup as _ForeachGroup')
+    lines.append('from marcout_fields import MarcField as _MarcField')
+    lines.append('from marcout_fields import Subfield as _Subfield')
+    lines.append('')
+    lines.append('_functions = _engine_functions('
+        + repr(tuple(marcout_engine.get('pure_functions', ()))) + ')')
+    for name in imports:
+        lines.append(name + ' = _functions[' + repr(name) + ']')
+    lines.append('')
+    lines.append('')
+
+    # the property names of each template, shared by its exported fields
+    for indx, template in enumerate(templates):
+        lines.append('_keys_' + str(indx) + ' = ' + repr(tuple(template)))
+    lines.append('')
+    lines.append('')
+
+    funcnames = []
+    for indx, template in enumerate(templates):
+        funcname = '_field_' + str(indx)
+        funcnames.append(funcname)
+        lines.append(generate_field_function(funcname, template, template_args[indx],
+            '_keys_' + str(indx)))
+        lines.append('')
+
+    lines.append('def export_record(album_json, collection_info):')
+    lines.append(indent + '# collection parameters')
+    for name in param_names:
+        lines.append(indent + name + ' = collection_info[' + repr(name) + ']')
+    lines.append('')
+    lines.append(indent + '# extracted properties')
+    for name in extract_names:
+        varval_source, default_source = extractor_exprs[name]
+        lines.append(indent + 'try:')
+        lines.append(indent + '    ' + name + ' = ' + varval_source)
+        lines.append(indent + 'except Exception:')
+        lines.append(indent + '    ' + name + ' = ' + default_source)
+    for name in extract_names:
+        # as in exporter.RecordNamespace
+        lines.append(indent + 'if ' + name + ' is None:')
+        lines.append(indent + '    ' + name + ' = _marcout_null')
+    lines.append('')
+    lines.append(indent + '_record_output = []')
+    for indx, funcname in enumerate(funcnames):
+        lines.append(indent + '_field = ' + funcname + '(' + ', '.join(template_args[indx]) + ')')
+        lines.append(indent + 'if _field is not None:')
+        lines.append(indent + '    _record_output.append(_field)')
+    lines.append(indent + 'return _record_output')
+
+    return '\n'.join(lines) + '\n'
+
+
+
+# =============================================================================
+#
+# ================== MODULE CACHE FUNCTIONS ===================================
+
+
+def engine_module_name(marcout_engine):
+    '''Returns the module name for the generated module of `marcout_engine`.'''
+    return ('marcout_engine_' + marcout_engine['source_hash'][:24]
+        + '_v' + str(codegen_version))
+
+
+def load_engine_module(marcout_engine, cache_dir=None):
+    '''Returns the generated module for `marcout_engine`, generating and
+    writing its source into `cache_dir` only if it is not already there.
+    Returns None if no module can be generated for the engine (see
+    `generate_engine_source`) or if it cannot be written into `cache_dir`.
+    '''
+    modname = engine_module_name(marcout_engine)
+    if modname in loaded_modules:
+        return loaded_modules[modname]
+
+    if cache_dir is None:
+        cache_dir = default_cache_dir
+    filepath = os.path.join(cache_dir, modname + '.py')
+
+    if not os.path.isfile(filepath):
+        try:
+            source = generate_engine_source(marcout_engine)
+            compile(source, filepath, 'exec')
+        except (ValueError, SyntaxError):
+            loaded_modules[modname] = None
+            return None
+        # write to a temporary name and move into place, so concurrent
+        # processes never import a partial module
+        temppath = filepath + '.tmp' + str(os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(temppath, 'w') as modfile:
+                modfile.write(source)
+            os.replace(temppath, filepath)
+        except OSError:
+            # an unwritable cache costs the speed of the generated module,
+            # but must not cost this export.
+            if os.path.isfile(temppath):
+                os.remove(temppath)
+            loaded_modules[modname] = None
+            return None
+
+    spec = importlib.util.spec_from_file_location(modname, filepath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    loaded_modules[modname] = module
+    return module
+
+
+def iter_export_records_per_module(export_workset, verbose=False, errors=None):
+    '''Generator form of `export_records_per_module`: yields each exported
+    record as soon as it is exported. `errors` is as for
+    exporter.iter_export_records_per_marcdef, except that the entries
+    of generated modules do not name the template or expression.
+    An engine that cannot be generated, or whose module cannot be written
+    to the cache, is exported by the exporter.
+    '''
+    module = load_engine_module(export_workset['marcout_engine'])
+    if module is None:
+        if verbose:
+            print('No module can be loaded for this engine: exporting with marcout_exporter')
+        yield from exporter.iter_export_records_per_marcdef(export_workset, verbose, errors)
+        return
+    collection_info = export_workset['collection_info']
+
+    if verbose:
+        print('Exporting with generated module ' + module.__name__)
+
+    export_record = module.export_record
+    if errors is None:
+        for record in export_workset['records_to_export']:
+            yield export_record(record, collection_info)
+        return
+
+    for recordno, record in enumerate(export_workset['records_to_export']):
+        try:
+            exported = export_record(record, collection_info)
+        except Exception as ex:
+            errors.append(exporter.record_error(recordno, record, 'export', ex))
+            exported = None
+        yield exported
+
+
+def export_records_per_module(export_workset, verbose=False):
+    '''Equivalent to exporter.export_records_per_marcdef, but exports through
+    the generated module for the workset's MARCout Engine.
+    RETURNS a List of exported records
+    '''
+    return list(iter_export_records_per_module(export_workset, verbose))
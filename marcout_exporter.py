@@ -1,190 +1,41 @@
 #!/usr/bin/python3
 
+import marcout_expressions as expressions
+import marcout_fields as fields
 import marcout_parser as parser
-import copy
+import marcout_tracing as tracing
+import functools
 import hashlib
+import itertools
+import json
+import time
 
 
 debug_output = False
 
-# =============================================================================
-#
-# ================== MARCout EXPRESSION BUILT-IN IMPLEMENTATIONS ===============
-
-
-# FUNCTIONS IMPLICITLY CALLED WHEN PARSER FINDS KEYWORD
-
-# - `IS`: operator that compares two sub-expressions for equality. 
-#     Equivalent to `==` in Python or JavaScript. No function: direct 
-#     substitution in parser.
-
-# `PRESENT`: an expression is `PRESENT` if it can be evaluated.
-def marcout_is_present(expr_string):
-    try:
-        eval(expr_string)
-        return True
-    except:
-        return False
-
-# - `IS TRUE`: postfix operator that resolves to True if the preceding
-#     expression is a MARCout distinguished value for `TRUE`.
-def marcout_is_true(expr):
-
-    # boolean is ok
-    if isinstance(expr, bool):
-        return expr
-
-    # test for numeric 1 as distinguished value for `TRUE`
-    elif isinstance(expr, int):
-        return expr == 1
-
-    elif isinstance(expr, str):
-        check_expr = str(expr).lower()
-        if check_expr in ('true', 'yes'):
-            return True
-        else:
-            # complex string. evaluate expression
-            try:
-                expr = eval(expr)
-                # if it comes out as a boolean, it was a proper
-                # boolean function call
-                if isinstance(expr, bool):
-                    return expr
-                else:
-                    # not a boolean function call
-                    return False
-            except:
-                # if it blows up, it's not `PRESENT`
-                return False
-    else:
-        return False
-
-
-# - `IS FALSE`: postfix operator that resolves to True if the preceding
-#     expression is a MARCout distinguished value for `FALSE`
-
-def marcout_is_false(expr):
-
-    # boolean is ok
-    if isinstance(expr, bool):
-        # reverse the sense
-        return not expr
-
-    # test for numeric 0 as distinguished value for `FALSE`
-    elif isinstance(expr, int):
-        return expr == 0
-
-    elif isinstance(expr, str):
-        check_expr = str(expr).lower()
-        if check_expr in ('false', 'no'):
-            return True
-        else:
-            # complex string. evaluate expression
-            try:
-                expr = eval(expr)
-                # if it comes out as a boolean, it was a proper
-                # boolean function call.
-                # reverse the sense
-                if isinstance(expr, bool):
-                    return notexpr
-                else:
-                    # not a boolean function call
-                    return False
-            except:
-                # if it blows up, it's not `PRESENT`
-                return False
-    else:
-        return False
-
-
-# - `HAS VALUE`: postfix operator that resolves to True if the preceding 
-    # expression is PRESENT and not `EMPTY`. In other words, the expression
-    # has meaning over and above the ambiguous empty values.
+# number of records whose JSON extracted properties are computed together,
+# a column at a time (see `ExtractColumns`)
+extract_chunksize = 256
 
-def marcout_has_value(expr):
+# maximum number of results kept per memoized (`PURE`) function
+function_cache_size = 4096
 
-    if expr is None:
-        return False
+# memoized versions of the functions in `builtin_functions`, by name,
+# shared by every engine that declares the function `PURE`
+function_memos = {}
 
-    if isinstance(expr, str):
-        check_expr = expr.strip()
-        # False if `EMPTY`: whitespace or empty string
-        if len(check_expr) == 0:
-            return False
-        else:
-            # `expr` might be an evaluable expression
-            try:
-                expr = eval(expr)
-                # recurse with results of evaluation
-                return marcout_has_value(expr)
-            except:
-                # not an evaluable expression. Just a non-empty string
-                return True
-
-    elif isinstance(expr, (list, tuple, dict, set)):
-        # False if `expr` is a data structure with no content
-        # otherwise True
-        return len(expr) > 0
-
-    else:
-        # other types do not have defined `EMPTY` values
-        return True
-
-# - `HAS NO VALUE`: postfix operator that resolves to True if the preceding
-#     expression is not `PRESENT`, or, if `PRESENT`, is `EMPTY`.
-def marcout_has_no_value(expr_string):
-
-    if expr is None:
-        return True
-
-    if isinstance(expr, str):
-        check_expr = expr.strip()
-        # True if `EMPTY`: whitespace or empty string
-        if len(check_expr) == 0:
-            return True
-        else:
-            # `expr` might be an evaluable expression
-            try:
-                expr = eval(expr)
-                # recurse with results of evaluation
-                return marcout_has_value(expr)
-            except:
-                # not an evaluable expression. Just a non-empty string
-                return False
-
-    elif isinstance(expr, (list, tuple, dict, set)):
-        # True if `expr` is a data structure with no content
-        # otherwise False
-        return len(expr) == 0
-
-    else:
-        # other types do not have defined `EMPTY` values
-        return False
+# function tables for engines, keyed by their tuple of `PURE` names
+engine_function_tables = {}
 
+# =============================================================================
+#
+# ================== MARCout EXPRESSION BUILT-IN IMPLEMENTATIONS ===============
 
-# - `NOTHING`: keyword for an empty value. Depending on context, equivalent
-#     to an empty string, or to a non-value such as Python `None` or
-#     JSON `null`.
-
-def marcout_nothing_value(type):
-    if type in (str, unicode):
-        return ''
-    else:
-        return None
-
-# - `STARTS WITH`: operator for string values. Resolves to True if the
-#     preceding string starts with the subsequent string.
-def marcout_startswith(tested_expr, start_expr):
-    return tested_expr.startswith(start_expr)
 
-# - `CONTAINS`: operator for string values. Resolves to True if the
-#     preceding string starts with the subsequent string
-def marcout_contains(tested_expr, search_expr):
-    return (search_expr in tested_expr)
+# The MARCout keywords (`IS TRUE`, `HAS VALUE`, `STARTS WITH`, etc.) are
+# implemented in marcout_expressions.py, which compiles them to calls of
+# `expressions.keyword_functions`.
 
-# No function necessary: parser leaves in place.
-# - `+`: the concatenation operator for string values. Does NOT represent
-#     numeric addition.
 
 # =============================================================================
 #
@@ -326,6 +177,96 @@ def compute_control_number(album_id, collection_abbr):
     return control_number;
 
 
+# functions that MARCout expressions may call, by name: the keyword
+# functions, the builtins above, and a few safe Python builtins.
+builtin_functions = {
+    'normalize_date': normalize_date,
+    'biblio_name': biblio_name,
+    'release_year': release_year,
+    'release_decade': release_decade,
+    'pretty_comma_list': pretty_comma_list,
+    'zeropad': zeropad,
+    'h_m_s': h_m_s,
+    'render_duration': render_duration,
+    'total_play_length': total_play_length,
+    'compute_control_number': compute_control_number,
+    'str': str,
+    'int': int,
+    'float': float,
+    'len': len,
+}
+builtin_functions.update(expressions.keyword_functions)
+
+
+def memoize_function(func, maxsize):
+    '''Returns `func` wrapped in a bounded LRU memo of `maxsize` results.
+    Arguments are cached by value and type (so the string 'None' and
+    `expressions.marcout_null` are kept apart). Calls with unhashable
+    arguments, such as a list of tracks, are passed straight to `func`.
+    The wrapper has `cache_info()` and `cache_clear()`.
+    '''
+    cached = functools.lru_cache(maxsize=maxsize, typed=True)(func)
+
+    @functools.wraps(func)
+    def memoized(*args):
+        try:
+            hash(args)
+        except TypeError:
+            return func(*args)
+        return cached(*args)
+
+    memoized.cache_info = cached.cache_info
+    memoized.cache_clear = cached.cache_clear
+    return memoized
+
+
+def engine_functions(pure_functions=()):
+    '''Returns the function table for an engine that declares the
+    functions named in `pure_functions` to be `PURE`: `builtin_functions`,
+    with each of those replaced by its memoized version. Memos are
+    shared between engines, so results carry over from one workset, and
+    one request, to the next.
+    '''
+    key = tuple(sorted(pure_functions))
+    if key in engine_function_tables:
+        return engine_function_tables[key]
+
+    functions = dict(builtin_functions)
+    for funcname in key:
+        if funcname not in builtin_functions or funcname in expressions.keyword_functions:
+            continue
+        if funcname not in function_memos:
+            function_memos[funcname] = memoize_function(builtin_functions[funcname],
+                function_cache_size)
+        functions[funcname] = function_memos[funcname]
+
+    engine_function_tables[key] = functions
+    return functions
+
+
+def function_cache_info():
+    '''Returns, for each memoized function, a dict of its cache's hits,
+    misses, current size, maximum size, and hit rate.
+    '''
+    retval = {}
+    for funcname in sorted(function_memos):
+        info = function_memos[funcname].cache_info()
+        calls = info.hits + info.misses
+        retval[funcname] = {'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'maxsize': info.maxsize,
+            'hit_rate': (info.hits / calls) if calls else 0.0,
+        }
+    return retval
+
+
+def clear_function_caches():
+    '''Empties every memoized function's cache, and resets its counters.'''
+    for funcname in function_memos:
+        function_memos[funcname].cache_clear()
+
+
 
 # =============================================================================
 
@@ -336,89 +277,371 @@ def compute_control_number(album_id, collection_abbr):
 # ================== CORE FUNCTIONS FOR EXPORTING MARC RECORDS ================
 
 
+def compute_extract(extractor, namespace, compiled_exprs=None, verbose=False,
+        failures=None):
+    '''Returns the value of JSON extracted property expression `extractor`
+    (which may end in `::DEFAULT <default>`) in `namespace`, where the JSON
+    record is `album_json`. An extractor that cannot be evaluated for this
+    record takes its `::DEFAULT` value, or ''.
+    If `failures` is a list, the exception of an extractor that fell back
+    to its default is appended to it.
+    '''
+    # apply any defaults left embedded by parser
+    varval_expr, default = parser.split_default(str(extractor))
+
+    try:
+        return evaluate_expr(varval_expr, compiled_exprs, namespace)
+    except Exception as e:
+        if failures is not None:
+            failures.append(e)
+        if verbose:
+            indent = ' ' * 4
+            print(indent + 'ATTEMPTING TO RESOLVE `' + varval_expr + '`')
+            print(indent + 'EVALUATION EXCEPTION of type "' + str(type(e)) + '":')
+            print(e)
+            print(indent + indent + 'APPLYING DEFAULT `' + default + '`')
+            print()
+
+    default_node = None
+    if compiled_exprs:
+        default_node = compiled_exprs.get(default)
+    if default_node is None:
+        default_node = parser.compile_default(default)
+    return expressions.evaluate(default_node, namespace, builtin_functions)
+
+
 def compute_extracts(extract_block, jsonobj):
-    # print('COMPUTING EXTRACTS.')
-    # print(extract_block)
-    # print
+    '''Returns the values of the JSON extracted properties in
+    `extract_block` for JSON record `jsonobj`. An extractor that cannot be
+    evaluated for this record takes its `::DEFAULT` value, or ''.
+    '''
     retval = {}
-    album_json = jsonobj
+    namespace = {'album_json': jsonobj}
     for propname in extract_block:
         if not propname:
             # empty key got in. gotta fix the parse
             continue
-        # print(propname + ':')
-        # print(extract_block[propname])
-        extracted_val = eval(extract_block[propname])
-        # print(extracted_val)
-        retval[propname] = extracted_val
+        retval[propname] = compute_extract(extract_block[propname], namespace)
     return retval
 
 
+@functools.lru_cache(maxsize=None)
+def path_getter(path):
+    '''Returns a function that reads subscript `path` (a tuple of keys, see
+    parser.extractor_paths) from a JSON record: for ('album', 'id'),
+    the function returns record['album']['id'].
+    '''
+    if len(path) == 1:
+        key0, = path
+        return lambda record: record[key0]
+    if len(path) == 2:
+        key0, key1 = path
+        return lambda record: record[key0][key1]
+    if len(path) == 3:
+        key0, key1, key2 = path
+        return lambda record: record[key0][key1][key2]
+
+    def getter(record):
+        for key in path:
+            record = record[key]
+        return record
+    return getter
+
+
+def compute_extract_column(extractor, records, compiled_exprs=None, path=None,
+        failures=None):
+    '''Returns a list of the values of JSON extracted property expression
+    `extractor` for each of `records`, computed in one loop. Records for
+    which the extractor cannot be evaluated take its `::DEFAULT` value, or
+    '': a constant default is computed once for the whole column.
+    If the extractor is a plain subscript chain with keys `path` (see
+    parser.extractor_paths), each value is read by a direct getter.
+    If `failures` is a list, the exception of each record that took the
+    default is appended to it.
+    '''
+    varval_expr, default = parser.split_default(str(extractor))
 
-def rewrite_for_context(marcout_expr, context_expr, context_varname):
-    '''Translates context-identifying MARCout expression into an evaluable form.
-    Parameters: `marcout_expr` is the MARCout expression.
-    `context_expr` is the MARCout identifier for the context.
-    `context_varname` is the evaluable variable reference for the context.
+    node = None
+    if compiled_exprs:
+        node = compiled_exprs.get(varval_expr)
+    if node is None:
+        try:
+            node = parser.compile_expr(varval_expr)
+        except ValueError:
+            # not evaluable for any record
+            node = None
+
+    default_node = None
+    if compiled_exprs:
+        default_node = compiled_exprs.get(default)
+    if default_node is None:
+        default_node = parser.compile_default(default)
+    default_value = None
+    if default_node[0] == 'const':
+        default_value = default_node[1]
+
+    if path is not None:
+        getter = path_getter(path)
+        column = []
+        for record in records:
+            try:
+                column.append(getter(record))
+            except Exception as ex:
+                if failures is not None:
+                    failures.append(ex)
+                if default_node[0] == 'const':
+                    column.append(default_value)
+                else:
+                    # a list default: a new one for each record
+                    column.append(expressions.evaluate(default_node,
+                        {'album_json': record}, builtin_functions))
+        return column
+
+    evaluate = expressions.evaluate
+    namespace = {}
+    column = []
+    for record in records:
+        namespace['album_json'] = record
+        try:
+            if node is None:
+                raise KeyError(varval_expr)
+            column.append(evaluate(node, namespace, builtin_functions))
+        except Exception as ex:
+            if failures is not None:
+                failures.append(ex)
+            if default_node[0] == 'const':
+                column.append(default_value)
+            else:
+                # a list default: a new one for each record
+                column.append(evaluate(default_node, namespace, builtin_functions))
+    return column
+
+
+class ExtractColumns(dict):
+    '''The JSON extracted properties of a chunk of records, a column (a
+    list with one value per record) per property. Each column is computed
+    the first time any record of the chunk reads its property, so
+    properties that no exported field reads are never computed.
+    If `profile` is an export profile (see `new_profile`), the columns
+    computed are profiled in it.
+    '''
 
-    EXAMPLE from FOREACH block:
-    marcout_expr: 'render_duration(track::duration)'
-    context_expr: 'track::'
-    context_varname: 'current_item'
-    return value: "render_duration(current_item['duration'])"
+    def __init__(self, records, extractors, compiled_exprs=None, verbose=False,
+            paths=None, profile=None):
+        dict.__init__(self)
+        self.records = records
+        self.extractors = extractors
+        self.compiled_exprs = compiled_exprs
+        self.verbose = verbose
+        # the engine's 'extractor_paths'
+        self.paths = paths or {}
+        self.profile = profile
+
+    def __missing__(self, name):
+        extractor = self.extractors[name]
+        if self.verbose:
+            indent = ' ' * 2
+            print(indent + 'resolving `' + name + ': ' + str(extractor) + '` for '
+                + str(len(self.records)) + ' records')
+        span = None
+        if tracing.hooks:
+            span = tracing.start_span('marcout.extract', {'extractor': name,
+                'records': len(self.records)})
+        if self.profile is None:
+            column = compute_extract_column(extractor, self.records, self.compiled_exprs,
+                self.paths.get(name))
+        else:
+            column = profile_extract_column(self.profile, name, extractor, self.records,
+                self.compiled_exprs, self.paths.get(name))
+        if span is not None:
+            tracing.end_span(span)
+        self[name] = column
+        return column
+
+
+def iter_record_rows(records, extractors, compiled_exprs=None, verbose=False,
+        chunksize=None, paths=None, profile=None):
+    '''Yields (record, columns, row) for each of iterable `records`, where
+    `columns` are the ExtractColumns of a chunk of up to `chunksize`
+    (default `extract_chunksize`) records, and the record is its row `row`.
+    `paths` are the engine's 'extractor_paths'; `profile`, if any, an
+    export profile (see `new_profile`).
     '''
-    tokens = parser.tokenize(marcout_expr)
-    for indx, token in enumerate(tokens):
-        if token.startswith(context_expr):
-            # change from MARCout notation to dict notation
-            tokens[indx] = token.replace(context_expr, context_varname + '[\'') + '\']'
-        # print(token)
-    return ''.join(tokens)
+    if chunksize is None:
+        chunksize = extract_chunksize
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunksize))
+        if not chunk:
+            return
+        columns = ExtractColumns(chunk, extractors, compiled_exprs, verbose, paths,
+            profile)
+        for row, record in enumerate(chunk):
+            yield record, columns, row
+
+
+class RecordNamespace(dict):
+    '''The namespace in which compiled MARCout expressions are evaluated
+    for one record: collection parameters, overlaid by the record's JSON
+    extracted properties (extracts win on a name collision).
+
+    Extracted properties are computed lazily: each is evaluated the first
+    time an expression reads it, and kept for the rest of the record. So
+    an extract read only by fields whose EXPORT WHEN fails is never
+    computed at all. An extract with no value reads as
+    `expressions.marcout_null`, which renders as the string 'None'.
+    If the record is row `row` of a chunk with ExtractColumns `columns`,
+    extracts are read from those columns.
+
+    `functions` is the engine's function table (see `engine_functions`),
+    by default `builtin_functions`.
+    '''
+
+    def __init__(self, record, extractors, collection_info, compiled_exprs=None,
+            verbose=False, functions=None, columns=None, row=None):
+        dict.__init__(self)
+        for name in collection_info:
+            if name not in extractors:
+                self[name] = collection_info[name]
+        self.extractors = extractors
+        self.compiled_exprs = compiled_exprs
+        self.verbose = verbose
+        self.functions = functions or builtin_functions
+        self.columns = columns
+        self.row = row
+        # extractors are evaluated with only the JSON record in scope
+        self.record_namespace = {'album_json': record}
+
+    def __missing__(self, name):
+        if not name or name not in self.extractors:
+            raise KeyError(name)
+
+        if self.columns is not None:
+            value = self.columns[name][self.row]
+        else:
+            extractor = self.extractors[name]
+            if self.verbose:
+                indent = ' ' * 2
+                print(indent + 'resolving `' + name + ': ' + str(extractor))
+
+            value = compute_extract(extractor, self.record_namespace, self.compiled_exprs,
+                self.verbose)
+
+        if self.verbose:
+            indent = ' ' * 2
+            print(indent + 'adding `' + str(value) + '` to record namespace')
+        if value is None:
+            value = expressions.marcout_null
+        self[name] = value
+        return value
 
 
-def evaluate_foreach(foreach_def_block, current_rec_extracts, collection_info):
+def collection_info_hash(collection_info):
+    '''Returns a hex digest identifying the content of `collection_info`.'''
+    content = json.dumps(collection_info, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def specialize_engine(marcout_engine, collection_info):
+    '''Returns a copy of `marcout_engine` whose compiled template expressions
+    have the collection parameters in `collection_info` bound in, and
+    constant-folded: `collection_label + ' MUSICat'` becomes a constant,
+    and `collection_host_url + album_id` keeps only its record-dependent
+    part. The copy shares everything else with `marcout_engine`, and
+    records the `collection_hash` it was specialized for.
+    '''
+    extractors = marcout_engine['json_extracted_properties']
+
+    # as in RecordNamespace: extracts win on a name collision
+    values = {}
+    for name in collection_info:
+        if name not in extractors:
+            values[name] = collection_info[name]
+
+    # extractors are evaluated with only the JSON record in scope: leave
+    # their expressions (and defaults) alone
+    unbound = set()
+    for propname in extractors:
+        unbound.update(parser.split_default(str(extractors[propname])))
+
+    compiled_exprs = {}
+    original_exprs = marcout_engine.get('compiled_expressions') or {}
+    for expr in original_exprs:
+        node = original_exprs[expr]
+        if expr not in unbound:
+            node = expressions.bind_names(node, values)
+        compiled_exprs[expr] = node
+
+    specialized = dict(marcout_engine)
+    specialized['compiled_expressions'] = compiled_exprs
+    specialized['collection_hash'] = collection_info_hash(collection_info)
+    return specialized
+
+
+def expr_node(expr, compiled_exprs, eachitem=None):
+    '''Returns the AST of MARCout expression `expr` from `compiled_exprs`,
+    or compiled on the spot in the context of FOR EACH item `eachitem`.
+    '''
+    node = None
+    if compiled_exprs:
+        node = compiled_exprs.get(expr)
+    if node is None:
+        node = parser.compile_expr(expr, eachitem)
+    return node
+
+
+def evaluate_expr(expr, compiled_exprs, namespace, eachitem=None):
+    '''Evaluates MARCout expression `expr` in `namespace`, using its AST
+    from `compiled_exprs` (the engine's 'compiled_expressions').
+    An expression missing from `compiled_exprs` is compiled on the spot,
+    in the context of FOR EACH item `eachitem`, if any.
+    Functions are looked up in the namespace's function table, if it is
+    a RecordNamespace, or in `builtin_functions`.
+    '''
+    node = expr_node(expr, compiled_exprs, eachitem)
+    functions = getattr(namespace, 'functions', builtin_functions)
+    return expressions.evaluate(node, namespace, functions)
+
+
+def evaluate_foreach(foreach_def_block, namespace, compiled_exprs=None):
     '''This function analyzes, sorts, and computes MARC subfield content 
     that is defined in a MARCout FOREACH block.
-    It returns each subfield's content, properly rendered, with declared 
-    demarcators(prefix, suffix) in a List,
-    ordered according to the SORTBY property of the foreach block.
+    It returns a list of marcout_fields.ForeachGroup, one per item: each
+    holds the item's subfields, properly rendered, with the declared
+    demarcators (prefix, suffix). Groups are ordered according to the
+    SORTBY property of the foreach block.
     '''
     retval = []
 
     if debug_output:
-        print('CURRENT REC EXTRACTS:')
-        print(current_rec_extracts)
-        print()
         print('FOREACH DEF BLOCK:')
         print(foreach_def_block)
         print()
 
     # local variables for notational simplicity:
     itemsource_key = foreach_def_block['itemsource']
-    itemsource = current_rec_extracts[itemsource_key]
+    itemsource = namespace[itemsource_key]
     eachitem_name = foreach_def_block['eachitem']
-    eachitem_expr = eachitem_name + '::'
 
     # DEMARCATORS
-    # if you do not eval() a string literal expression, it will
-    # retain any accumulated enclosing quotes.
-    #demarc = eval(demarc)
+    # demarcators are string literal expressions: evaluate them, or they
+    # retain their enclosing quotes.
     prefix = None
     if 'prefix' in foreach_def_block:
         prefix = foreach_def_block['prefix']
         if prefix:
-            prefix = eval(prefix)
+            prefix = evaluate_expr(prefix, compiled_exprs, namespace)
     suffix = None
     if 'suffix' in foreach_def_block:
         suffix = foreach_def_block['suffix']
         if suffix:
-            suffix = eval(suffix)
+            suffix = evaluate_expr(suffix, compiled_exprs, namespace)
     # deprecated! Will treat as 'suffix'
     demarc = None
     if 'demarcator' in foreach_def_block:
         demarc = foreach_def_block['demarcator']
         if demarc:
-            demarc = eval(demarc)
+            demarc = evaluate_expr(demarc, compiled_exprs, namespace)
 
     # NOTES ABOUT SORTING:
 
@@ -426,163 +649,175 @@ def evaluate_foreach(foreach_def_block, current_rec_extracts, collection_info):
     # does not touch the subfield ordering WITHIN a group. The internal 
     # subfield ordering is established in the MARCout declaration.
 
-    # 2) The sort key is evaluated by evaluating the group-level SORT BY
-    # in the MARCout declaration.
-
-    sortkeys = foreach_def_block['sortby']
-    # TODO: deal with sortby for cascade if more than one sort key in this list
-    sortkey = sortkeys[0].lstrip(eachitem_expr)
-    subfield_defs = foreach_def_block['subfields']
-
-    # sort the list being iterated
-    # TODO: make a better sort function for cascading sort
-    itemsource.sort(key=lambda x: x[sortkey])
-
-    # append rendered and demarcated subfields to retval
-    for eachitem in itemsource:
-
-        rendered_subfields = []
-
-        # this respects subfield definition order
-        for subfield_def in subfield_defs:
-
-            # a subfield_def is a dict of form 
-            # {subfield_code: evaluable expression}
-            for subcode in subfield_def.keys():
-                if subcode.startswith('group_'):
-                    # this doesn't get processed here. It's group level.
-                    pass
-
-                # now with genuine subfields...
-                subfield_expr = subfield_def[subcode]
-
-                # print('  ' + subcode + ': ' + subfield_expr)
-
-                subfield_expr = rewrite_for_context(subfield_expr, eachitem_expr, 'eachitem')
-                # print('  ' + subcode + ': ' + subfield_expr)
-                # print('  ' + subcode + ': ' + eval(subfield_expr))
-                eval_expr = eval(subfield_expr)
-                rendered_subfields.append({subcode: eval_expr})
-
-        # demarcators applied at group level in rendered_subfields
-        if prefix:
-            rendered_subfields.insert(0, {'group_prefix': prefix})
-        if suffix:
-            rendered_subfields.append({'group_suffix': suffix})
-        if demarc:
-            rendered_subfields.append({'group_demarc': demarc})
-
-        retval.append(rendered_subfields)
-
+    # 2) The sort key of an item is the tuple of its values of the SORT BY
+    # expressions of the block, in declaration order: items equal on the
+    # first are ordered by the second, and so on. Items equal on all keep
+    # their order in the itemsource, which is not itself reordered.
+
+    functions = getattr(namespace, 'functions', builtin_functions)
+    evaluate = expressions.evaluate
+    sort_nodes = [expr_node(sortby, compiled_exprs, eachitem_name)
+        for sortby in foreach_def_block['sortby']]
+
+    # (subfield code, AST) of each subfield, in subfield definition order
+    subfield_nodes = []
+    for subfield_def in foreach_def_block['subfields']:
+        # a subfield_def is a dict of form 
+        # {subfield_code: evaluable expression}
+        for subcode in subfield_def.keys():
+            subfield_nodes.append((subcode, expr_node(subfield_def[subcode],
+                compiled_exprs, eachitem_name)))
+
+    def sort_key(eachitem):
+        namespace[expressions.item_key] = eachitem
+        return tuple(evaluate(node, namespace, functions) for node in sort_nodes)
+
+    # append rendered subfields, in groups with their demarcators, to retval
+    Subfield = fields.Subfield
+    for eachitem in sorted(itemsource, key=sort_key):
+
+        # FOR EACH subfield expressions were compiled in their item context
+        namespace[expressions.item_key] = eachitem
+        rendered_subfields = [Subfield(subcode, evaluate(node, namespace, functions))
+            for subcode, node in subfield_nodes]
+
+        # (empty demarcators are absent)
+        retval.append(fields.ForeachGroup(rendered_subfields, prefix, suffix, demarc))
+
+    namespace.pop(expressions.item_key, None)
     return retval
 
 
-def compute_expr(expr, current_rec_extracts, collection_info):
-    retval = expr
-
-    # this is a parse 
-    tokens = parser.tokenize(expr)
-    for indx, token in enumerate(tokens):
-        if debug_output:
-            print('TOKEN: ' + token)
-        if token[0] in parser.opaques:
-            # this is a string literal. Don't mess with it.
-            continue
-
-        # For code expressions:
-
-        # record-specific values
-        # replace reference to extract name with actual value extracted from JSON.
-        # ensure that the result is quotes as a literal.
-        for extract in current_rec_extracts:
-            if extract in token:
-                if debug_output:
-                    print('EXTRACT: ' + str(extract))
-
-                extractval = current_rec_extracts[extract]
-
-                if debug_output:
-                    print('EXTRACTVAL: ' + str(extractval))
-                    print('IS STR: ' + str(isinstance(extractval, str)))
-                if isinstance(extractval, str):
-                    # direct substitution WITH enclosing "" so it evals as a
-                    # string literal on the way out of this function
-                    token = token.replace(extract, '"' + extractval + '"')
-                else:
-                    token = token.replace(extract, str(extractval))
-                if debug_output:
-                    print('TOKEN: ' + token)
-
-        # collection-specific parametric values
-        for param in collection_info.keys():
-            if param in token:
-                if debug_output:
-                    print('PARAM: ' + param)
-                paramval = collection_info[param]
-                if isinstance(paramval, str):
-                    # direct substitution WITH enclosing "" so it evals as a
-                    # string literal on the way out of this function
-                    token = token.replace(param, '"' + paramval + '"')
-                else:
-                    token = token.replace(extract, str(extractval))
-                if debug_output:
-                    print('TOKEN: ' + token)
+def compute_expr(expr, namespace, compiled_exprs=None, failures=None):
+    '''Evaluates MARCout expression `expr` for the current record, whose
+    RecordNamespace is `namespace`. Names in the expression resolve to the
+    record's extracted values, then to collection parameters; function
+    names to the MARCout builtins in this module.
+    An expression that cannot be evaluated for this record yields ''.
+    If `failures` is a list, the (expression, exception) of such an
+    expression is appended to it.
+    '''
+    retval = ''
 
-        # whatever modifications have been made to token, update the tokens list
+    if not expr.strip():
+        return retval
 
-        if str(token) == 'None':
-            token = '"' + str(token) + '"'
+    # this evaluation applies functions, concats, etc
+    try:
+        if debug_output:
+            print('EVALUATING "' + expr + '"')
+        retval = evaluate_expr(expr, compiled_exprs, namespace)
+        if debug_output:
+            print('EVALUATED TO: ' + str(retval))
+    except Exception as ex:
+        if failures is not None:
+            failures.append((expr, ex))
+        if debug_output:
+            print('DIED ON ' + expr)
+            print(ex)
+        retval = ''
 
-        tokens[indx] = str(token)
+    return retval
 
-    # concat tokens into content
-    evaluable = ''.join(tokens)
 
-    retval = ''
-
-    # this second-stage eval applies functions, concats, etc
-    if evaluable:
+def failed_expression(template, namespace, compiled_exprs=None):
+    '''After exporting `template` for the record of `namespace` has raised,
+    returns the expression that raised: a demarcator, or a SORT BY or
+    subfield expression of the item being exported when it raised, or
+    otherwise the FOR EACH itemsource (which may have a value that cannot
+    be iterated or sorted). Returns None for a template with no FOR EACH.
+    '''
+    if 'foreach' not in template:
+        return None
+    foreach = template['foreach']
+    try:
+        namespace[foreach['itemsource']]
+    except Exception:
+        return foreach['itemsource']
+
+    exprs = [foreach[propname] for propname in ('prefix', 'suffix', 'demarcator')
+        if foreach.get(propname)]
+    if expressions.item_key in namespace:
+        exprs += foreach.get('sortby', [])
+        for subfield_def in foreach.get('subfields', []):
+            exprs += subfield_def.values()
+    for expr in exprs:
         try:
-            if debug_output:
-                print('EVALUATING "' + evaluable + '"')
-            retval = eval(evaluable)
-            if debug_output:
-                print('EVALUATED TO: ' + str(retval))
-        except Exception as ex:
-            if verbose:
-                print('tokens: ')
-                print(tokens)
-                print('DIED ON ' + evaluable)
+            evaluate_expr(expr, compiled_exprs, namespace, foreach['eachitem'])
+        except Exception:
+            return expr
+    return foreach['itemsource']
 
-    return retval
 
+def record_album_id(record):
+    '''Returns the album id of JSON record `record`, or None if it has none.'''
+    try:
+        return record['album']['id']
+    except Exception:
+        return None
 
-def export_marc_field(template, current_rec_extracts, collection_info):
-    '''This function returns a copy of the template, with record-specific
-    values computed in place of the various expressions.
+
+def record_error(recordno, record, stage, ex, tag=None, expr=None):
+    '''Returns the error entry of a record that could not be exported or
+    serialized: a dict of its 'record_index' in the batch, its 'album_id'
+    (None if it has none), the 'stage' that failed ('export' or
+    'serialize'), the 'tag' of the field template and the 'expression'
+    being evaluated (None if not known), and the 'exception' type and its
+    'message'.
     '''
+    return {'record_index': recordno,
+        'album_id': record_album_id(record),
+        'stage': stage,
+        'tag': tag,
+        'expression': expr,
+        'exception': type(ex).__name__,
+        'message': str(ex),
+    }
 
-    # redundant use of deepcopy: belt, suspenders, 2 condoms & a bike helmet.
-    retval = copy.deepcopy(template)
 
-    for propname in retval:
+def export_marc_field(template, namespace, compiled_exprs=None, failures=None,
+        timings=None):
+    '''This function returns a new exported field for the template, with
+    record-specific values computed in place of the various expressions.
+    The template itself is never modified: engines are shared between
+    records (and, through the engine cache, between requests), so the
+    exported field is built fresh, and its fixed values are shared with
+    the template rather than copied.
+    The field is a marcout_fields.MarcField, whose properties are the
+    template's (the template is its `keys`).
+    If `failures` is a list, the (expression, exception) of each expression
+    that could not be evaluated is appended to it (see `compute_expr`).
+    If `timings` is a dict (a template's entry in an export profile), the
+    time taken by the FOR EACH block, and the groups it exported, are
+    added to its 'foreach_seconds' and 'foreach_groups'.
+    '''
+    span = None
+    if tracing.hooks:
+        span = tracing.start_span('marcout.export_field', {'tag': template['tag']})
 
-        if propname in ('tag', 'indicator_1', 'indicator_2', 'fixed'):
+    # 'tag', 'indicator_1', 'indicator_2', 'fixed', 'terminator': fixed,
+    # not computed. Immutable strings, so shared as is.
+    retval = fields.MarcField(template, template['tag'], template.get('indicator_1'),
+        template.get('indicator_2'), template.get('fixed'),
+        terminator=template.get('terminator'))
 
-            # do not evaluate. These are fixed, not computed.
-            continue
+    # computed in the template's order
+    for propname in template:
 
-        elif propname in ('content',):
-            retval[propname] = compute_expr(retval[propname], current_rec_extracts, collection_info)
+        if propname in ('content', 'export_if', 'export_if_not'):
+            setattr(retval, propname, compute_expr(template[propname], namespace,
+                compiled_exprs, failures))
 
         elif propname == 'subfields':
             # "subfields" is a list to preserve order in which subfields
             # are defined. Each list item is a dict. Each dict is of the form
             # {subfield_code: expr} and has len() == 1
-            for subfield_dict in retval[propname]:
+            subfields = []
+            for subfield_dict in template[propname]:
                 for subfield_code in subfield_dict:
-
-                    subfield_dict[subfield_code] = compute_expr(subfield_dict[subfield_code], current_rec_extracts, collection_info)
+                    subfields.append(fields.Subfield(subfield_code, compute_expr(
+                        subfield_dict[subfield_code], namespace, compiled_exprs, failures)))
+            retval.subfields = subfields
 
         elif propname == 'foreach':
             # this is a dict. Keys are 
@@ -591,25 +826,144 @@ def export_marc_field(template, current_rec_extracts, collection_info):
             # 'sortby': array of exprs, e.g. ['track::position'], 
             # 'subfields': array of subfield dicts, e.g. [{'t': 'track::title'}, {'g': 'render_duration(track::duration)'}],
             # 'eachitem': name assigned for notation. e.g. 'track', 
-            retval[propname] = evaluate_foreach(retval[propname], current_rec_extracts, collection_info)
-
-        elif propname in('export_if', 'export_if_not'):
-            # conditional
-            retval[propname] = compute_expr(retval[propname], current_rec_extracts, collection_info)
-
+            if timings is None:
+                retval.foreach = evaluate_foreach(template[propname], namespace,
+                    compiled_exprs)
+            else:
+                started = time.perf_counter()
+                retval.foreach = evaluate_foreach(template[propname], namespace,
+                    compiled_exprs)
+                timings['foreach_seconds'] += time.perf_counter() - started
+                timings['foreach_groups'] += len(retval.foreach)
+
+    if span is not None:
+        tracing.end_span(span)
     return retval
 
 
-def export_records_per_marcdef(export_workset, verbose):
-    '''The parameter is an Export Workset. This is a dict containing all
-    necessary information to export the records it contains:
-    {
-        'marcout_engine': marcout_engine parsed from MARCout export definition document
-        'serialization': sz_name : valid serialization name from unified JSON 
-        'collection_info': collection info from unified JSON 
-        'records_to_export': expected JSON representation of records
-    }
-    RETURNS a List of exported records
+def export_template(template, namespace, compiled_exprs=None, failures=None, timings=None):
+    '''Returns the field exported for `template` for the record of
+    `namespace` (see `export_marc_field`), or None if the template's
+    EXPORT WHEN / EXPORT UNLESS conditions exclude it.
+    '''
+    # observe export conditionals
+    if 'export_if' in template:
+        evaluated_conditional = compute_expr(template['export_if'], namespace,
+            compiled_exprs, failures)
+        if not evaluated_conditional:
+            # fail: this template does not get filled and
+            # placed in the return
+            return None
+
+    if 'export_if_not' in template:
+        evaluated_conditional = compute_expr(template['export_if_not'], namespace,
+            compiled_exprs, failures)
+        if evaluated_conditional:
+            # fail: the True condition prevents this template from 
+            # being filled and placed in the return
+            return None
+
+    return export_marc_field(template, namespace, compiled_exprs, failures, timings)
+
+
+def new_profile(marcout_engine):
+    '''Returns a new, empty, export profile for `marcout_engine`: a dict of
+        - 'records': the number of records processed (exported or
+            skipped; see `iter_export_records_per_marcdef`).
+        - 'templates': per field template, in order, a dict of 'tag',
+            'calls' (records for which the template was considered),
+            'seconds' and 'max_seconds' (total and longest time for one
+            record, not counting extractors: see 'extractors'),
+            'conditional' (calls that evaluated EXPORT WHEN / UNLESS
+            conditions) and 'passed' (of those, the calls whose conditions
+            let the field be exported), 'failed_expressions' (expressions
+            that could not be evaluated, and exported as ''), 'exceptions'
+            (calls that raised), and 'foreach_seconds' and
+            'foreach_groups' (time taken by the FOR EACH block, including
+            any extractor column it was first to read, and the groups it
+            exported).
+        - 'extractors': per JSON extracted property, a dict of 'calls'
+            (records it was computed for), 'chunks' (columns computed, see
+            `ExtractColumns`), 'seconds' and 'max_seconds' (total, and
+            longest for one column), and 'defaulted' (records that fell
+            back to its `::DEFAULT`).
+        - 'extract_seconds': the total time of all extractors.
+    '''
+    templates = []
+    for template in marcout_engine['marc_field_templates']:
+        templates.append({'tag': template['tag'], 'calls': 0, 'seconds': 0.0,
+            'max_seconds': 0.0, 'conditional': 0, 'passed': 0, 'failed_expressions': 0,
+            'exceptions': 0, 'foreach_seconds': 0.0, 'foreach_groups': 0})
+    extractors = {}
+    for name in marcout_engine['json_extracted_properties']:
+        if name:
+            extractors[name] = {'calls': 0, 'chunks': 0, 'seconds': 0.0,
+                'max_seconds': 0.0, 'defaulted': 0}
+    return {'records': 0, 'templates': templates, 'extractors': extractors,
+        'extract_seconds': 0.0}
+
+
+def profile_extract_column(profile, name, extractor, records, compiled_exprs=None,
+        path=None):
+    '''`compute_extract_column`, profiled in the entry of extractor `name`
+    of export profile `profile`.
+    '''
+    entry = profile['extractors'][name]
+    failures = []
+    started = time.perf_counter()
+    column = compute_extract_column(extractor, records, compiled_exprs, path, failures)
+    elapsed = time.perf_counter() - started
+    entry['calls'] += len(records)
+    entry['chunks'] += 1
+    entry['seconds'] += elapsed
+    entry['max_seconds'] = max(entry['max_seconds'], elapsed)
+    entry['defaulted'] += len(failures)
+    profile['extract_seconds'] += elapsed
+    return column
+
+
+def profile_template(profile, indx, template, namespace, compiled_exprs=None):
+    '''`export_template`, profiled in the entry of template `indx` of
+    export profile `profile`. Time spent computing extractor columns is
+    left to the extractors' entries.
+    '''
+    entry = profile['templates'][indx]
+    conditional = 'export_if' in template or 'export_if_not' in template
+    failures = []
+    extract_seconds = profile['extract_seconds']
+    started = time.perf_counter()
+    try:
+        exported_field = export_template(template, namespace, compiled_exprs, failures,
+            entry)
+    except Exception:
+        entry['exceptions'] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        elapsed -= profile['extract_seconds'] - extract_seconds
+        entry['calls'] += 1
+        entry['seconds'] += elapsed
+        entry['max_seconds'] = max(entry['max_seconds'], elapsed)
+        entry['failed_expressions'] += len(failures)
+    if conditional:
+        entry['conditional'] += 1
+        if exported_field is not None:
+            entry['passed'] += 1
+    return exported_field
+
+
+def iter_export_records_per_marcdef(export_workset, verbose=False, errors=None,
+        profile=None):
+    '''Generator form of `export_records_per_marcdef`: yields each exported
+    record as soon as it is exported. 'records_to_export' in the workset
+    may be any iterable of records, including a generator, so a batch of
+    any size is exported in bounded memory.
+    If `errors` is a list, a record that cannot be exported does not
+    abort the batch: its `record_error` entry is appended to `errors`,
+    and None is yielded in its place.
+    If `profile` is an export profile (see `new_profile`), the export of
+    every template and the computation of every extractor is profiled in
+    it.
     '''
 
     if verbose:
@@ -620,107 +974,87 @@ def export_records_per_marcdef(export_workset, verbose):
         print('=============================================')
         print()
 
-
-    # return value
-    exported_marc_records = []
-
     # convenience variable
     engine_json_extractors = export_workset['marcout_engine']['json_extracted_properties']
     engine_field_templates = export_workset['marcout_engine']['marc_field_templates']
+    compiled_exprs = export_workset['marcout_engine'].get('compiled_expressions')
+    dependencies = export_workset['marcout_engine'].get('dependencies')
+    functions = engine_functions(export_workset['marcout_engine'].get('pure_functions', ()))
     collection_info = export_workset['collection_info']
 
-    for record in export_workset['records_to_export']:
-
-        # expected name, per MARCout convention
-        album_json = record
-
-        # Extract content of JSON record into locally scoped variables.
-        # This reconstructs the assignment form in the original 
-        # MARCout syntax.
-        # These variables will then be referenceable in the
-        # MARC field template expressions.
-
-        # a convenient parametric form for passing around extracted values.
-        current_rec_extracts = {}
-
-        # Execute these extraction statements in context of the record.
-        # Stash values in current_rec_extracts.
-        for key in engine_json_extractors:
-            # coerce to strings
-            varname = str(key)
-            varval_expr = str(engine_json_extractors[key])
-
-            if verbose:
-                indent = ' ' * 2
-                print(indent + 'resolving `' + varname + ': ' + varval_expr)
-
-            # apply any defaults left embedded by parser
-            default = ''
-            if '::DEFAULT' in varval_expr:
-                varval_expr, default = varval_expr.split('::DEFAULT')
-                varval_expr = varval_expr.rstrip()
-                default = default.strip()
-
-            try:
-                varval = eval(varval_expr)
-            except Exception as e:
-                if verbose:
-                    indent = ' ' * 4
-                    print(indent + 'ATTEMPTING TO RESOLVE `' + varval_expr + '`')
-                    print(indent + 'EVAL EXCEPTION of type "' + str(type(e)) + '":')
-                    print(e)
-                    print(indent + indent + 'APPLYING DEFAULT `' + default + '`')
-                    print()
-                varval = default
-
-            # add evaluation of varval to current_rec_extracts
-            if verbose:
-                indent = ' ' * 2
-                print(indent + 'adding `' + str(varval) + '` to current_rec_extracts')
-            current_rec_extracts[varname] = varval
-
-
-        # TODO ensure named functions are also in scope.
-        
-
-        # Populate MARC field data structures by copying templates and
+    # records are taken a chunk at a time, so that each JSON extracted
+    # property is computed for the whole chunk in one loop
+    rows = iter_record_rows(export_workset['records_to_export'],
+        engine_json_extractors, compiled_exprs, verbose,
+        paths=export_workset['marcout_engine'].get('extractor_paths'), profile=profile)
+    for recordno, (record, columns, row) in enumerate(rows):
+
+        # The JSON extracted properties are the locally scoped variables
+        # of the original MARCout syntax, referenceable in the MARC field
+        # template expressions. Each is extracted (for the record's whole
+        # chunk) only when a template expression first reads it.
+        namespace = RecordNamespace(record, engine_json_extractors, collection_info,
+            compiled_exprs, verbose, functions, columns, row)
+
+        # Populate MARC field data structures from the templates, by
         # evaluating from the JSON content
         # and the application of the MARCout functions.
 
+        record_span = None
+        if tracing.hooks:
+            record_span = tracing.start_span('marcout.export_record',
+                {'record_index': recordno, 'album_id': record_album_id(record)})
+
         record_output = []
-        # need to use copy.deepcopy to avoid modifying templates: otherwise 
-        # content would be propagated forward into a subsequent record, which
-        # would blow things up: eval() on *values*, rather than parsed MARCout
-        # expressions, would generally not work. (And in cases where it DID 
-        # work, that would be even worse, creating corrupt records.)
-        for template in copy.deepcopy(engine_field_templates):
-
-            # observe export conditionals
-            if 'export_if' in template:
-                evaluated_conditional = compute_expr(template['export_if'], current_rec_extracts, collection_info)
-                if not evaluated_conditional:
-                    # fail: this template does not get filled and
-                    # placed in the return
-                    continue
-
-            if 'export_if_not' in template:
-                evaluated_conditional = compute_expr(template['export_if_not'], current_rec_extracts, collection_info)
-                # print('evaluates to: ' + str(evaluated_conditional))
-                if evaluated_conditional:
-                    # fail: the True condition prevents this template from 
-                    # being filled and placed in the return
-                    continue
-
-            exported_field = export_marc_field(template, current_rec_extracts, collection_info)
+        # templates are read, never modified (see export_marc_field), so
+        # every record is exported from the engine's own templates.
+        for indx, template in enumerate(engine_field_templates):
+            try:
+                if profile is None:
+                    exported_field = export_template(template, namespace, compiled_exprs)
+                else:
+                    exported_field = profile_template(profile, indx, template, namespace,
+                        compiled_exprs)
+            except Exception as ex:
+                if errors is None:
+                    raise
+                # skip the record, and go on with the next
+                errors.append(record_error(recordno, record, 'export', ex,
+                    template['tag'], failed_expression(template, namespace, compiled_exprs)))
+                record_output = None
+                break
+            if exported_field is None:
+                # the template's export conditions exclude the field
+                continue
             if verbose:
                 indent = ' ' * 2
                 print(indent + 'EXPORTING ' + template['tag'])
+                if dependencies:
+                    print(indent + indent + 'using extracts: '
+                        + ', '.join(dependencies[indx]['content']['extracts']))
 
             record_output.append(exported_field)
 
-        # put all of the fields for this record in the return val
-        exported_marc_records.append(record_output)
+        if profile is not None:
+            profile['records'] += 1
+        if record_span is not None:
+            tracing.end_span(record_span, {'skipped': record_output is None})
+        yield record_output
+
+
+def export_records_per_marcdef(export_workset, verbose):
+    '''The parameter is an Export Workset. This is a dict containing all
+    necessary information to export the records it contains:
+    {
+        'marcout_engine': marcout_engine parsed from MARCout export definition document
+        'serialization': sz_name : valid serialization name from unified JSON 
+        'collection_info': collection info from unified JSON 
+        'records_to_export': expected JSON representation of records
+    }
+    RETURNS a List of exported records
+    '''
 
+    exported_marc_records = list(iter_export_records_per_marcdef(export_workset, verbose))
 
     if verbose:
         print()
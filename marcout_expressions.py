@@ -0,0 +1,657 @@
+#!/usr/bin/python3
+
+# This module defines the MARCout expression language: a grammar that parses
+# MARCout expressions into an abstract syntax tree (AST), constant-folds
+# the AST at compile time, and a small interpreter that evaluates it for
+# each exported record. Nothing here ever calls `eval`: record data is
+# only ever data.
+#
+# GRAMMAR (see marcout-syntax.md for the keywords' meanings):
+#
+#   expression := concat [ IS TRUE | IS FALSE | HAS VALUE | HAS NO VALUE ]
+#               | concat ( IS | IS NOT | STARTS WITH | CONTAINS ) concat
+#   concat     := postfix ( '+' postfix )*
+#   postfix    := primary ( '[' expression ']' )*
+#   primary    := 'string literal' | number | NOTHING
+#               | '[' [ expression ( ',' expression )* ] ']'
+#               | item::property            (FOR EACH subfields only)
+#               | name                      (extract or collection parameter)
+#               | name '(' [ expression ( ',' expression )* ] ')'
+#               | '(' expression ')'
+#
+# `==` and `!=` are accepted as synonyms for IS and IS NOT.
+#
+# AST NODES are tuples, so that compiled MARCout Engines remain plain data
+# (they can be marshalled into engine artifacts):
+#
+#   ('const', value)
+#   ('name', name)
+#   ('item', (property, ...))       the current FOR EACH item's property
+#   ('index', node, key_node)
+#   ('call', funcname, (arg_node, ...))
+#   ('concat', (node, ...))
+#   ('list', (node, ...))           a new list for each evaluation
+#   ('eq', node, node)
+#   ('ne', node, node)
+#   ('shared', slot, node)          a subexpression common to several template
+#                                   expressions: evaluated once per record
+#
+# The MARCout keyword operators are compiled to calls of the keyword
+# functions defined below (`keyword_functions`).
+
+import re
+
+
+# =============================================================================
+#
+# ================== MARCout KEYWORD FUNCTIONS ================================
+
+
+class MarcoutNull(str):
+    '''The value of an extracted property whose JSON value is null. It
+    renders, and concatenates, as the text 'None' (as MARCout exports
+    always have), but it is never `TRUE` or `FALSE`, and it has no value.
+    '''
+    __slots__ = ()
+
+
+marcout_null = MarcoutNull('None')
+
+
+# - `IS TRUE`: postfix operator that resolves to True if the preceding
+#     expression is a MARCout distinguished value for `TRUE`.
+def marcout_is_true(value):
+
+    # boolean is ok
+    if isinstance(value, bool):
+        return value
+
+    # test for numeric 1 as distinguished value for `TRUE`
+    elif isinstance(value, int):
+        return value == 1
+
+    elif isinstance(value, str) and not isinstance(value, MarcoutNull):
+        return value.lower() in ('true', 'yes')
+
+    return False
+
+
+# - `IS FALSE`: postfix operator that resolves to True if the preceding
+#     expression is a MARCout distinguished value for `FALSE`
+def marcout_is_false(value):
+
+    # boolean is ok
+    if isinstance(value, bool):
+        # reverse the sense
+        return not value
+
+    # test for numeric 0 as distinguished value for `FALSE`
+    elif isinstance(value, int):
+        return value == 0
+
+    elif isinstance(value, str) and not isinstance(value, MarcoutNull):
+        return value.lower() in ('false', 'no')
+
+    return False
+
+
+# - `HAS VALUE`: postfix operator that resolves to True if the preceding
+#     expression is PRESENT and not `EMPTY`. In other words, the expression
+#     has meaning over and above the ambiguous empty values.
+def marcout_has_value(value):
+
+    if value is None or isinstance(value, MarcoutNull):
+        return False
+
+    if isinstance(value, str):
+        # False if `EMPTY`: whitespace or empty string
+        return len(value.strip()) > 0
+
+    elif isinstance(value, (list, tuple, dict, set)):
+        # False if `value` is a data structure with no content
+        return len(value) > 0
+
+    # other types do not have defined `EMPTY` values
+    return True
+
+
+# - `HAS NO VALUE`: postfix operator that resolves to True if the preceding
+#     expression is not `PRESENT`, or, if `PRESENT`, is `EMPTY`.
+#     (An expression that is not `PRESENT` fails to evaluate at all.)
+def marcout_has_no_value(value):
+    return not marcout_has_value(value)
+
+
+# - `NOTHING`: keyword for an empty value. Depending on context, equivalent
+#     to an empty string, or to a non-value such as Python `None` or
+#     JSON `null`. In expressions, it is the empty string.
+def marcout_nothing_value(type=str):
+    if type is str:
+        return ''
+    else:
+        return None
+
+
+# - `STARTS WITH`: operator for string values. Resolves to True if the
+#     preceding string starts with the subsequent string.
+def marcout_startswith(tested_expr, start_expr):
+    return tested_expr.startswith(start_expr)
+
+
+# - `CONTAINS`: operator for string values. Resolves to True if the
+#     subsequent string is found within the preceding string.
+def marcout_contains(tested_expr, search_expr):
+    return (search_expr in tested_expr)
+
+
+# - `+`: the concatenation operator for string values. Does NOT represent
+#     numeric addition. Compiled to a 'concat' node.
+
+
+# =============================================================================
+#
+# ================== CONSTANTS ================================================
+
+# functions implicitly called when the parser finds a keyword. They are
+# pure, so calls with constant arguments are folded at compile time.
+keyword_functions = {
+    'marcout_is_true': marcout_is_true,
+    'marcout_is_false': marcout_is_false,
+    'marcout_has_value': marcout_has_value,
+    'marcout_has_no_value': marcout_has_no_value,
+    'marcout_startswith': marcout_startswith,
+    'marcout_contains': marcout_contains,
+}
+
+postfix_keywords = {
+    'IS TRUE': 'marcout_is_true',
+    'IS FALSE': 'marcout_is_false',
+    'HAS VALUE': 'marcout_has_value',
+    'HAS NO VALUE': 'marcout_has_no_value',
+}
+
+infix_keywords = {
+    'IS': 'eq',
+    '==': 'eq',
+    'IS NOT': 'ne',
+    '!=': 'ne',
+    'STARTS WITH': 'marcout_startswith',
+    'CONTAINS': 'marcout_contains',
+}
+
+# names that are constants rather than extracts or parameters
+constant_names = {'True': True, 'False': False, 'None': None}
+
+# the namespace key under which the current FOR EACH item is evaluated.
+# It is not a valid name, so no extract or parameter can collide with it.
+item_key = '::item'
+
+# the namespace key under which a record's values of its engine's shared
+# subexpressions are kept, by slot
+shared_key = '::shared'
+
+# names such as `__class__` are reserved: they name Python internals, never
+# extracts, parameters, functions, or item properties
+dunder_pattern = re.compile(r'(?:^|::)__\w*__(?:$|::)')
+
+token_pattern = re.compile(r'''
+    (?P<string>"[^"]*"|'[^']*')
+  | (?P<number>\d+(?:\.\d+)?)
+  | (?P<keyword>\b(?:HAS\s+NO\s+VALUE|HAS\s+VALUE|STARTS\s+WITH
+        |IS\s+NOT|IS\s+TRUE|IS\s+FALSE|IS|CONTAINS|NOTHING)\b)
+  | (?P<item>[A-Za-z_]\w*(?:::[A-Za-z_]\w*)+)
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<op>==|!=|[+(),\[\]])
+  | (?P<space>\s+)
+  | (?P<error>.)
+''', re.VERBOSE)
+
+
+
+# =============================================================================
+#
+# ================== PARSE FUNCTIONS ==========================================
+
+
+def lex(expr):
+    '''Returns the tokens of MARCout expression `expr` as a list of
+    (kind, text, column) tuples, ending with ('end', '', len(expr)).
+    '''
+    tokens = []
+    for match in token_pattern.finditer(expr):
+        kind = match.lastgroup
+        text = match.group()
+        if kind == 'space':
+            continue
+        if kind == 'error':
+            raise ValueError('unexpected character `' + text + '` at column '
+                + str(match.start() + 1))
+        if kind == 'keyword':
+            # normalize whitespace within keyword phrases
+            text = ' '.join(text.split())
+        tokens.append((kind, text, match.start()))
+    tokens.append(('end', '', len(expr)))
+    return tokens
+
+
+def parse_error(token, message):
+    if token[0] == 'end':
+        return ValueError(message + ' at end of expression')
+    return ValueError(message + ' at column ' + str(token[2] + 1)
+        + ' (`' + token[1] + '`)')
+
+
+def parse_expression(tokens, pos, eachitem):
+    '''Parses `expression` from tokens[pos]; returns (node, next pos).'''
+    node, pos = parse_concat(tokens, pos, eachitem)
+    token = tokens[pos]
+
+    if token[1] in postfix_keywords and token[0] == 'keyword':
+        return ('call', postfix_keywords[token[1]], (node,)), pos + 1
+
+    if token[1] in infix_keywords and token[0] in ('keyword', 'op'):
+        right, pos = parse_concat(tokens, pos + 1, eachitem)
+        operation = infix_keywords[token[1]]
+        if operation in ('eq', 'ne'):
+            return (operation, node, right), pos
+        return ('call', operation, (node, right)), pos
+
+    return node, pos
+
+
+def parse_concat(tokens, pos, eachitem):
+    '''Parses `concat` from tokens[pos]; returns (node, next pos).'''
+    node, pos = parse_postfix(tokens, pos, eachitem)
+    parts = [node]
+    while tokens[pos][1] == '+' and tokens[pos][0] == 'op':
+        node, pos = parse_postfix(tokens, pos + 1, eachitem)
+        parts.append(node)
+    if len(parts) == 1:
+        return parts[0], pos
+    return ('concat', tuple(parts)), pos
+
+
+def parse_postfix(tokens, pos, eachitem):
+    '''Parses `postfix` from tokens[pos]; returns (node, next pos).'''
+    node, pos = parse_primary(tokens, pos, eachitem)
+    while tokens[pos][1] == '[' and tokens[pos][0] == 'op':
+        key, pos = parse_expression(tokens, pos + 1, eachitem)
+        if tokens[pos][1] != ']':
+            raise parse_error(tokens[pos], 'expected `]`')
+        node = ('index', node, key)
+        pos += 1
+    return node, pos
+
+
+def parse_primary(tokens, pos, eachitem):
+    '''Parses `primary` from tokens[pos]; returns (node, next pos).'''
+    kind, text, column = tokens[pos]
+
+    if kind == 'string':
+        return ('const', text[1:-1]), pos + 1
+
+    if kind == 'number':
+        if '.' in text:
+            return ('const', float(text)), pos + 1
+        return ('const', int(text)), pos + 1
+
+    if kind == 'keyword' and text == 'NOTHING':
+        return ('const', marcout_nothing_value(str)), pos + 1
+
+    if kind in ('item', 'name') and dunder_pattern.search(text):
+        raise parse_error(tokens[pos], 'reserved name')
+
+    if kind == 'item':
+        parts = text.split('::')
+        if parts[0] != eachitem:
+            if eachitem is None:
+                raise parse_error(tokens[pos], 'item reference outside of FOR EACH')
+            raise parse_error(tokens[pos], 'item reference is not to FOR EACH item `'
+                + eachitem + '`')
+        return ('item', tuple(parts[1:])), pos + 1
+
+    if kind == 'name':
+        if tokens[pos + 1][1] == '(':
+            # function call
+            args = []
+            pos += 2
+            if tokens[pos][1] != ')':
+                while True:
+                    arg, pos = parse_expression(tokens, pos, eachitem)
+                    args.append(arg)
+                    if tokens[pos][1] == ',':
+                        pos += 1
+                    elif tokens[pos][1] == ')':
+                        break
+                    else:
+                        raise parse_error(tokens[pos], 'expected `,` or `)`')
+            return ('call', text, tuple(args)), pos + 1
+
+        if text in constant_names:
+            return ('const', constant_names[text]), pos + 1
+        return ('name', text), pos + 1
+
+    if kind == 'op' and text == '[':
+        items = []
+        pos += 1
+        if tokens[pos][1] != ']':
+            while True:
+                item, pos = parse_expression(tokens, pos, eachitem)
+                items.append(item)
+                if tokens[pos][1] == ',':
+                    pos += 1
+                elif tokens[pos][1] == ']':
+                    break
+                else:
+                    raise parse_error(tokens[pos], 'expected `,` or `]`')
+        return ('list', tuple(items)), pos + 1
+
+    if kind == 'op' and text == '(':
+        node, pos = parse_expression(tokens, pos + 1, eachitem)
+        if tokens[pos][1] != ')':
+            raise parse_error(tokens[pos], 'expected `)`')
+        return node, pos + 1
+
+    raise parse_error(tokens[pos], 'expected a value')
+
+
+def fold_constants(node):
+    '''Returns `node` with every subtree that does not depend on the record
+    replaced by its constant value. Calls to keyword functions are folded;
+    calls to other functions are not. A constant subtree whose evaluation
+    fails is left as is, so the failure happens (as it always has) at
+    export time.
+    '''
+    kind = node[0]
+
+    if kind in ('const', 'name', 'item'):
+        return node
+
+    if kind == 'shared':
+        inner = fold_constants(node[2])
+        if inner[0] == 'const':
+            return inner
+        return ('shared', node[1], inner)
+
+    if kind == 'list':
+        # never folded: a list constant would be shared by every record
+        return ('list', tuple(fold_constants(item) for item in node[1]))
+
+    if kind == 'call':
+        args = tuple(fold_constants(arg) for arg in node[2])
+        node = ('call', node[1], args)
+        if node[1] not in keyword_functions:
+            return node
+        if not all(arg[0] == 'const' for arg in args):
+            return node
+
+    elif kind == 'concat':
+        # merge adjacent string constants: concatenation of strings is
+        # associative, so 'a' + x + 'b' + 'c' is 'a' + x + 'bc'
+        parts = []
+        for part in node[1]:
+            part = fold_constants(part)
+            if (parts and part[0] == 'const' and parts[-1][0] == 'const'
+                    and isinstance(part[1], str) and isinstance(parts[-1][1], str)):
+                parts[-1] = ('const', parts[-1][1] + part[1])
+                continue
+            parts.append(part)
+        if len(parts) == 1:
+            return parts[0]
+        node = ('concat', tuple(parts))
+        if not all(part[0] == 'const' for part in parts):
+            return node
+
+    elif kind in ('eq', 'ne', 'index'):
+        node = (kind, fold_constants(node[1]), fold_constants(node[2]))
+        if not (node[1][0] == 'const' and node[2][0] == 'const'):
+            return node
+
+    try:
+        return ('const', evaluate(node, {}, keyword_functions))
+    except Exception:
+        return node
+
+
+def compile_expr(expr, eachitem=None):
+    '''Parses MARCout expression `expr` into a constant-folded AST. If the
+    expression belongs to a FOR EACH block, `eachitem` is the name of its
+    item (`track` for `FOR EACH: track in album_tracks`), and `track::title`
+    refers to a property of the current item.
+    Raises a ValueError if `expr` is not a valid MARCout expression.
+    '''
+    try:
+        tokens = lex(expr)
+        node, pos = parse_expression(tokens, 0, eachitem)
+        if tokens[pos][0] != 'end':
+            raise parse_error(tokens[pos], 'unexpected')
+    except ValueError as e:
+        raise ValueError('Invalid MARCout expression `' + expr.strip() + '`: ' + str(e))
+    return fold_constants(node)
+
+
+def bind_names(node, values):
+    '''Returns AST `node` with every name found in dict `values` replaced
+    by its value, and constant-folded: the parts of the expression that
+    depend only on `values` are computed once, here.
+    '''
+    kind = node[0]
+
+    if kind == 'name':
+        if node[1] in values:
+            return ('const', values[node[1]])
+        return node
+
+    if kind in ('const', 'item'):
+        return node
+
+    if kind == 'shared':
+        node = ('shared', node[1], bind_names(node[2], values))
+    elif kind == 'call':
+        node = ('call', node[1], tuple(bind_names(arg, values) for arg in node[2]))
+    elif kind in ('concat', 'list'):
+        node = (kind, tuple(bind_names(part, values) for part in node[1]))
+    elif kind in ('eq', 'ne', 'index'):
+        node = (kind, bind_names(node[1], values), bind_names(node[2], values))
+
+    return fold_constants(node)
+
+
+def subscript_path(node, rootname):
+    '''If AST `node` is a plain subscript chain on name `rootname` with
+    constant keys, such as `album_json['album']['id']`, returns the keys
+    as a tuple (('album', 'id')); otherwise returns None.
+    '''
+    keys = []
+    while node[0] == 'index':
+        if node[2][0] != 'const':
+            return None
+        keys.append(node[2][1])
+        node = node[1]
+    if node != ('name', rootname) or not keys:
+        return None
+    keys.reverse()
+    return tuple(keys)
+
+
+def literal_value(expr):
+    '''Returns the value of `expr` if it is a constant MARCout expression,
+    such as a quoted string literal; otherwise returns `expr` as text.
+    '''
+    try:
+        node = compile_expr(expr)
+    except ValueError:
+        return expr
+    if node[0] == 'const':
+        return node[1]
+    return expr
+
+
+def referenced_names(node):
+    '''Returns a 2-tuple of sets: the names, and the function names, that
+    the AST `node` refers to.
+    '''
+    names = set()
+    funcnames = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        kind = node[0]
+        if kind == 'name':
+            names.add(node[1])
+        elif kind == 'call':
+            funcnames.add(node[1])
+            stack.extend(node[2])
+        elif kind in ('concat', 'list'):
+            stack.extend(node[1])
+        elif kind in ('eq', 'ne', 'index'):
+            stack.append(node[1])
+            stack.append(node[2])
+        elif kind == 'shared':
+            stack.append(node[2])
+    return names, funcnames
+
+
+def child_nodes(node):
+    '''Returns the tuple of the immediate subtrees of AST `node`.'''
+    kind = node[0]
+    if kind == 'call':
+        return node[2]
+    if kind in ('concat', 'list'):
+        return node[1]
+    if kind in ('eq', 'ne', 'index'):
+        return node[1:]
+    if kind == 'shared':
+        return (node[2],)
+    return ()
+
+
+def share_subexpressions(node, slots):
+    '''Returns AST `node` with each subtree that is a key of dict `slots`
+    replaced by ('shared', slot, subtree), so that it is evaluated once
+    per record however many expressions contain it.
+    '''
+    kind = node[0]
+    if kind == 'call':
+        shared = ('call', node[1], tuple(share_subexpressions(arg, slots) for arg in node[2]))
+    elif kind in ('concat', 'list'):
+        shared = (kind, tuple(share_subexpressions(part, slots) for part in node[1]))
+    elif kind in ('eq', 'ne', 'index'):
+        shared = (kind, share_subexpressions(node[1], slots),
+            share_subexpressions(node[2], slots))
+    else:
+        shared = node
+    if node in slots:
+        return ('shared', slots[node], shared)
+    return shared
+
+
+
+# =============================================================================
+#
+# ================== EVALUATION FUNCTIONS =====================================
+
+
+def evaluate(node, namespace, functions):
+    '''Returns the value of AST `node`. Names are looked up in `namespace`
+    (and the current FOR EACH item under `item_key`); function names in
+    `functions`. A name or function that cannot be found raises a KeyError.
+    '''
+    kind = node[0]
+
+    if kind == 'const':
+        return node[1]
+
+    elif kind == 'name':
+        return namespace[node[1]]
+
+    elif kind == 'call':
+        func = functions[node[1]]
+        return func(*[evaluate(arg, namespace, functions) for arg in node[2]])
+
+    elif kind == 'shared':
+        values = namespace.get(shared_key)
+        if values is None:
+            values = namespace[shared_key] = {}
+        slot = node[1]
+        if slot in values:
+            return values[slot]
+        value = values[slot] = evaluate(node[2], namespace, functions)
+        return value
+
+    elif kind == 'concat':
+        parts = node[1]
+        value = evaluate(parts[0], namespace, functions)
+        for part in parts[1:]:
+            value = value + evaluate(part, namespace, functions)
+        return value
+
+    elif kind == 'list':
+        return [evaluate(item, namespace, functions) for item in node[1]]
+
+    elif kind == 'item':
+        value = namespace[item_key]
+        for propname in node[1]:
+            value = value[propname]
+        return value
+
+    elif kind == 'eq':
+        return evaluate(node[1], namespace, functions) == evaluate(node[2], namespace, functions)
+
+    elif kind == 'ne':
+        return evaluate(node[1], namespace, functions) != evaluate(node[2], namespace, functions)
+
+    elif kind == 'index':
+        return evaluate(node[1], namespace, functions)[evaluate(node[2], namespace, functions)]
+
+    raise ValueError('Unknown MARCout expression node `' + str(kind) + '`.')
+
+
+
+# =============================================================================
+#
+# ================== PYTHON SOURCE GENERATION =================================
+
+
+def to_python(node, item_varname='eachitem'):
+    '''Returns Python source equivalent to AST `node`, for generated code
+    (see marcout_codegen.py). Names become Python names, function calls
+    become calls, and the current FOR EACH item is `item_varname`.
+    '''
+    kind = node[0]
+
+    if kind == 'const':
+        return repr(node[1])
+
+    elif kind == 'name':
+        return node[1]
+
+    elif kind == 'call':
+        return (node[1] + '('
+            + ', '.join(to_python(arg, item_varname) for arg in node[2]) + ')')
+
+    elif kind == 'concat':
+        return '(' + ' + '.join(to_python(part, item_varname) for part in node[1]) + ')'
+
+    elif kind == 'list':
+        return '[' + ', '.join(to_python(item, item_varname) for item in node[1]) + ']'
+
+    elif kind == 'item':
+        return item_varname + ''.join('[' + repr(propname) + ']' for propname in node[1])
+
+    elif kind == 'eq':
+        return ('(' + to_python(node[1], item_varname) + ' == '
+            + to_python(node[2], item_varname) + ')')
+
+    elif kind == 'ne':
+        return ('(' + to_python(node[1], item_varname) + ' != '
+            + to_python(node[2], item_varname) + ')')
+
+    elif kind == 'index':
+        return (to_python(node[1], item_varname) + '['
+            + to_python(node[2], item_varname) + ']')
+
+    elif kind == 'shared':
+        return to_python(node[2], item_varname)
+
+    raise ValueError('Unknown MARCout expression node `' + str(kind) + '`.')
@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+
+# This module is the compact model of exported MARC fields: the exporter
+# (and generated MARCout modules) produce records as lists of `MarcField`,
+# and the serializers consume them.
+#
+# The model replaces the "raw datastructure" of earlier versions, in which
+# a field was a dict with optional keys, its subfields a list of one-key
+# dicts, and each FOR EACH group a list of one-key dicts with demarcators
+# under 'group_' keys. Fields, subfields and groups here are slotted
+# objects: smaller than dicts, and read by attribute rather than by
+# `list(subfield.keys())[0]`.
+#
+# The raw datastructure remains the form of the 'raw-datastructure'
+# serialization: `to_dicts` and `from_dicts` convert records both ways.
+
+
+# =============================================================================
+#
+# ================== CLASSES ==================================================
+
+
+class Subfield(object):
+    '''A subfield: its one-character `code` and its `value`.'''
+    __slots__ = ('code', 'value')
+
+    def __init__(self, code, value):
+        self.code = code
+        self.value = value
+
+    def __eq__(self, other):
+        return (isinstance(other, Subfield)
+            and self.code == other.code and self.value == other.value)
+
+    def __repr__(self):
+        return 'Subfield(' + repr(self.code) + ', ' + repr(self.value) + ')'
+
+
+class ForeachGroup(object):
+    '''The subfields exported for one item of a FOR EACH block, with the
+    block's demarcators: `prefix` precedes the subfields, `suffix` and
+    then `demarcator` follow them. A demarcator that is None or empty is
+    absent.
+    '''
+    __slots__ = ('prefix', 'subfields', 'suffix', 'demarcator')
+
+    def __init__(self, subfields, prefix=None, suffix=None, demarcator=None):
+        self.subfields = subfields
+        self.prefix = prefix
+        self.suffix = suffix
+        self.demarcator = demarcator
+
+    def __eq__(self, other):
+        return isinstance(other, ForeachGroup) and group_to_list(self) == group_to_list(other)
+
+    def __repr__(self):
+        return 'ForeachGroup(' + repr(group_to_list(self)) + ')'
+
+
+class MarcField(object):
+    '''An exported MARC field. `keys` is the field's template (or anything
+    else that iterates over the names of the field's properties, in
+    order, and answers `in`): a property is present only if its name is
+    in `keys`, whatever its value. Engines' templates are shared by all
+    the fields exported from them.
+    `subfields` is a list of Subfield, and `foreach` a list of
+    ForeachGroup; the other properties are strings (`terminator` may be
+    None), or the values of EXPORT WHEN / UNLESS conditions.
+    '''
+    __slots__ = ('keys', 'tag', 'indicator_1', 'indicator_2', 'fixed', 'content',
+        'subfields', 'foreach', 'terminator', 'export_if', 'export_if_not')
+
+    def __init__(self, keys, tag, indicator_1=None, indicator_2=None, fixed=None,
+            content=None, subfields=None, foreach=None, terminator=None,
+            export_if=None, export_if_not=None):
+        self.keys = keys
+        self.tag = tag
+        self.indicator_1 = indicator_1
+        self.indicator_2 = indicator_2
+        self.fixed = fixed
+        self.content = content
+        self.subfields = subfields
+        self.foreach = foreach
+        self.terminator = terminator
+        self.export_if = export_if
+        self.export_if_not = export_if_not
+
+    def __eq__(self, other):
+        return isinstance(other, MarcField) and to_dict(self) == to_dict(other)
+
+    def __repr__(self):
+        return 'MarcField(' + repr(to_dict(self)) + ')'
+
+
+
+# =============================================================================
+#
+# ================== CONVERSION FUNCTIONS =====================================
+
+
+def group_to_list(group):
+    '''Returns ForeachGroup `group` in raw datastructure form: a list of
+    one-key dicts, {'group_prefix': ...} first if there is a prefix, then
+    {code: value} for each subfield, then {'group_suffix': ...} and
+    {'group_demarc': ...}.
+    '''
+    retval = []
+    if group.prefix:
+        retval.append({'group_prefix': group.prefix})
+    for subfield in group.subfields:
+        retval.append({subfield.code: subfield.value})
+    if group.suffix:
+        retval.append({'group_suffix': group.suffix})
+    if group.demarcator:
+        retval.append({'group_demarc': group.demarcator})
+    return retval
+
+
+def group_from_list(group_listing):
+    '''Returns the ForeachGroup of a group in raw datastructure form (see
+    `group_to_list`).
+    '''
+    group = ForeachGroup([])
+    for item in group_listing:
+        for key in item:
+            if key == 'group_prefix':
+                group.prefix = item[key]
+            elif key == 'group_suffix':
+                group.suffix = item[key]
+            elif key == 'group_demarc':
+                group.demarcator = item[key]
+            else:
+                group.subfields.append(Subfield(key, item[key]))
+    return group
+
+
+def to_dict(field):
+    '''Returns MarcField `field` in raw datastructure form: a dict of its
+    present properties, in order.
+    '''
+    retval = {}
+    for propname in field.keys:
+        if propname == 'subfields':
+            retval[propname] = [{subfield.code: subfield.value}
+                for subfield in field.subfields]
+        elif propname == 'foreach':
+            retval[propname] = [group_to_list(group) for group in field.foreach]
+        else:
+            retval[propname] = getattr(field, propname)
+    return retval
+
+
+def from_dict(raw_field):
+    '''Returns the MarcField of a field in raw datastructure form.'''
+    field = MarcField(tuple(raw_field), raw_field['tag'])
+    for propname in raw_field:
+        if propname == 'subfields':
+            field.subfields = []
+            for subfield_dict in raw_field[propname]:
+                for subfield_code in subfield_dict:
+                    field.subfields.append(Subfield(subfield_code,
+                        subfield_dict[subfield_code]))
+        elif propname == 'foreach':
+            field.foreach = [group_from_list(group_listing)
+                for group_listing in raw_field[propname]]
+        elif propname in MarcField.__slots__ and propname != 'keys':
+            setattr(field, propname, raw_field[propname])
+        else:
+            raise ValueError('Unknown MARC field property `' + str(propname) + '`.')
+    return field
+
+
+def to_dicts(record):
+    '''Returns an exported record (a list of MarcField) in raw
+    datastructure form.
+    '''
+    return [to_dict(field) for field in record]
+
+
+def from_dicts(raw_record):
+    '''Returns the exported record (a list of MarcField) of a record in raw
+    datastructure form.
+    '''
+    return [from_dict(raw_field) for raw_field in raw_record]
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import marcout_fields as marcfields
 
 
 # =============================================================================
@@ -155,79 +156,58 @@ def iso_record_2_raw(iso_record):
 
 
 def raw_field_2_iso(raw_field):
-    '''This function accepts a raw datastructure(dict) representation 
+    '''This function accepts an exported field (a marcout_fields.MarcField)
     of a record; splits that into tag and content; and returns 
     a 2-tuple of (tag, content) where content is flattened into a string,
     is properly formatted and delimited for ISO 2709.
     '''
+    keys = raw_field.keys
+
     # tag
-    tag = raw_field['tag']
+    tag = raw_field.tag
 
     # field content
     retval = field_delimiter
-    if 'indicator_1' in raw_field:
-        retval += raw_field['indicator_1']
-    if 'indicator_2' in raw_field:
-        retval += raw_field['indicator_2']
+    if 'indicator_1' in keys:
+        retval += raw_field.indicator_1
+    if 'indicator_2' in keys:
+        retval += raw_field.indicator_2
 
-    if 'content' in raw_field:
+    if 'content' in keys:
         # no preceding subfield delimiter
-        retval += raw_field['content']
+        retval += raw_field.content
     else:
         # 'content' is incompatible with 'subfields' or 'foreach'
-        if 'subfields' in raw_field:
-            for subfield in raw_field['subfields']:
+        if 'subfields' in keys:
+            for subfield in raw_field.subfields:
                 retval += subfield_delimiter
-                # dict with only one mapping; key is subfield code
-                if len(subfield.keys()) > 1:
-                    raise ValueError('subfield dict with multiple mappings: "' 
-                        + str(subfield) + '".')
-                for sub_key in subfield.keys():
-                    retval += sub_key
-                    retval += subfield[sub_key]
-
-        if 'foreach' in raw_field:
+                retval += subfield.code
+                retval += subfield.value
+
+        if 'foreach' in keys:
             # this is another level of complexity: a pattern of subfields,
             # repeated in "groups" corresponding to each item in the foreach.
             # There are also group-level items such as demarcators.
-            # foreach is a list of lists:
-            # 
-            # 'foreach': [
-            #         [{
-            #             't': 'Pillow'
-            #         }, {
-            #             'g': '(8:30)'
-            #         }, {
-            #             'group_suffix': ' --'
-            #         }],
-            #         etc.
-
-            # The outer list preserves sort order imposed on the groups.
-            # The inner list preserves the pattern (including all demarcators).
-            # Each dict contains a single entry.
+            # foreach is a list of marcout_fields.ForeachGroup.
+
+            # The list preserves sort order imposed on the groups. Each
+            # group's subfields preserve the pattern.
             #   - Normal subfields get rendered as subfields.
             #   - Demarcators exist at the group level, and are to be rendered as 
-            #       string literal values (not subfields) when encountered. NO
-            #       SUPPLEMENTAL SORTING is required - demarcators were sorted 
-            #       when data was injected into the Raw form.
-
-            for group_listing in raw_field['foreach']:
-
-                for item in group_listing:
-                    # item is a dict. Should only ever have one key & 
-                    # one associated value.
-                    key = list(item.keys())[0]
-                    if key.startswith('group_'):
-                        # demarcator
-                        retval += item[key]
-
-                    else:
-                        # it's a subfield
-                        retval += subfield_delimiter
-                        subfield_code = key
-                        subfield_val = item[subfield_code]
-                        retval += subfield_code
-                        retval += subfield_val
+            #       string literal values (not subfields): the prefix before
+            #       the group's subfields, the suffix and demarcator after.
+
+            for group in raw_field.foreach:
+                if group.prefix:
+                    retval += group.prefix
+                for subfield in group.subfields:
+                    retval += subfield_delimiter
+                    retval += subfield.code
+                    retval += subfield.value
+                if group.suffix:
+                    retval += group.suffix
+                if group.demarcator:
+                    retval += group.demarcator
 
 
     return tag, retval
@@ -266,7 +246,8 @@ def make_iso_directory(field_defs):
 
 
 def raw_record_2_iso(raw_record):
-    # raw_record is a list of field dicts, OPTIONALLY beginning with the
+    # raw_record is a list of fields (marcout_fields.MarcField, or field
+    # dicts in raw datastructure form), OPTIONALLY beginning with the
     # 24-charcter LDR code.
 
     # print()
@@ -281,8 +262,10 @@ def raw_record_2_iso(raw_record):
     fields = []
 
     for raw_field in raw_record:
-        if raw_field['tag'] == 'LDR':
-            LDR = raw_field['fixed']
+        if isinstance(raw_field, dict):
+            raw_field = marcfields.from_dict(raw_field)
+        if raw_field.tag == 'LDR':
+            LDR = raw_field.fixed
         else:
             # it's a normal field. Add (tag, content) to field list
             fields.append(raw_field_2_iso(raw_field))
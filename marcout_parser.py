@@ -3,74 +3,18 @@
 # This module contains necessary functions and content to convert 
 #  a MARCout export definition source file into a MARCout Export Engine.
 
-import copy
+import collections
+import hashlib
 
 import marcout_common as common
+import marcout_expressions as expressions
+import marcout_tracing as tracing
 
 
 # =============================================================================
 #
 # ================== CONSTANTS ================================================
 
-# Characters significant for subfield expression parse operations
-opaques = {'"': '"', "'": "'"}
-nestables = {'(':')', '[':']', '{':'}'}
-
-
-# less ambiguous substitutes for MARCout reserved phrases
-marcout_keyword_replacements = {
-    'IS NOT': 'IS_NOT',
-    'IS TRUE': 'IS_TRUE',
-    'IS FALSE': 'IS_FALSE',
-    'HAS VALUE': 'HAS_VALUE',
-    'HAS NO VALUE': 'HAS_NO_VALUE',
-    'STARTS WITH': 'STARTS_WITH'
-}
-
-marcout_rewrites = {
-    
-    # - `IS`: operator that compares two sub-expressions for equality. 
-    #     Equivalent to `==` in Python.
-    ' IS ': [' == ', 'replace'],
-
-    # - `IS NOT`: infix operator that compares two sub-expressions for inequality. 
-    #     Equivalent to `!=` in Python.
-    ' IS_NOT ': [' != ', 'replace'],
-
-    # - `IS TRUE`: postfix operator that resolves to True if the preceding
-    #     expression is a MARCout values of `TRUE`.
-    ' IS_TRUE': ['marcout_is_true', 'postfix'],
-
-    # - `IS FALSE`: postfix operator that resolves to True if the preceding
-    #     expression is true, for MARCout values of `FALSE`.
-    ' IS_FALSE': ['marcout_is_false', 'postfix'],
-
-    # - `HAS VALUE`: postfix operator that resolves to True if the preceding 
-    #     expression is PRESENT and not `EMPTY`. In other words, the expression
-    #     has meaning over and above the ambiguous empty values.
-    ' HAS_VALUE': ['marcout_has_value', 'postfix'],
-
-    # - `HAS NO VALUE`: postfix operator that resolves to True if the preceding
-    #     expression is not `PRESENT`, or, if `PRESENT`, is `EMPTY`.
-    ' HAS_NO_VALUE': ['marcout_has_no_value', 'postfix'],
-
-    # - `NOTHING`: alias (non-operator) keyword for generation of an empty value.
-    #     Depending on context, makes an empty string, or a non-value such as 
-    #     Python `None` or JSON `null`.
-    'NOTHING': ['marcout_nothing_value', 'replace'],
-
-    # - `STARTS WITH`: infix operator for string values. Resolves to True if the
-    #     preceding string starts with the subsequent string.
-    ' STARTS_WITH ': ['marcout_startswith', 'infix'],
-
-    # - `CONTAINS`: infix operator for string values. Resolves to True if the
-    #     preceding string starts with the subsequent string.
-    ' CONTAINS ': ['marcout_contains', 'infix']
-
-    # - `+`: the concatenation operator for string values. Does NOT represent
-    #     numeric addition, date addition, etc.
-}
-
 # ISO 2709 LDR: MARCout constant, 24 chars in length
 iso_2709_ldr_template = '00000....a2200000...4500'
 iso_2709_ldr_defaults = {'05': 'n', '06': 'j', '07': 'm', '17': '1'}
@@ -92,51 +36,276 @@ def value_after_first(expr, split_expr):
     return split_expr.join(expr.split(split_expr)[1:]).strip()
 
 
-def rewrite_keyword_expr(expr):
-    '''This function replaces reserved keyword characters, words, and phrases
-    with equivalent expressions in order to create an evaluable expression
-    form. Sometimes, as in the case of postfix expressions, it's necessary to
-    reorder the parts of the expression. Note that the resulting expression
-    cannot, in general, be evaluated until the content of a JSON record is 
-    available.
+def split_default(extractor):
+    '''Splits a JSON extracted property's expression at `::DEFAULT`.
+    Returns (expression, default), where `default` is '' if the extractor
+    declares none.
+    '''
+    default = ''
+    if '::DEFAULT' in extractor:
+        extractor, default = extractor.split('::DEFAULT')
+        extractor = extractor.rstrip()
+        default = default.strip()
+    return extractor, default
+
+
+def compile_expr(expr, eachitem=None):
+    '''Compiles a MARCout expression into its constant-folded AST (see
+    marcout_expressions.py). The AST is evaluated at export time against
+    a namespace of record extracts and collection parameters, so the
+    expression source is parsed exactly once per MARCout Engine.
+    `eachitem` names the item of an enclosing FOR EACH block.
+    Raises a ValueError if the expression is not valid MARCout.
+    '''
+    return expressions.compile_expr(expr, eachitem)
+
+
+def compile_default(default):
+    '''Compiles the `::DEFAULT` of a JSON extracted property. A default
+    is a literal, such as '' or []. Any other default is taken as text.
+    '''
+    try:
+        node = compile_expr(default)
+    except ValueError:
+        node = None
+    if node is None or node[0] not in ('const', 'list'):
+        node = ('const', default)
+    return node
+
+
+def compile_template_exprs(field_templates, source_positions=None, extractors=None):
+    '''Accepts the list of MARC field templates and returns a dict mapping
+    each expression source string to its compiled AST. This covers
+    CONTENT, SUBFIELD, EXPORT WHEN/UNLESS expressions, and the subfields and
+    demarcators of FOR EACH blocks. FOR EACH subfields and SORT BY keys are
+    compiled in their item context (`track::title` is the current track's
+    title).
+    If `extractors` (the JSON extracted properties) are supplied, their
+    expressions and defaults are compiled too.
+    If the engine's `source_positions` are supplied, a ValueError for an
+    invalid expression names the template's file and line.
+    '''
+    compiled = {}
+
+    def add(expr, eachitem=None):
+        if not expr or expr in compiled:
+            return
+        compiled[expr] = compile_expr(expr, eachitem)
+
+    for propname in (extractors or {}):
+        varval_expr, default = split_default(extractors[propname])
+        try:
+            add(varval_expr)
+        except ValueError as e:
+            if not source_positions:
+                raise
+            lineno = source_positions['json_extracted_properties'][propname]
+            raise ValueError(source_location(source_positions['filename'], lineno)
+                + propname + ': ' + str(e))
+        if default not in compiled:
+            compiled[default] = compile_default(default)
+
+    for indx, template in enumerate(field_templates):
+        try:
+            compile_template(template, add)
+        except ValueError as e:
+            if not source_positions:
+                raise
+            lineno = source_positions['marc_field_templates'][indx]['tag']
+            raise ValueError(source_location(source_positions['filename'], lineno)
+                + 'FIELD ' + template['tag'] + ': ' + str(e))
+
+    return compiled
+
+
+def compile_template(template, add):
+    '''Calls `add(expr)`, or `add(expr, eachitem)` for FOR EACH
+    subfields, on every expression in a MARC field template.
+    '''
+    for propname in ('content', 'export_if', 'export_if_not'):
+        if propname in template:
+            add(template[propname])
+
+    for subfield_dict in template.get('subfields', []):
+        for subfield_code in subfield_dict:
+            add(subfield_dict[subfield_code])
+
+    if 'foreach' in template:
+        foreach = template['foreach']
+        for subfield_dict in foreach.get('subfields', []):
+            for subfield_code in subfield_dict:
+                add(subfield_dict[subfield_code], foreach['eachitem'])
+        for sortby in foreach.get('sortby', []):
+            add(sortby, foreach['eachitem'])
+        for propname in ('prefix', 'suffix', 'demarcator'):
+            if propname in foreach:
+                add(foreach[propname])
+
+
+def extractor_paths(extractors, compiled_exprs):
+    '''Returns, for each JSON extracted property whose expression is a
+    plain subscript chain on the record, such as `album_json['album']['id']`
+    (with or without a `::DEFAULT`), the chain's keys as a tuple. Exporters
+    read these properties with a direct getter (see
+    marcout_exporter.path_getter) instead of evaluating the expression.
+    '''
+    paths = {}
+    for propname in extractors:
+        varval_expr, default = split_default(extractors[propname])
+        if varval_expr not in compiled_exprs:
+            continue
+        path = expressions.subscript_path(compiled_exprs[varval_expr], 'album_json')
+        if path is not None:
+            paths[propname] = path
+    return paths
+
+
+def template_dependencies(field_templates, compiled_exprs, extractors):
+    '''Returns the dependency graph of the MARC field templates: a list
+    with one dict per template, of the form
+        {'condition': {'extracts': [...], 'functions': [...]},
+         'content': {'extracts': [...], 'functions': [...]}}
+    naming the JSON extracted properties and the functions that its
+    EXPORT WHEN / EXPORT UNLESS expressions ('condition'), and the rest of
+    its expressions ('content'), refer to. MARCout keywords compile to
+    calls of keyword functions; those are not listed.
+    '''
+    graph = []
+    for template in field_templates:
+        refs = {'condition': (set(), set()), 'content': (set(), set())}
+
+        def adder(part):
+            def add(expr, eachitem=None):
+                if expr:
+                    names, funcnames = expressions.referenced_names(compiled_exprs[expr])
+                    refs[part][0].update(names)
+                    refs[part][1].update(funcnames)
+            return add
+
+        add_condition = adder('condition')
+        for propname in ('export_if', 'export_if_not'):
+            add_condition(template.get(propname))
+        content = dict((propname, template[propname]) for propname in template
+            if propname not in ('export_if', 'export_if_not'))
+        compile_template(content, adder('content'))
+        if 'foreach' in template:
+            refs['content'][0].add(template['foreach']['itemsource'])
+
+        dependencies = {}
+        for part in refs:
+            names, funcnames = refs[part]
+            dependencies[part] = {
+                'extracts': sorted(name for name in names if name in extractors),
+                'functions': sorted(name for name in funcnames
+                    if name not in expressions.keyword_functions)}
+        graph.append(dependencies)
+    return graph
+
+
+def shareable(node, pure_functions):
+    '''Returns True if AST `node` may be evaluated once per record and its
+    value reused: it computes something (it is not a constant or a name
+    lookup), and it reads no FOR EACH item, makes no new list, and calls
+    only keyword functions and functions declared `PURE`.
+    '''
+    if node[0] not in ('call', 'concat', 'eq', 'ne', 'index'):
+        return False
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node[0] in ('item', 'list'):
+            return False
+        if node[0] == 'call' and not (node[1] in expressions.keyword_functions
+                or node[1] in pure_functions):
+            return False
+        stack.extend(expressions.child_nodes(node))
+    return True
+
+
+def common_subexpressions(field_templates, compiled_exprs, pure_functions):
+    '''Returns the subexpressions that occur more than once in the
+    expressions of the MARC field templates (across templates, conditions
+    and FOR EACH blocks), and can be shared (see `shareable`): a list of
+    (AST, occurrences), most frequent first. A subexpression that only
+    recurs within one shared subexpression is not listed: the whole is
+    evaluated once per record, so its parts are too.
+    '''
+    occurrences = []
+
+    def add(expr, eachitem=None):
+        if expr:
+            occurrences.append(compiled_exprs[expr])
+
+    for template in field_templates:
+        compile_template(template, add)
+
+    counts = collections.Counter()
+    stack = list(occurrences)
+    while stack:
+        node = stack.pop()
+        counts[node] += 1
+        stack.extend(expressions.child_nodes(node))
+    candidates = set(node for node in counts
+        if counts[node] > 1 and shareable(node, pure_functions))
+
+    # recount, entering each candidate only at its first occurrence
+    counts = collections.Counter()
+    stack = list(occurrences)
+    while stack:
+        node = stack.pop()
+        counts[node] += 1
+        if node in candidates and counts[node] > 1:
+            continue
+        stack.extend(expressions.child_nodes(node))
+
+    shared = [(node, counts[node]) for node in candidates if counts[node] > 1]
+    shared.sort(key=lambda pair: -pair[1])
+    return shared
+
+
+def share_template_exprs(field_templates, compiled_exprs, shared, extractors):
+    '''Rewrites the compiled template expressions in `compiled_exprs` so
+    that each of the `shared` subexpressions (see `common_subexpressions`)
+    is evaluated once per record, through the record's table of shared
+    values. Its slot in the table is its index in `shared`.
+    Extractor expressions, which are evaluated outside of the record's
+    namespace, are left alone.
     '''
-    retval = expr
+    slots = dict((node, slot) for slot, (node, count) in enumerate(shared))
 
-    # replace token phrases with unified keyword forms
-    for keyword in marcout_keyword_replacements:
-        retval = retval.replace(keyword, marcout_keyword_replacements[keyword])
+    unshared = set()
+    for propname in extractors:
+        unshared.update(split_default(str(extractors[propname])))
 
-    # replace keyword expressions
-    for keyword in marcout_rewrites:
-        if keyword in retval:
-            # the value of marcout_rewrites[keyword] is a list containing
-            # [replacement, mode], where `mode` describes how the replacement
-            # is applied.
-            replacement = marcout_rewrites[keyword][0]
-            replacement_mode = marcout_rewrites[keyword][1]
+    template_exprs = set()
 
-            if replacement_mode == 'replace':
-                # the replacement val is a string that directly replaces
-                # the keyword
-                retval = retval.replace(keyword, replacement)
+    def add(expr, eachitem=None):
+        if expr and expr not in unshared:
+            template_exprs.add(expr)
 
-            elif replacement_mode == 'postfix':
-                # the replacement value is a function name with a single
-                # argument. The argument is the entire exression, but with the 
-                # keyword removed)
-                retval = replacement + '(' + retval.replace(keyword, '') + ')'
+    for template in field_templates:
+        compile_template(template, add)
 
-            elif replacement_mode == 'infix':
-                # the replacement value is a function name with two arguments:
-                # the portion of the expression before the keyword, and the
-                # portion of the expression after the keyword.
-                portions = retval.split(keyword)
-                retval = replacement + '(' + portions[0] + ', ' + portions[1] + ')'
+    for expr in template_exprs:
+        compiled_exprs[expr] = expressions.share_subexpressions(compiled_exprs[expr], slots)
 
-            else:
-                raise ValueError('Unknown replacement mode "' + replacement_mode + '".')
 
-    return retval
+def engine_statistics(marcout_engine):
+    '''Returns a dict of figures about a MARCout Engine: the numbers of
+    'field_templates', 'json_extracted_properties' (and of those,
+    'direct_extractors', read by a subscript path; see `extractor_paths`),
+    'compiled_expressions', 'common_subexpressions', and
+    'shared_evaluations_saved', the evaluations per exported record that
+    sharing the common subexpressions saves when every template is exported.
+    '''
+    shared = marcout_engine.get('common_subexpressions', [])
+    return {'field_templates': len(marcout_engine['marc_field_templates']),
+        'json_extracted_properties': len(marcout_engine['json_extracted_properties']),
+        'direct_extractors': len(marcout_engine.get('extractor_paths', {})),
+        'compiled_expressions': len(marcout_engine.get('compiled_expressions', {})),
+        'common_subexpressions': len(shared),
+        'shared_evaluations_saved': sum(count - 1 for node, count in shared),
+    }
 
 
 def render_ldr(ldr_field_def):
@@ -171,31 +340,11 @@ def render_ldr(ldr_field_def):
     return retval.replace('.', ' ')
 
 
-def parse_marcexport_deflines(deflines):
-    '''This function turns the marcexport define text content into datastructures.
-    It does this by reading the MARCout text line by line in multiple passes
-    to accomplish different ends.
-
-    From those blocks, it parses source content for the different
-    categories of information. (It ignores "DESCRIPTION", which is
-    non-machine-parseable documentation for humans.)
-    
-    From the content, it parses a dictionary/map/hash/object of marcexport
-    datastructures:
-        - 'known_parameters', required parameters
-        - 'functions', function names anb brief signature/descriptions
-        - 'json_extracted_properties', named expressions for pulling values from a
-            JSON instance.
-        - 'marc_field_templates', an ordered sequence of data structures listing
-            desired fixed values, and album JSON extraction expressions, for MARC
-            fields.
-            This list of templates thus controls field order, subfield order,
-            and instructions for pulling data from the expected JSON instance.
-
-    This marcexport datastructures dictionary/map/hash/object is returned.
+def strip_comments(deflines):
+    '''Returns the lines of MARCout source with comment lines removed,
+    and with trailing comments and whitespace stripped from the rest.
+    Empty lines are preserved: they are significant.
     '''
-
-    # FIRST PASS: REMOVE COMMENTS (AND TRAILING NEWLINES)
     contentlines = []
     for line in deflines:
         if line.strip().startswith('#'):
@@ -203,398 +352,493 @@ def parse_marcexport_deflines(deflines):
             continue
         line = line.split('#')[0].rstrip()
         #note that we PRESERVE empty lines: they are significant
-        contentlines.append(line.rstrip())
-
-    # SECOND PASS: PARSE CONTENT INTO NAMED BLOCKS
-    defblocks = {}      # dictionary: keys are block titles
-    parse_order = []    # list: record order in which blocks were found
-    current_blockname = None
-
-    for line in contentlines:
-        if line.strip().endswith('--------'):
-            # transform block title in MARCout to lowercase with underscore
-            line = line.strip()
-            current_blockname = line[:line.find('----')]
-            current_blockname = current_blockname.lower().replace(' ', '_')
-            defblocks[current_blockname] = []
-            parse_order.append(current_blockname)
-
-        else:
-            if current_blockname:
-                defblocks[current_blockname].append(line.strip())
-
-    # now evaluate marcexport define DATASTRUCTURE content as required.
-    # do it block by block.
-    marcdefs = {}
-    marcdefs['parse_order'] = parse_order
+        contentlines.append(line)
+    return contentlines
 
-    # KNOWN PARAMETERS:
-    # what needs to be passed in for some things to work -- 
-    # in codebase, some are environment variables;
-    # at command line, they must be explicitly passed.
-    paramnames = []
-    for line in defblocks['known_parameters']:
-        if line.strip():
-            paramnames.append(line.strip())
 
-    marcdefs['known_parameters'] = paramnames
-
-    # FUNCTIONS:
-    # function names and expressions
-    marcdefs['functions'] = {}
-    for line in defblocks['functions']:
-        line = line.strip()
-        if not line:
-            continue
-
-        # extract the function name
-        funcname = line.split('(')[0]
-        marcdefs['functions'][funcname] = line
-
-    # EXTRACTORS:
-    # expressions for pulling data out of JSON instances
-    marcdefs['json_extracted_properties'] = {}
-    for line in defblocks['json_extracted_properties']:
-        line = line.strip()
-        if not line:
-            continue
-
-        parts = line.split('=')
-        # someone might put some equals signs in the expr - condition or something
-        marcdefs['json_extracted_properties'][parts[0].strip()] = ('='.join(parts[1:])).strip()
-
-    # FIELD TEMPLATES: 
-    # ordered sequence of templates for MARC fields
-    marcdefs['marc_field_templates'] = None
+def new_source_hash():
+    '''Returns the state for computing a source hash one line at a time
+    (see `update_source_hash`).
+    '''
+    return {'sha': hashlib.sha256(), 'started': False, 'blank': False}
 
-    field_data = [] # list of MARC field data assembled according to definitions
-    current_field = None
 
-    # using a while loop to have control over indx for readaheads
-    indx = -1
-    while indx < len(defblocks['marc_field_templates']) - 1:
+def update_source_hash(hash_state, line):
+    '''Adds a line of MARCout source, with comments already stripped, to a
+    source hash. Indentation, trailing whitespace, and runs of blank lines
+    are not significant.
+    '''
+    line = line.strip()
+    if not line:
+        if hash_state['blank'] and hash_state['started']:
+            # one empty line is as significant as several
+            return
+        hash_state['blank'] = True
+    else:
+        hash_state['blank'] = False
+    if hash_state['started']:
+        hash_state['sha'].update(b'\n')
+    hash_state['sha'].update(line.encode('utf-8'))
+    hash_state['started'] = True
+
+
+def source_hash(deflines):
+    '''Returns a hex digest identifying MARCout source by its content.
+    Sources that differ only in comments, indentation, trailing whitespace,
+    or runs of blank lines parse to the same MARCout Engine, and have the
+    same hash.
+    '''
+    hash_state = new_source_hash()
+    for line in strip_comments(deflines):
+        update_source_hash(hash_state, line)
+    return hash_state['sha'].hexdigest()
 
-        indx += 1
-        line = defblocks['marc_field_templates'][indx]
 
-        # indented_line is for processing indents. Otherwise, just strip
-        # the line completely.
-        indented_line = line.rstrip()
-        line = line.strip()
+def source_location(filename, lineno):
+    '''Returns a "file:line: " prefix for parse error messages.'''
+    return (filename or '<marcout>') + ':' + str(lineno) + ': '
 
-        if line.endswith('----') or line.split('#')[0].rstrip().endswith('----'):
-            # just a header
-            continue
 
-        if not line:
-            # blank line --> field is done
-            if current_field:
-                # supply default properties
-                if 'terminator' not in current_field:
-                    current_field['terminator'] = '.'
-                # data structures need a copy
-                field_data.append(copy.copy(current_field))
-                current_field = None
-
-        if line.startswith('LDR:'):
-            # this is the ISO 2709 LDR, but used for all forms
-            current_field = {}
-            fieldtag = 'LDR'
-            current_field['tag'] = fieldtag
-
-        elif line.startswith('LDR POS:'):
-            line = line.split(':')[1].split()
-
-            # safety: make sure there's a home for this without
-            # an intervening blank line that erased current_field
-            if not current_field:
-                current_field = {}
-                fieldtag = 'LDR'
-                current_field['tag'] = fieldtag
-
-            for segment in line:
-                if segment.isdigit():
-                    # this is the position tag. Get any declared override value:
-                    nextline = defblocks['marc_field_templates'][indx + 1].strip()
-                    if nextline.startswith('OVERRIDE:'):
-                        value = nextline.split(':')[1].strip()
-                    if value:
-                        current_field[segment] = value
-                    break
-
-        elif line.startswith('FIELD:'):
-            # new field
-            current_field = {}
-            fieldtag = line.split(':')[1].strip()
-            current_field['tag'] = fieldtag
-
-        elif line.startswith('EXPORT UNLESS:'):
-            expr = ':'.join(line.split(':')[1:])
-            # perform initial prep for tokenization
-            expr = rewrite_keyword_expr(expr)
-            current_field['export_if_not'] = expr
-
-        elif line.startswith('EXPORT WHEN:'):
-            expr = ':'.join(line.split(':')[1:])
-            # perform initial prep for tokenization
-            expr = rewrite_keyword_expr(expr)
-            current_field['export_if'] = expr
-
-        elif line.startswith('INDC1:'):
-            indc1 = line.split(':')[1].strip()
-            if indc1 == 'blank':
-                indc1 = ' '
-            current_field['indicator_1'] = indc1
-
-        elif line.startswith('INDC2:'):
-            indc2 = line.split(':')[1].strip()
-            if indc2 == 'blank':
-                indc2 = ' '
-            current_field['indicator_2'] = indc2
-
-        elif line.startswith('CONTENT:'):
-            content = ':'.join(line.split(':')[1:])
-            # perform initial prep for tokenization
-            content = rewrite_keyword_expr(content)
-            current_field['content'] = content
-
-        elif line.startswith('FOR EACH:'):
-            # more complicated
-            foreachexpr = line.split(':')[1].split(' in ')
-            current_field['foreach'] = {}
-            current_field['foreach']['eachitem'] = foreachexpr[0].strip()
-            current_field['foreach']['itemsource'] = foreachexpr[1].strip()
-
-        elif line.startswith('EACH-SUBFIELD:'):
-            if 'subfields' not in current_field['foreach']:
-                current_field['foreach']['subfields'] = []
-            eachsub_code = line.split(':')[1].strip()
-            eachsub_expr = defblocks['marc_field_templates'][indx + 1].strip()
-            # perform initial prep for tokenization
-            eachsub_expr = rewrite_keyword_expr(eachsub_expr)
-            current_field['foreach']['subfields'].append({eachsub_code: eachsub_expr})
-
-        elif line.startswith('SORT BY:'):
-            # we may one day want to support "sort by a, b" expressions...
-            # so make this an array, also
-            if 'sortby' not in current_field['foreach']:
-                current_field['foreach']['sortby'] = []
-            sortby_expr = value_after_first(line, ':')
-            current_field['foreach']['sortby'].append(sortby_expr)
-
-        # TODO This is DEPRECATED.
-        elif line.startswith('DEMARC WITH:'):
-            demarc_expr = value_after_first(line, ':')
-            current_field['foreach']['demarcator'] = demarc_expr
-
-        elif line.startswith('EACH-PREFIX:'):
-            prefix_expr = value_after_first(line, ':')
-            current_field['foreach']['prefix'] = prefix_expr
-
-        elif line.startswith('EACH-SUFFIX:'):
-            suffix_expr = value_after_first(line, ':')
-            current_field['foreach']['suffix'] = suffix_expr
-
-        # "we do not want to grab subfields that are within a" ... 
-        # ("within a " what? guess I got distracted.) TODO figure this out
-        elif line.startswith('SUBFIELD:'):
-            if 'subfields' not in current_field:
-                current_field['subfields'] = []
-            subfield_code = line.split(':')[1].strip()
-            subfield_expr = defblocks['marc_field_templates'][indx + 1].strip()
-            # perform initial prep for tokenization
-            subfield_expr = rewrite_keyword_expr(subfield_expr)
-            current_field['subfields'].append({subfield_code: subfield_expr})
-
-        # A "data" output line is CONTENT, SUBFIELDS, or FOREACH.
-        # the DEFAULT is "."
-        elif line.startswith('TERMINATE DATA WITH:'):
-            terminator_expr = value_after_first(line, ':')
-            if terminator_expr in ('', 'NONE', 'NOTHING'):
-                terminator_expr = None
-            current_field['terminator'] = terminator_expr
-
-    # the LDR field needs to be represented as 24 chars. Might as well 
+def new_definition(filename, first_lineno):
+    '''Returns the parse state for one MARCout export definition.'''
+    marcdefs = {}
+    marcdefs['parse_order'] = []
+    marcdefs['source_hash'] = None
+    marcdefs['known_parameters'] = []
+    marcdefs['functions'] = {}
+    marcdefs['pure_functions'] = []
+    marcdefs['json_extracted_properties'] = {}
+    marcdefs['marc_field_templates'] = []
+
+    positions = {}
+    positions['filename'] = filename
+    positions['first_line'] = first_lineno
+    positions['last_line'] = first_lineno
+    positions['known_parameters'] = {}
+    positions['functions'] = {}
+    positions['json_extracted_properties'] = {}
+    positions['marc_field_templates'] = []
+
+    return {
+        'filename': filename,
+        'marcdefs': marcdefs,
+        'positions': positions,
+        'blockname': None,
+        # the template being parsed, and the lines its parts came from
+        'current_field': None,
+        'current_positions': None,
+        # a directive whose value is on the next line: (directive, code, lineno)
+        'pending': None,
+        'hash_state': new_source_hash(),
+    }
+
+
+def finish_field(state):
+    '''Appends the template being parsed (if any) to the field templates.'''
+    current_field = state['current_field']
+    if current_field:
+        # supply default properties
+        if 'terminator' not in current_field:
+            current_field['terminator'] = '.'
+        state['marcdefs']['marc_field_templates'].append(current_field)
+        state['positions']['marc_field_templates'].append(state['current_positions'])
+    state['current_field'] = None
+    state['current_positions'] = None
+
+
+def finish_block(state):
+    '''Closes the block being parsed, before a new block title or the end
+    of the definition.
+    '''
+    if state['pending']:
+        directive, code, pending_lineno = state['pending']
+        if directive != 'LDR POS':
+            raise ValueError(source_location(state['filename'], pending_lineno)
+                + directive + ' ' + code + ' has no expression on the following line.')
+        state['pending'] = None
+    if state['blockname'] == 'marc_field_templates':
+        finish_field(state)
+
+
+def finish_definition(state):
+    '''Completes the MARCout Engine for a fully parsed definition.'''
+    marcdefs = state['marcdefs']
+    positions = state['positions']
+    field_data = marcdefs['marc_field_templates']
+
+    # the LDR field needs to be represented as 24 chars. Might as well
     # do it here -- no further changes until len() and offset computations.
-    LDR_template = None
     for indx, template in enumerate(field_data):
         if template['tag'] == 'LDR':
-            LDR_template = template
             new_ldr_template = {}
             new_ldr_template['tag'] = 'LDR'
-            new_ldr_template['fixed'] = render_ldr(LDR_template)
+            # do this as 'fixed' so it won't get evaluated...
+            new_ldr_template['fixed'] = render_ldr(template)
             new_ldr_template['terminator'] = None
             # replace old messy LDR template with new one
             field_data[indx] = new_ldr_template
             break
-    # do this as 'fixed' so it won't get evaluated...
-    LDR_template['fixed'] = render_ldr(LDR_template)
-    LDR_template['terminator'] = None
-
-    # assign all of this to the MARC FIELD TEMPLATES block
-    marcdefs['marc_field_templates'] = field_data
 
+    marcdefs['source_hash'] = state['hash_state']['sha'].hexdigest()
+
+    span = None
+    if tracing.hooks:
+        span = tracing.start_span('marcout.compile', {'source_hash': marcdefs['source_hash']})
+
+    # compile every template expression once, here, rather than
+    # re-parsing the expression text for every exported record.
+    marcdefs['compiled_expressions'] = compile_template_exprs(field_data, positions,
+        marcdefs['json_extracted_properties'])
+    marcdefs['extractor_paths'] = extractor_paths(marcdefs['json_extracted_properties'],
+        marcdefs['compiled_expressions'])
+    # which extracts and FUNCTIONS each template needs, so that exporters
+    # compute only the extracts a record's exported fields use.
+    marcdefs['dependencies'] = template_dependencies(field_data,
+        marcdefs['compiled_expressions'], marcdefs['json_extracted_properties'])
+    # subexpressions that recur across templates are evaluated once per
+    # record (see `common_subexpressions`)
+    marcdefs['common_subexpressions'] = common_subexpressions(field_data,
+        marcdefs['compiled_expressions'], marcdefs['pure_functions'])
+    share_template_exprs(field_data, marcdefs['compiled_expressions'],
+        marcdefs['common_subexpressions'], marcdefs['json_extracted_properties'])
+    marcdefs['source_positions'] = positions
+
+    if span is not None:
+        tracing.end_span(span, {'templates': len(field_data),
+            'expressions': len(marcdefs['compiled_expressions']),
+            'common_subexpressions': len(marcdefs['common_subexpressions'])})
     return marcdefs
 
 
-#
-# ================== MARCout EXPRESSION PARSING FUNCTIONS =====================
+def require_field(state, line, lineno):
+    '''Returns the template being parsed; raises a ValueError if `line`
+    occurs outside of a FIELD or LDR.
+    '''
+    if state['current_field'] is None:
+        raise ValueError(source_location(state['filename'], lineno)
+            + '`' + line + '` is not within a FIELD.')
+    return state['current_field']
 
-# In MARC fields, the "tag", "indicator 1", and "indicator 2" values are
-# fixed; their values are defined in the MARCout export definition.
-#
-# Subfield content, on the other hand, often includes values extracted from 
-# the album JSON
 
-# This is a simplistic stack-based recursive descent parse with implicit
-# grammar for subfield expressions in marcexport.define. 
-# The "delims" structure is a stack which grows as new opening delimiters
-# occur, and shrinks as corresponding closing delimiters occur.
-#
-# In a subfield expression, quoted string literals are opaque objects: it
-# doesn't matter what characters they contain, except the occurrence of
-# the same quote character that begain the literal.
-#
-# The other kind of delimiter is the nestable structure token: (, [, {
-# that open a nested sequence, and the corresponding ), ], } delimiters.
-# As the name suggests, these kinds of delimiters can be meaningfully
-# nested
-#
-# The parse separates the expression into syntactically significant 
-# character sequences, as noted in the `tokenize` function string.
+def require_foreach(state, line, lineno):
+    '''Returns the FOR EACH block being parsed; raises a ValueError if `line`
+    occurs outside of a FOR EACH.
+    '''
+    current_field = require_field(state, line, lineno)
+    if 'foreach' not in current_field:
+        raise ValueError(source_location(state['filename'], lineno)
+            + '`' + line + '` is not within a FOR EACH.')
+    return current_field['foreach']
 
 
-def closes_delim(delims, char):
-    '''Returns True if char closes LAST value in delims'''
-    if not delims:
-        # Nothing to close
-        return False
+def parse_template_line(state, line, lineno):
+    '''Parses one (stripped, comment-free) line of the MARC FIELD TEMPLATES
+    block into the template being parsed.
+    '''
+    # A directive on the previous line may take this line as its value.
+    if state['pending']:
+        directive, code, pending_lineno = state['pending']
+        state['pending'] = None
+        current_field = state['current_field']
+        positions = state['current_positions']
+
+        if directive == 'LDR POS':
+            # this is the position tag. Get any declared override value:
+            if line.startswith('OVERRIDE:'):
+                value = line.split(':')[1].strip()
+                if value:
+                    current_field[code] = value
+
+        elif directive == 'EACH-SUBFIELD':
+            current_field['foreach']['subfields'].append({code: line})
+            positions['foreach']['subfields'].append(lineno)
+
+        elif directive == 'SUBFIELD':
+            current_field['subfields'].append({code: line})
+            positions['subfields'].append(lineno)
+
+        # the value line is also parsed as a line in its own right:
+        # in particular, a blank line still ends the field.
+
+    if line.endswith('----'):
+        # just a header
+        return
+
+    if not line:
+        # blank line --> field is done
+        finish_field(state)
+        return
+
+    if line.startswith('LDR:'):
+        # this is the ISO 2709 LDR, but used for all forms
+        state['current_field'] = {'tag': 'LDR'}
+        state['current_positions'] = {'tag': lineno}
+
+    elif line.startswith('LDR POS:'):
+        segments = line.split(':')[1].split()
+
+        # safety: make sure there's a home for this without
+        # an intervening blank line that erased current_field
+        if not state['current_field']:
+            state['current_field'] = {'tag': 'LDR'}
+            state['current_positions'] = {'tag': lineno}
+
+        for segment in segments:
+            if segment.isdigit():
+                # the OVERRIDE value, if any, is on the next line
+                state['pending'] = ('LDR POS', segment, lineno)
+                state['current_positions'][segment] = lineno
+                break
+
+    elif line.startswith('FIELD:'):
+        # new field
+        fieldtag = line.split(':')[1].strip()
+        state['current_field'] = {'tag': fieldtag}
+        state['current_positions'] = {'tag': lineno}
+
+    elif line.startswith('EXPORT UNLESS:'):
+        current_field = require_field(state, line, lineno)
+        expr = ':'.join(line.split(':')[1:])
+        current_field['export_if_not'] = expr.strip()
+        state['current_positions']['export_if_not'] = lineno
+
+    elif line.startswith('EXPORT WHEN:'):
+        current_field = require_field(state, line, lineno)
+        expr = ':'.join(line.split(':')[1:])
+        current_field['export_if'] = expr.strip()
+        state['current_positions']['export_if'] = lineno
+
+    elif line.startswith('INDC1:'):
+        current_field = require_field(state, line, lineno)
+        indc1 = line.split(':')[1].strip()
+        if indc1 == 'blank':
+            indc1 = ' '
+        current_field['indicator_1'] = indc1
+        state['current_positions']['indicator_1'] = lineno
+
+    elif line.startswith('INDC2:'):
+        current_field = require_field(state, line, lineno)
+        indc2 = line.split(':')[1].strip()
+        if indc2 == 'blank':
+            indc2 = ' '
+        current_field['indicator_2'] = indc2
+        state['current_positions']['indicator_2'] = lineno
+
+    elif line.startswith('CONTENT:'):
+        current_field = require_field(state, line, lineno)
+        content = ':'.join(line.split(':')[1:])
+        current_field['content'] = content.strip()
+        state['current_positions']['content'] = lineno
+
+    elif line.startswith('FOR EACH:'):
+        current_field = require_field(state, line, lineno)
+        foreachexpr = line.split(':')[1].split(' in ')
+        current_field['foreach'] = {}
+        current_field['foreach']['eachitem'] = foreachexpr[0].strip()
+        current_field['foreach']['itemsource'] = foreachexpr[1].strip()
+        state['current_positions']['foreach'] = {'foreach': lineno}
+
+    elif line.startswith('EACH-SUBFIELD:'):
+        foreach = require_foreach(state, line, lineno)
+        if 'subfields' not in foreach:
+            foreach['subfields'] = []
+            state['current_positions']['foreach']['subfields'] = []
+        # the subfield expression is on the next line
+        eachsub_code = line.split(':')[1].strip()
+        state['pending'] = ('EACH-SUBFIELD', eachsub_code, lineno)
+
+    elif line.startswith('SORT BY:'):
+        # we may one day want to support "sort by a, b" expressions...
+        # so make this an array, also
+        foreach = require_foreach(state, line, lineno)
+        if 'sortby' not in foreach:
+            foreach['sortby'] = []
+            state['current_positions']['foreach']['sortby'] = []
+        foreach['sortby'].append(value_after_first(line, ':'))
+        state['current_positions']['foreach']['sortby'].append(lineno)
+
+    # TODO This is DEPRECATED.
+    elif line.startswith('DEMARC WITH:'):
+        foreach = require_foreach(state, line, lineno)
+        foreach['demarcator'] = value_after_first(line, ':')
+        state['current_positions']['foreach']['demarcator'] = lineno
+
+    elif line.startswith('EACH-PREFIX:'):
+        foreach = require_foreach(state, line, lineno)
+        foreach['prefix'] = value_after_first(line, ':')
+        state['current_positions']['foreach']['prefix'] = lineno
+
+    elif line.startswith('EACH-SUFFIX:'):
+        foreach = require_foreach(state, line, lineno)
+        foreach['suffix'] = value_after_first(line, ':')
+        state['current_positions']['foreach']['suffix'] = lineno
+
+    elif line.startswith('SUBFIELD:'):
+        current_field = require_field(state, line, lineno)
+        if 'subfields' not in current_field:
+            current_field['subfields'] = []
+            state['current_positions']['subfields'] = []
+        # the subfield expression is on the next line
+        subfield_code = line.split(':')[1].strip()
+        state['pending'] = ('SUBFIELD', subfield_code, lineno)
+
+    # A "data" output line is CONTENT, SUBFIELDS, or FOREACH.
+    # the DEFAULT is "."
+    elif line.startswith('TERMINATE DATA WITH:'):
+        current_field = require_field(state, line, lineno)
+        terminator_expr = value_after_first(line, ':')
+        if terminator_expr in ('', 'NONE', 'NOTHING'):
+            terminator_expr = None
+        current_field['terminator'] = terminator_expr
+        state['current_positions']['terminator'] = lineno
+
+
+def parse_content_line(state, line, lineno):
+    '''Parses one (stripped, comment-free) line of MARCout source into the
+    block being parsed.
+    '''
+    blockname = state['blockname']
+    marcdefs = state['marcdefs']
+    positions = state['positions']
+
+    if blockname == 'marc_field_templates':
+        parse_template_line(state, line, lineno)
+
+    elif not line:
+        # blank lines are only significant in field templates
+        return
+
+    elif blockname == 'known_parameters':
+        # KNOWN PARAMETERS:
+        # what needs to be passed in for some things to work --
+        # in codebase, some are environment variables;
+        # at command line, they must be explicitly passed.
+        marcdefs['known_parameters'].append(line)
+        positions['known_parameters'][line] = lineno
+
+    elif blockname == 'functions':
+        # FUNCTIONS:
+        # function names and expressions. A signature followed by `PURE`
+        # declares a function whose result depends only on its arguments,
+        # so that exporters may cache its results.
+        funcname = line.split('(')[0].strip()
+        marcdefs['functions'][funcname] = line
+        positions['functions'][funcname] = lineno
+        if line.split(')')[-1].strip() == 'PURE':
+            marcdefs['pure_functions'].append(funcname)
 
-    # the last character in a delim sequence is looking for its closure
-    openchar = delims[-1]
-
-    if openchar in opaques:
-        # We are in a string literal. Nothing but the corresponding 
-        # close quote will have any effect.
-        return (char == opaques[openchar])
-    if openchar in nestables:
-        # We're in a nestable expression
-        if char == nestables[openchar]:
-            # It's the right one
-            return True
-        elif char in nestables.values():
-            # It's a wrong one. Invalid nesting!
-            errmsg = 'BAD SUBFIELD EXPR: closing character `' + char
-            errmsg += '` does not match opening character `' + openchar + '`.'
-            raise Exception(errmsg)
-    else:
-        # Neither opaque nor nestable. Fix the tokenize script
-        errmsg = 'CODE ERROR: invalid delimiter `' + delims[-1] + '`.'
-        errmsg += ' Probably in tokenize function.'
-        raise Exception(errmsg)
+    elif blockname == 'json_extracted_properties':
+        # EXTRACTORS:
+        # expressions for pulling data out of JSON instances
+        parts = line.split('=')
+        # someone might put some equals signs in the expr - condition or something
+        propname = parts[0].strip()
+        marcdefs['json_extracted_properties'][propname] = ('='.join(parts[1:])).strip()
+        positions['json_extracted_properties'][propname] = lineno
 
-    return False
+    # other blocks, such as DESCRIPTION, are documentation for humans.
 
 
-def opens_delim(delims, char):
-    if not delims:
-        # any opening delim will start a block
-        return (char in opaques) or (char in nestables)
+def parse_marcexport_definitions(deflines, filename=None):
+    '''This generator turns MARCout source text content into MARCout Engines,
+    yielding one engine for each export definition in `deflines` (an
+    iterable of lines, such as an open file). Definitions may be
+    concatenated: a block title that has already occurred in the current
+    definition begins the next one.
 
-    if delims[-1] in opaques:
-        # We are in a string literal, so no delimiter can open a nested block. 
-        # This is what "opaque" means. A quoted literal can contain anything;
-        # opening delimiters are insignificant.
-        return False
-    elif delims[-1] in nestables:
-        # We're in a nested block. We can open either a string literal 
-        # or a nested block here.
-        return char in opaques or char in nestables
-    else:
-        # Neither opaque nor nestable. Fix the tokenize script
-        errmsg = 'CODE ERROR: invalid delimiter `' + delims[-1] + '`.'
-        errmsg += ' Probably in tokenize function.'
-        raise Exception(errmsg)
+    The source is read in a single pass, line by line, and never held in
+    memory as a whole. Each engine records, in 'source_positions', the
+    `filename` and line numbers from which its templates and expressions
+    were parsed. Parse errors are raised as ValueErrors naming the file
+    and line.
+
+    See `parse_marcexport_deflines` for the content of a MARCout Engine.
+    '''
+    state = new_definition(filename, 1)
+    lineno = 0
+
+    for lineno, line in enumerate(deflines, 1):
 
+        # REMOVE COMMENTS (AND TRAILING NEWLINES)
+        if line.strip().startswith('#'):
+            # it's only a comment line. ignore
+            continue
+        line = line.split('#')[0].strip()
 
-def append_normalized_block(block, blocks):
-    '''Strips leading & trailing whitespace; will not append a whitespace-only block.'''
-    if block.strip():
-        blocks.append(block.strip())
+        if line.endswith('--------'):
+            # transform block title in MARCout to lowercase with underscore
+            blockname = line[:line.find('----')]
+            blockname = blockname.lower().replace(' ', '_')
 
+            finish_block(state)
+            if blockname in state['marcdefs']['parse_order']:
+                # a repeated block: this is the start of the next definition
+                state['positions']['last_line'] = lineno - 1
+                yield finish_definition(state)
+                state = new_definition(filename, lineno)
 
-def tokenize(expr):
+            state['blockname'] = blockname
+            state['marcdefs']['parse_order'].append(blockname)
 
-    '''This function returns the `expr` argument divided into a sequence of
-    syntactically significant blocks of characters.
+        elif state['blockname']:
+            parse_content_line(state, line, lineno)
 
-    Block types are:
-     - string literals, explicitly quoted (treated as "opaque" to further parsing)
-     - opening and closing nestable structure tokens: (, [, {, ), ], }
-     - concatenation symbol: + with adjacent whitespace preserved
-     - function names, invoked at JSON --> MARC export time
-     - extracted property names, resolved at JSON --> MARC export time
+        update_source_hash(state['hash_state'], line)
+
+    finish_block(state)
+    state['positions']['last_line'] = lineno
+    yield finish_definition(state)
 
-    Concatenating the blocks in this return value recreates the `expr`
-    parameter. This is a lossless transformation. 
-    '''
-    token_blocks = []     # sequence of blocks
-    current_block = ''
-    current_delims = []
-
-    for char in expr:
-
-        if closes_delim(current_delims, char):
-            # we are matching an earlier opening. If quote, no thing.
-            # if nestable... a little more involved.
-            if char in opaques.values():
-                # append it. Quotes don't get their own block like nestables do
-                current_block += char
-                append_normalized_block(current_block, token_blocks)
-
-            elif char in nestables.values():
-                append_normalized_block(current_block, token_blocks)
-                # closing char gets its own block
-                token_blocks.append(char)
-
-            # reset
-            current_block = ''
-            current_delims.pop()
-
-        elif opens_delim(current_delims, char):
-
-            if char in nestables:
-                append_normalized_block(current_block, token_blocks)
-                # it gets its own block
-                token_blocks.append(char)
-                # reset
-                current_block = ''
-                current_delims.append(char)
-
-            elif char in opaques:
-                append_normalized_block(current_block, token_blocks)
-                # put the char at the start of the new block
-                current_block = ''
-                current_block += char
-                current_delims.append(char)
-
-        elif char == '+':
-            # give this a block of its own, but make no delim entry
-            # because this is an operator
-            append_normalized_block(current_block, token_blocks)
-            # normalize whitespace for operator
-            token_blocks.append(' + ')
-            current_block = ''
-
-        else:
-            # non-delim, non-operator: content only:
-            # neither opens nor closes
-            current_block += char
-
-    # flush accumulated content to return value
-    append_normalized_block(current_block, token_blocks)
-
-    return token_blocks
 
+def parse_marcexport_deflines(deflines, filename=None):
+    '''This function turns the marcexport define text content into datastructures.
+    It reads the MARCout text line by line, in a single pass (see
+    `parse_marcexport_definitions`), and expects exactly one export
+    definition. It ignores "DESCRIPTION", which is non-machine-parseable
+    documentation for humans.
 
+    From the content, it parses a dictionary/map/hash/object of marcexport
+    datastructures:
+        - 'known_parameters', required parameters
+        - 'functions', function names anb brief signature/descriptions
+        - 'pure_functions', the names of functions declared `PURE`
+        - 'json_extracted_properties', named expressions for pulling values from a
+            JSON instance.
+        - 'marc_field_templates', an ordered sequence of data structures listing
+            desired fixed values, and album JSON extraction expressions, for MARC
+            fields.
+            This list of templates thus controls field order, subfield order,
+            and instructions for pulling data from the expected JSON instance.
+        - 'compiled_expressions', a mapping from each template and
+            extractor expression to its compiled AST.
+        - 'dependencies', the extracts and functions each template refers
+            to (see `template_dependencies`).
+        - 'extractor_paths', the subscript keys of each extractor that is
+            a plain subscript chain on the record (see `extractor_paths`).
+        - 'common_subexpressions', the subexpressions shared by several
+            template expressions, each evaluated once per record (see
+            `common_subexpressions`; `engine_statistics` reports them).
+        - 'source_hash', identifying the MARCout source (see `source_hash`).
+        - 'source_positions', the file name, and the line numbers from which
+            each parameter, function, extractor, template and template
+            expression was parsed.
 
+    This marcexport datastructures dictionary/map/hash/object is returned.
+    '''
+    span = None
+    if tracing.hooks:
+        span = tracing.start_span('marcout.parse', {'filename': filename})
+    try:
+        engines = parse_marcexport_definitions(deflines, filename)
+        marcdefs = next(engines)
+        for extra in engines:
+            raise ValueError(source_location(filename, extra['source_positions']['first_line'])
+                + 'MARCout source contains more than one export definition.')
+    except Exception as ex:
+        if span is not None:
+            tracing.end_span(span, {'error': type(ex).__name__ + ': ' + str(ex)})
+        raise
+    if span is not None:
+        tracing.end_span(span, {'source_hash': marcdefs['source_hash'],
+            'templates': len(marcdefs['marc_field_templates'])})
+    return marcdefs
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+# This module is a persistent cache of serialized exported records, kept in
+# an sqlite3 database file, for incremental ("delta") exports: a record
+# whose JSON, MARCout Engine, and collection info are all unchanged since
+# it was last exported is not exported again.
+#
+# Cached output is keyed by the engine's source hash, the collection info
+# hash (see marcout_exporter.collection_info_hash), and a hash of the
+# record's canonical JSON, and is stored per serialization.
+#
+# The key does not cover the exporter's own code: after upgrading MARCout
+# builtins or serializers, delete the cache file (or bump
+# `record_cache_version`).
+
+import hashlib
+import json
+import sqlite3
+import threading
+
+
+# =============================================================================
+#
+# ================== CONSTANTS ================================================
+
+# part of every key: bump this to invalidate every existing cache
+record_cache_version = 1
+
+# cached records written between commits
+commit_interval = 500
+
+create_table = '''CREATE TABLE IF NOT EXISTS exported_records (
+    record_key TEXT NOT NULL,
+    serialization TEXT NOT NULL,
+    output,
+    PRIMARY KEY (record_key, serialization))'''
+
+
+
+# =============================================================================
+#
+# ================== FUNCTIONS ================================================
+
+
+def record_fingerprint(record):
+    '''Returns a hex digest of the canonical JSON form of `record`: equal
+    for records that are equal as JSON, whatever their key order.
+    '''
+    content = json.dumps(record, sort_keys=True, separators=(',', ':'),
+        ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def record_key(engine_hash, collection_hash, record):
+    '''Returns the cache key of `record` exported by the engine with source
+    hash `engine_hash`, for the collection info with hash `collection_hash`.
+    '''
+    content = '\n'.join((str(record_cache_version), engine_hash, collection_hash,
+        record_fingerprint(record)))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def open_record_cache(filepath):
+    '''Opens (creating, if necessary) the record cache database at
+    `filepath`. Returns the cache: a dict holding the connection, a lock
+    serializing its use between threads, the number of uncommitted
+    writes, and 'hits' and 'misses' counters.
+    '''
+    connection = sqlite3.connect(filepath, check_same_thread=False)
+    connection.execute(create_table)
+    connection.commit()
+    return {'connection': connection,
+        'lock': threading.Lock(),
+        'uncommitted': 0,
+        'hits': 0,
+        'misses': 0,
+    }
+
+
+def read_cached(cache, key, sz_name):
+    '''Returns the cached output of the record with `key` in serialization
+    `sz_name`, or None. Counts a hit or a miss.
+    '''
+    with cache['lock']:
+        row = cache['connection'].execute('SELECT output FROM exported_records '
+            'WHERE record_key = ? AND serialization = ?', (key, sz_name)).fetchone()
+        if row is None:
+            cache['misses'] += 1
+            return None
+        cache['hits'] += 1
+        return row[0]
+
+
+def write_cached(cache, key, sz_name, output):
+    '''Stores `output` as the record with `key` in serialization `sz_name`.
+    Writes are committed every `commit_interval` records, and by
+    `close_record_cache`.
+    '''
+    with cache['lock']:
+        cache['connection'].execute('INSERT OR REPLACE INTO exported_records '
+            '(record_key, serialization, output) VALUES (?, ?, ?)', (key, sz_name, output))
+        cache['uncommitted'] += 1
+        if cache['uncommitted'] >= commit_interval:
+            cache['connection'].commit()
+            cache['uncommitted'] = 0
+
+
+def close_record_cache(cache):
+    '''Commits any outstanding writes, and closes the cache.'''
+    with cache['lock']:
+        cache['connection'].commit()
+        cache['connection'].close()
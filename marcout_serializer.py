@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 
+import marcout_fields as fields
 import marcout_iso2709 as iso
+import marcout_tracing as tracing
 
 
 # =============================================================================
@@ -20,60 +22,54 @@ def serialize_text(marc_record_fields, verbose):
 
     retval = ''
 
+    # fields are marcout_fields.MarcField: a property is present if it is
+    # in the field's keys
     for field in marc_record_fields:
+        keys = field.keys
         retval += '='
-        retval += field['tag']
+        retval += field.tag
         retval += '  '
         for indcname in ('indicator_1', 'indicator_2'):
             # when there's no indicator at all, we represent in text as a single space
             indc_val = ' ' 
-            if indcname in field:
-                indc_val = field[indcname]
+            if indcname in keys:
+                indc_val = getattr(field, indcname)
                 if not indc_val.strip():
                     # the indicator is a space, which is represented as "\".
                     # We need to escape the backslash character by doubling it.
                     indc_val = '\\'
             retval += indc_val
 
-        if 'fixed' in field:
-            retval += field['fixed']
-
-        if 'content' in field:
-            retval += field['content']
-
-        # foreach will be a list of subfields, in order, with optional preceding
-        # or subsequent delimiters
-        elif 'foreach' in field:
-            for group_item in field['foreach']:
-                # group_item is a list of dicts
-                for sub_item in group_item:
-                    # sub_item dict should only ever have one key & 
-                    # one associated value.
-                    key = list(sub_item.keys())[0]
-                    if key.startswith('group_'):
-                        # it's a group marker, not a data field. 
-                        # Just append the value.
-                        retval += sub_item[key]
-                    else:
-                        # it's a subfield
-                        retval += '$'
-                        subfield_code = key
-                        subfield_val = sub_item[subfield_code]
-                        retval += subfield_code
-                        retval += subfield_val
-
-        elif 'subfields' in field:
-            for subfield in field['subfields']:
+        if 'fixed' in keys:
+            retval += field.fixed
+
+        if 'content' in keys:
+            retval += field.content
+
+        # foreach will be a list of groups, in order, each with its subfields
+        # and optional preceding or subsequent demarcators
+        elif 'foreach' in keys:
+            for group in field.foreach:
+                # demarcators are not data fields: just append the value.
+                if group.prefix:
+                    retval += group.prefix
+                for subfield in group.subfields:
+                    retval += '$'
+                    retval += subfield.code
+                    retval += subfield.value
+                if group.suffix:
+                    retval += group.suffix
+                if group.demarcator:
+                    retval += group.demarcator
+
+        elif 'subfields' in keys:
+            for subfield in field.subfields:
                 retval += '$'
-                # subfield dict should only ever have one key & 
-                # one associated value.
-                subfield_code = list(subfield.keys())[0]
-                subfield_val = str(subfield[subfield_code])
-                retval += subfield_code
-                retval += subfield_val
-        if 'terminator' in field:
-            if field['terminator']:
-                retval += field['terminator']
+                retval += subfield.code
+                retval += str(subfield.value)
+        if 'terminator' in keys:
+            if field.terminator:
+                retval += field.terminator
         retval += '\n'
 
     return retval
@@ -89,9 +85,10 @@ def serialize_iso2709(marc_record_fields, verbose):
 
 
 def serialize_raw(marc_record_fields, verbose):
-    '''Returns serialized data structures in Python/Javascript evaluable form.
+    '''Returns serialized data structures in Python/Javascript evaluable form:
+    the record in raw datastructure form (see marcout_fields.to_dicts).
     '''
-    return str(marc_record_fields)
+    return str(fields.to_dicts(marc_record_fields))
 
 
 def serialize_xml(marc_record_fields, verbose):
@@ -100,15 +97,28 @@ def serialize_xml(marc_record_fields, verbose):
     raise Exception('serialize_xml not yet implemented.')
 
 
-def serialize_records(marc_record_list, sz_name, verbose=False):
-    '''Accepts a list of MARCout records in raw data form and applies
-    requested serialization to each.
+def iter_serialize_records(marc_records, sz_name, verbose=False):
+    '''Generator form of `serialize_records`: accepts any iterable of
+    MARCout records (lists of marcout_fields.MarcField), and yields each one serialized as
+    soon as it is available.
     '''
-    retval = []
-    for marc_record in marc_record_list:
-        retval.append(serializations[sz_name](marc_record, verbose))
+    serialize = serializations[sz_name]
+    for indx, marc_record in enumerate(marc_records):
+        if not tracing.hooks:
+            yield serialize(marc_record, verbose)
+            continue
+        span = tracing.start_span('marcout.serialize', {'record_index': indx,
+            'serialization': sz_name})
+        serialized = serialize(marc_record, verbose)
+        tracing.end_span(span, {'length': len(serialized)})
+        yield serialized
 
-    return retval
+
+def serialize_records(marc_record_list, sz_name, verbose=False):
+    '''Accepts a list of MARCout records (lists of marcout_fields.MarcField)
+    and applies requested serialization to each.
+    '''
+    return list(iter_serialize_records(marc_record_list, sz_name, verbose))
 
 
 # =============================================================================
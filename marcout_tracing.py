@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+
+# This module is MARCout's tracing hook interface. The parser, exporter and
+# serializer report spans (timed operations) to the hooks registered here:
+#
+#   'marcout.parse'           parsing a MARCout definition into an engine
+#   'marcout.compile'         compiling the engine's expressions
+#   'marcout.export_record'   exporting one record
+#   'marcout.extract'         computing one JSON extracted property, for a
+#                             chunk of records (see exporter.ExtractColumns)
+#   'marcout.export_field'    exporting one MARC field of a record
+#   'marcout.serialize'       serializing one exported record
+#
+# A hook is a callable taking one finished span: a dict of 'name',
+# 'trace_id', 'span_id', 'parent_span_id' (None for a root span),
+# 'start_ns' and 'end_ns' (time.time_ns() values), and 'attributes' (a
+# dict of the record index, album id, field tag and so on).
+#
+# With no hook registered, tracing costs a test of `hooks` at each point:
+# spans are only made while a hook is registered.
+#
+# Spans opened while another span of the same thread is open are its
+# children. Root spans belong to the thread's current trace (see
+# `new_trace`), or each to a new trace if there is none.
+#
+# `open_span_file` registers a built-in hook that writes spans, as
+# OpenTelemetry (OTLP/JSON) lines, to a local file.
+
+import json
+import os
+import threading
+import time
+
+
+# =============================================================================
+#
+# ================== CONSTANTS ================================================
+
+# registered hooks, called with each finished span in registration order
+hooks = []
+
+# per thread: 'trace_id', the current trace, and 'stack', the open spans
+trace_context = threading.local()
+
+# the OpenTelemetry instrumentation scope of MARCout spans
+scope_name = 'marcout'
+
+# OTLP SpanKind INTERNAL
+span_kind_internal = 1
+
+
+
+# =============================================================================
+#
+# ================== HOOK FUNCTIONS ===========================================
+
+
+def add_hook(hook):
+    '''Registers `hook`, to be called with each finished span.'''
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    '''Unregisters `hook`.'''
+    hooks.remove(hook)
+
+
+def new_trace():
+    '''Begins a new trace in this thread: the root spans that follow (such
+    as those of one export request) share its trace id. Returns the id.
+    '''
+    trace_context.trace_id = os.urandom(16).hex()
+    return trace_context.trace_id
+
+
+def span_stack():
+    '''Returns this thread's list of open spans.'''
+    stack = getattr(trace_context, 'stack', None)
+    if stack is None:
+        stack = trace_context.stack = []
+    return stack
+
+
+def start_span(name, attributes=None):
+    '''Opens and returns a span named `name`, with `attributes`, a child of
+    this thread's innermost open span, if any. Close it with `end_span`.
+    '''
+    stack = span_stack()
+    if stack:
+        trace_id = stack[-1]['trace_id']
+        parent_span_id = stack[-1]['span_id']
+    else:
+        trace_id = getattr(trace_context, 'trace_id', None) or os.urandom(16).hex()
+        parent_span_id = None
+    span = {'name': name,
+        'trace_id': trace_id,
+        'span_id': os.urandom(8).hex(),
+        'parent_span_id': parent_span_id,
+        'start_ns': time.time_ns(),
+        'end_ns': None,
+        'attributes': dict(attributes or {}),
+    }
+    stack.append(span)
+    return span
+
+
+def end_span(span, attributes=None):
+    '''Closes `span` (and any span left open inside it), adds `attributes`
+    to it, and calls every hook with it.
+    '''
+    span['end_ns'] = time.time_ns()
+    if attributes:
+        span['attributes'].update(attributes)
+    stack = span_stack()
+    while stack:
+        if stack.pop() is span:
+            break
+    for hook in list(hooks):
+        hook(span)
+
+
+
+# =============================================================================
+#
+# ================== OPENTELEMETRY FILE EXPORTER ==============================
+
+
+def otlp_value(value):
+    '''Returns `value` as an OTLP/JSON AnyValue.'''
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        # int64 values are strings in OTLP/JSON
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otlp_span(span):
+    '''Returns `span` as an OTLP/JSON span.'''
+    retval = {'traceId': span['trace_id'],
+        'spanId': span['span_id'],
+        'name': span['name'],
+        'kind': span_kind_internal,
+        'startTimeUnixNano': str(span['start_ns']),
+        'endTimeUnixNano': str(span['end_ns']),
+        'attributes': [{'key': key, 'value': otlp_value(value)}
+            for key, value in span['attributes'].items() if value is not None],
+    }
+    if span['parent_span_id']:
+        retval['parentSpanId'] = span['parent_span_id']
+    return retval
+
+
+def open_span_file(filepath, service_name='marcout'):
+    '''Opens the file at `filepath` for appending, and registers a hook
+    that writes each span to it as a line of OTLP/JSON: an
+    ExportTraceServiceRequest holding the one span, as written by the
+    OpenTelemetry Collector's file exporter. Returns the span file: a
+    dict holding the file, the hook, and a lock serializing writes
+    between threads. Close it with `close_span_file`.
+    '''
+    spanfile = {'file': open(filepath, 'a'),
+        'lock': threading.Lock(),
+        'resource': {'attributes': [{'key': 'service.name',
+            'value': otlp_value(service_name)}]},
+    }
+
+    def write_span(span):
+        line = json.dumps({'resourceSpans': [{'resource': spanfile['resource'],
+            'scopeSpans': [{'scope': {'name': scope_name},
+                'spans': [otlp_span(span)]}]}]})
+        with spanfile['lock']:
+            spanfile['file'].write(line + '\n')
+
+    spanfile['hook'] = write_span
+    add_hook(write_span)
+    return spanfile
+
+
+def close_span_file(spanfile):
+    '''Unregisters the hook of span file `spanfile`, and closes the file.'''
+    remove_hook(spanfile['hook'])
+    with spanfile['lock']:
+        spanfile['file'].close()
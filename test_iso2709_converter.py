@@ -1,5 +1,5 @@
 
-usage = '''USAGE: python3 test_iso2709_converter.py <
+usage = '''USAGE: python3 test_iso2709_converter.py <raw-datastructure-filepath>
 '''
 
 
@@ -23,12 +23,12 @@ print(raw_struct)
 print()
 print()
 
-serial = raw_record_2_iso(raw_struct)
+serial = iso.raw_record_2_iso(raw_struct)
 print(serial)
 print()
 print()
 
-first_record_pos = serial.find(field_delimiter)     # 203 in mischa's raw rep
+first_record_pos = serial.find(iso.field_delimiter)     # 203 in mischa's raw rep
 print('FIRST RECORD STARTS AT POS ' + str(first_record_pos))
 print()
 directory_string = serial[24:first_record_pos]
@@ -38,10 +38,10 @@ print(directory_string)
 print()
 print()
 
-fields = entries_in_iso_directory(directory_string)
+fields = iso.entries_in_iso_directory(directory_string)
 for field in fields:
     print(field)
-    print(read_iso_field_content(field, fields_text))
+    print(iso.read_iso_field_content(field, fields_text))
     print()
 
 # marcfilename = sys.argv[1]
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+# Tests of the fallback of generated-module exports (marcout_codegen.py,
+# `load_engine_module`): an engine whose module cannot be written to the
+# module cache is exported by marcout_exporter instead.
+# Run with `python3 -m unittest discover tests` or pytest.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# this file lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout
+import marcout_codegen as codegen
+
+
+unified_json_path = os.path.join(repo_dir, 'examples', 'unified-json.json')
+
+
+class CodegenFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(unified_json_path) as json_file:
+            self.unified = json.load(json_file)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.default_cache_dir = codegen.default_cache_dir
+        self.loaded_modules = dict(codegen.loaded_modules)
+        codegen.loaded_modules.clear()
+
+    def tearDown(self):
+        codegen.default_cache_dir = self.default_cache_dir
+        codegen.loaded_modules.clear()
+        codegen.loaded_modules.update(self.loaded_modules)
+
+    def test_uncreatable_cache_dir_falls_back_to_exporter(self):
+        # a cache directory beneath a regular file cannot be created
+        blocker = os.path.join(self.tempdir, 'not-a-directory')
+        with open(blocker, 'w') as blocker_file:
+            blocker_file.write('')
+        codegen.default_cache_dir = os.path.join(blocker, '__marcoutcache__')
+
+        self.assertEqual(marcout.export_records(self.unified, codegen=True),
+            marcout.export_records(self.unified))
+        self.assertEqual(list(codegen.loaded_modules.values()), [None])
+
+    def test_unwritable_cache_dir_falls_back_to_exporter(self):
+        cache_dir = os.path.join(self.tempdir, '__marcoutcache__')
+        os.makedirs(cache_dir)
+        os.chmod(cache_dir, 0o500)
+        self.addCleanup(os.chmod, cache_dir, 0o700)
+        if os.access(cache_dir, os.W_OK):
+            self.skipTest('permissions are not enforced for this user')
+        codegen.default_cache_dir = cache_dir
+
+        self.assertEqual(marcout.export_records(self.unified, codegen=True),
+            marcout.export_records(self.unified))
+        self.assertEqual(os.listdir(cache_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
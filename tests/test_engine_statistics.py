@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+# Tests of MARCout Engine statistics (marcout_parser.engine_statistics, and
+# parse-marcout --verbose, which reports them).
+# Run with `python3 -m unittest discover tests` or pytest.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# this file lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout_parser as parser
+
+
+# release_year(release_date) occurs three times, across two templates
+repeated_subexpression_source = '''
+KNOWN PARAMETERS---------------------------------
+
+    collection_label
+
+JSON EXTRACTED PROPERTIES------------------------
+
+    album_title = album_json['album']['title']
+
+    release_date = album_json['album']['release_date']
+
+FUNCTIONS----------------------------------------
+
+    release_year(release_date) PURE
+
+MARC FIELD TEMPLATES------------------------------------
+
+FIELD: 245
+INDC1: 1
+INDC2: 0
+    SUBFIELD: a
+        album_title + ' ' + release_year(release_date)
+    SUBFIELD: c
+        release_year(release_date)
+
+FIELD: 260
+INDC1: blank
+INDC2: blank
+    SUBFIELD: c
+        release_year(release_date)
+'''
+
+expected_statistics = {'field_templates': 2,
+    'json_extracted_properties': 2,
+    'direct_extractors': 2,
+    'compiled_expressions': 5,
+    'common_subexpressions': 1,
+    'shared_evaluations_saved': 2,
+}
+
+
+class EngineStatisticsTest(unittest.TestCase):
+
+    def test_repeated_subexpression_is_counted(self):
+        marcout_engine = parser.parse_marcexport_deflines(
+            repeated_subexpression_source.split('\n'))
+        self.assertEqual(parser.engine_statistics(marcout_engine), expected_statistics)
+
+    def test_parse_marcout_verbose_reports_statistics(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        source_path = os.path.join(tempdir, 'repeated.marcout')
+        with open(source_path, 'w') as source_file:
+            source_file.write(repeated_subexpression_source)
+
+        completed = subprocess.run([sys.executable,
+            os.path.join(repo_dir, 'parse-marcout'), source_path, '--verbose'],
+            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        self.assertIn('MARCout Engine statistics:', completed.stdout)
+        for name, value in expected_statistics.items():
+            self.assertIn('    ' + name + ': ' + str(value) + '\n', completed.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
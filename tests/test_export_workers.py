@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+# Tests of exports across a pool of worker processes (marcout.py,
+# `iter_export_in_workers`). Run with `python3 -m unittest discover tests`
+# or pytest.
+
+import json
+import os
+import sys
+import unittest
+
+# this file lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout
+
+
+unified_json_path = os.path.join(repo_dir, 'examples', 'unified-json.json')
+
+
+class ExportWorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(unified_json_path) as json_file:
+            self.unified = json.load(json_file)
+        self.records = self.unified['records'] * 10
+
+    def test_generator_input_is_read_one_window_ahead_at_most(self):
+        workers = 2
+        chunksize = 3
+        window = workers * chunksize
+        reads = []
+
+        def counted_records():
+            for record in self.records:
+                reads.append(record)
+                yield record
+
+        outputs = []
+        for output in marcout.iter_export(self.unified, records=counted_records(),
+                workers=workers, chunksize=chunksize):
+            outputs.append(output)
+            self.assertLessEqual(len(reads), len(outputs) - 1 + window)
+
+        self.assertEqual(len(reads), len(self.records))
+        self.assertEqual(outputs, list(marcout.iter_export(self.unified,
+            records=self.records)))
+
+    def test_skipping_export_keeps_record_indexes_across_windows(self):
+        records = list(self.records)
+        # an album with an unsortable track list cannot be exported
+        bad = json.loads(json.dumps(records[0]))
+        bad['album']['tracks'] = [{'position': 1}, {'title': 'no position'}]
+        records[7] = bad
+        errors = []
+        outputs = list(marcout.iter_serialized(dict(
+            marcout.resolve_unified_json(self.unified), records_to_export=records),
+            workers=2, chunksize=2, errors=errors))
+        self.assertIsNone(outputs[7])
+        self.assertEqual(len(outputs), len(records))
+        self.assertEqual([error['record_index'] for error in errors], [7])
+
+
+if __name__ == '__main__':
+    unittest.main()
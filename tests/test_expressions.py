@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+# Tests of the MARCout expression language (marcout_expressions.py,
+# `compile_expr` and `evaluate`): expressions are parsed by the MARCout
+# grammar, never by Python, so Python syntax beyond it is rejected, and a
+# call can only reach the functions it is given.
+# Run with `python3 -m unittest discover tests` or pytest.
+
+import os
+import sys
+import unittest
+
+# this file lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout_expressions as expressions
+
+
+namespace = {'album_json': {'album': {'title': 'Title', 'tracks': [{'title': 'One'}]}},
+    'collection_label': 'Label'}
+
+functions = dict(expressions.keyword_functions, upper=str.upper)
+
+
+def evaluated(expr, eachitem=None, item=None):
+    '''Returns the value of `expr`, compiled and evaluated against
+    `namespace` and `functions`.
+    '''
+    record_namespace = dict(namespace)
+    if item is not None:
+        record_namespace[expressions.item_key] = item
+    return expressions.evaluate(expressions.compile_expr(expr, eachitem),
+        record_namespace, functions)
+
+
+class ExpressionSafetyTest(unittest.TestCase):
+
+    def assertRejected(self, expr, eachitem=None):
+        with self.assertRaises(ValueError, msg=expr):
+            expressions.compile_expr(expr, eachitem)
+
+    def test_grammar_expressions_evaluate(self):
+        self.assertEqual(evaluated("album_json['album']['title']"), 'Title')
+        self.assertEqual(evaluated("upper(collection_label) + ' MUSICat'"), 'LABEL MUSICat')
+        self.assertEqual(evaluated('track::title', 'track', {'title': 'One'}), 'One')
+        self.assertTrue(evaluated("collection_label IS 'Label'"))
+
+    def test_attribute_access_is_rejected(self):
+        for expr in ('album_json.keys', "album_json.get('album')", "'text'.upper()",
+                '(1).real', "album_json['album'].__class__", 'track.title'):
+            self.assertRejected(expr)
+
+    def test_dunder_names_are_rejected(self):
+        for expr in ('__builtins__', '__class__', "__import__('os')",
+                "album_json['album'] + __name__"):
+            self.assertRejected(expr)
+        self.assertRejected('track::__class__', 'track')
+        self.assertRejected('track::__dict__::keys', 'track')
+
+    def test_dunder_keys_are_only_subscripts(self):
+        # a quoted key is data: it subscripts the JSON, never an attribute
+        with self.assertRaises(KeyError):
+            evaluated("album_json['__class__']")
+
+    def test_calls_outside_the_function_table_are_rejected(self):
+        for expr in ("open('/etc/passwd')", "eval('1 + 1')", "exec('x = 1')",
+                "getattr(album_json, 'keys')", "globals()", "type(album_json)"):
+            with self.assertRaises(KeyError, msg=expr):
+                evaluated(expr)
+
+    def test_unknown_names_are_not_python_builtins(self):
+        for expr in ('open', 'len', 'print'):
+            with self.assertRaises(KeyError, msg=expr):
+                evaluated(expr)
+
+    def test_lambdas_and_comprehensions_are_rejected(self):
+        for expr in ('lambda: 1', 'lambda x: x', '[title for title in album_json]',
+                '(title for title in album_json)', '{title: 1 for title in album_json}',
+                "{'key': 'value'}", '1 if collection_label else 2'):
+            self.assertRejected(expr)
+
+    def test_unknown_nodes_are_rejected(self):
+        for node in (('lambda', (), ('const', 1)), ('attr', ('name', 'album_json'), 'keys')):
+            with self.assertRaises(ValueError, msg=node[0]):
+                expressions.evaluate(node, dict(namespace), functions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+# Tests of the `::DEFAULT` values of JSON extracted properties
+# (marcout_parser.compile_default, marcout_exporter.compute_extract).
+# Run with `python3 -m unittest discover tests` or pytest.
+#
+# A default that is a MARCout literal (a quoted string, a number, a list,
+# a constant such as None, or a concatenation of constants) takes its
+# literal value: `::DEFAULT ''` is the empty string. Any other default is
+# taken as raw text: `::DEFAULT unknown` is 'unknown'.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# this file lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout
+import marcout_codegen as codegen
+import marcout_exporter as exporter
+
+
+unified_json_path = os.path.join(repo_dir, 'examples', 'unified-json.json')
+
+# an extractor that no record can evaluate
+missing = "album_json['album']['no_such_property']"
+
+
+def defaulted(default):
+    '''Returns the value of an unevaluable extractor with `default`.'''
+    return exporter.compute_extract(missing + ' ::DEFAULT ' + default,
+        {'album_json': {'album': {}}})
+
+
+class ExtractDefaultsTest(unittest.TestCase):
+
+    def test_quoted_defaults_are_string_literals(self):
+        self.assertEqual(defaulted("''"), '')
+        self.assertEqual(defaulted('""'), '')
+        self.assertEqual(defaulted("'unknown'"), 'unknown')
+        self.assertEqual(defaulted('"not given"'), 'not given')
+
+    def test_unquoted_defaults_are_raw_text(self):
+        self.assertEqual(defaulted('unknown'), 'unknown')
+        self.assertEqual(defaulted('not given'), 'not given')
+
+    def test_other_literal_defaults(self):
+        self.assertEqual(defaulted('[]'), [])
+        self.assertEqual(defaulted('0'), 0)
+        self.assertEqual(defaulted("'a' + 'b'"), 'ab')
+
+    def test_no_default_is_empty_string(self):
+        self.assertEqual(exporter.compute_extract(missing, {'album_json': {}}), '')
+
+    def test_list_default_is_new_for_each_record(self):
+        first = defaulted('[]')
+        first.append('changed')
+        self.assertEqual(defaulted('[]'), [])
+
+
+class ExtractDefaultsExportTest(unittest.TestCase):
+    '''The third example record has no 'artist_is_group', so it takes the
+    default of that extractor. The interpreter and generated modules must
+    agree on every form of default.
+    '''
+
+    def setUp(self):
+        with open(unified_json_path) as json_file:
+            self.unified = json.load(json_file)
+        self.cache_dir = tempfile.mkdtemp()
+        self.default_cache_dir = codegen.default_cache_dir
+        codegen.default_cache_dir = self.cache_dir
+
+    def tearDown(self):
+        codegen.default_cache_dir = self.default_cache_dir
+        shutil.rmtree(self.cache_dir)
+
+    def export_with_default(self, default, codegen_export):
+        source = self.unified['marcout_sourcecode'].replace(
+            "['artist_is_group'] ::DEFAULT ''", "['artist_is_group'] ::DEFAULT " + default)
+        return marcout.export_records(dict(self.unified, marcout_sourcecode=source),
+            codegen=codegen_export)
+
+    def test_generated_modules_apply_defaults_as_the_exporter_does(self):
+        for default in ("''", "'unknown'", 'unknown', 'not given', '[]'):
+            self.assertEqual(self.export_with_default(default, True),
+                self.export_with_default(default, False), default)
+
+    def test_quoted_empty_default_is_not_true(self):
+        # artist_is_group is '' for the third record: not TRUE, so its
+        # artist is exported as a person (100), not a group (110)
+        exported = self.export_with_default("''", False)[2]
+        self.assertIn('=100  ', exported)
+        self.assertNotIn('=110  ', exported)
+
+
+if __name__ == '__main__':
+    unittest.main()
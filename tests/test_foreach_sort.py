@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+# Tests of FOR EACH blocks with several SORT BY keys (marcout_exporter.py,
+# `evaluate_foreach`, and the generated modules of marcout_codegen.py):
+# items are ordered by the first key, then by the second among items
+# equal on the first, and the itemsource is not reordered.
+# Run with `python3 -m unittest discover tests` or pytest.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# this file lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout
+import marcout_codegen as codegen
+
+
+unified_json_path = os.path.join(repo_dir, 'examples', 'unified-json.json')
+
+# (side, position, title) of each track, in itemsource order. Sorted by side
+# alone, or by position alone, the titles would be in another order.
+tracks = [('B', 2, 'Side B two'), ('A', 2, 'Side A two'),
+    ('B', 1, 'Side B one'), ('A', 1, 'Side A one')]
+
+sorted_titles = ['Side A one', 'Side A two', 'Side B one', 'Side B two']
+
+
+class ForeachSortTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(unified_json_path) as json_file:
+            unified = json.load(json_file)
+        source = unified['marcout_sourcecode']
+        self.assertIn('SORT BY: track::position', source)
+        self.unified = dict(unified, marcout_sourcecode=source.replace(
+            'SORT BY: track::position',
+            'SORT BY: track::side\n        SORT BY: track::position'))
+
+        self.record = json.loads(json.dumps(unified['records'][0]))
+        self.record['album']['tracks'] = [dict(self.record['album']['tracks'][0],
+            side=side, position=position, title=title)
+            for side, position, title in tracks]
+
+        self.cache_dir = tempfile.mkdtemp()
+        self.default_cache_dir = codegen.default_cache_dir
+        codegen.default_cache_dir = self.cache_dir
+
+    def tearDown(self):
+        codegen.default_cache_dir = self.default_cache_dir
+        shutil.rmtree(self.cache_dir)
+
+    def export(self, codegen_export):
+        exported = list(marcout.iter_export(self.unified, records=[self.record],
+            codegen=codegen_export))
+        self.assertEqual(len(exported), 1)
+        return exported[0]
+
+    def field_505(self, exported):
+        lines = [line for line in exported.split('\n') if line.startswith('=505  ')]
+        self.assertEqual(len(lines), 1)
+        return lines[0]
+
+    def test_ties_on_first_key_are_broken_by_second(self):
+        field = self.field_505(self.export(False))
+        positions = [field.index(title) for title in sorted_titles]
+        self.assertEqual(positions, sorted(positions), field)
+
+    def test_generated_module_sorts_as_the_exporter_does(self):
+        self.assertEqual(self.export(True), self.export(False))
+
+    def test_source_record_is_unchanged(self):
+        original = json.loads(json.dumps(self.record))
+        self.export(False)
+        self.export(True)
+        self.assertEqual(self.record, original)
+        self.assertEqual([track['title'] for track in self.record['album']['tracks']],
+            [title for side, position, title in tracks])
+
+
+if __name__ == '__main__':
+    unittest.main()
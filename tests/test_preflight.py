@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+# Tests of the preflight dry run (marcout.py, `preflight` and
+# `sample_records`, and test-marcout's --preflight=<N>).
+# Run with `python3 -m unittest discover tests` or pytest.
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# this file lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout
+
+
+unified_json_path = os.path.join(repo_dir, 'examples', 'unified-json.json')
+
+
+class PreflightSampleTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(unified_json_path) as json_file:
+            self.export_workset = marcout.resolve_unified_json(json.load(json_file))
+
+    def test_sample_is_evenly_spaced(self):
+        records = list(range(10))
+        self.assertEqual(marcout.sample_records(records, 5), [0, 2, 4, 6, 8])
+        self.assertEqual(marcout.sample_records(records, 1), [0])
+        self.assertEqual(marcout.sample_records(records, 20), records)
+
+    def test_sample_below_one_is_rejected(self):
+        for sample in (0, -1):
+            with self.assertRaises(ValueError):
+                marcout.sample_records(list(range(10)), sample)
+            with self.assertRaises(ValueError):
+                marcout.preflight(self.export_workset, sample)
+
+    def test_preflight_samples_records(self):
+        report = marcout.preflight(self.export_workset, 2)
+        self.assertEqual(report['records_sampled'], 2)
+        self.assertEqual(report['records_total'],
+            len(self.export_workset['records_to_export']))
+
+    def test_command_line_rejects_sample_below_one(self):
+        for option in ('--preflight=0', '--preflight=-3', '--preflight=some'):
+            completed = subprocess.run([sys.executable,
+                os.path.join(repo_dir, 'test-marcout'), unified_json_path, option],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            self.assertEqual(completed.returncode, 2, option)
+            self.assertIn('--preflight=<N>', completed.stderr)
+            self.assertNotIn('Traceback', completed.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+# Tests of skip-and-continue exports (marcout.py, `iter_export` with
+# `error_file`): each skipped record's error entry must give its index in
+# the batch, whatever exports it beneath.
+# Run with `python3 -m unittest discover tests` or pytest.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# this file lives one directory below the MARCout modules
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import marcout
+
+
+unified_json_path = os.path.join(repo_dir, 'examples', 'unified-json.json')
+
+
+def read_error_file(filepath):
+    '''Returns the error entries and the summary of an error file.'''
+    with open(filepath) as error_file:
+        lines = [json.loads(line) for line in error_file]
+    return lines[:-1], lines[-1]['summary']
+
+
+class SkipAndContinueTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(unified_json_path) as json_file:
+            self.unified = json.load(json_file)
+        self.good = self.unified['records'][0]
+        # an album whose tracks cannot be sorted by position
+        self.bad = json.loads(json.dumps(self.unified['records'][1]))
+        self.bad['album']['tracks'] = [{'position': 1}, {'title': 'no position'}]
+        self.tempdir = tempfile.mkdtemp()
+        self.error_file = os.path.join(self.tempdir, 'errors.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def export(self, records, **options):
+        return list(marcout.iter_export(self.unified, records=records,
+            error_file=self.error_file, **options))
+
+    def test_uniterable_itemsource_is_named(self):
+        record = json.loads(json.dumps(self.good))
+        record['album']['tracks'] = 5
+        self.export([record])
+        entries, summary = read_error_file(self.error_file)
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['tag'], '505')
+        self.assertEqual(entries[0]['expression'], 'album_tracks')
+
+    def test_record_cache_keeps_batch_indexes(self):
+        cache_file = os.path.join(self.tempdir, 'records.db')
+        self.export([self.good], record_cache_file=cache_file)
+
+        outputs = self.export([self.good, self.good, self.good, self.bad],
+            record_cache_file=cache_file)
+        entries, summary = read_error_file(self.error_file)
+        self.assertEqual(len(outputs), 3)
+        self.assertEqual([entry['record_index'] for entry in entries], [3])
+        self.assertEqual(entries[0]['album_id'], self.bad['album']['id'])
+        self.assertEqual(summary['failed'], 1)
+
+    def test_record_cache_with_workers_keeps_batch_indexes(self):
+        cache_file = os.path.join(self.tempdir, 'records.db')
+        self.export([self.good], record_cache_file=cache_file)
+
+        self.export([self.good, self.bad, self.good, self.bad],
+            record_cache_file=cache_file, workers=2, chunksize=1)
+        entries, summary = read_error_file(self.error_file)
+        self.assertEqual([entry['record_index'] for entry in entries], [1, 3])
+
+    def test_deduplication_keeps_batch_indexes(self):
+        outputs = self.export([self.good, self.good, self.good, self.bad, self.good,
+            self.bad], deduplicate=True)
+        entries, summary = read_error_file(self.error_file)
+        self.assertEqual(len(outputs), 4)
+        # the repeat of the bad record, kept in its position, is reported too
+        self.assertEqual([entry['record_index'] for entry in entries], [3, 5])
+        self.assertEqual(summary['failed'], 2)
+
+    def test_collapsed_duplicates_keep_batch_indexes(self):
+        outputs = self.export([self.good, self.good, self.good, self.bad, self.bad],
+            collapse_duplicates=True)
+        entries, summary = read_error_file(self.error_file)
+        self.assertEqual(len(outputs), 1)
+        self.assertEqual([entry['record_index'] for entry in entries], [3])
+        self.assertEqual(summary['failed'], 1)
+
+    def test_deduplication_over_record_cache_keeps_batch_indexes(self):
+        cache_file = os.path.join(self.tempdir, 'records.db')
+        self.export([self.good], record_cache_file=cache_file)
+
+        self.export([self.good, self.good, self.bad, self.good, self.bad],
+            record_cache_file=cache_file, deduplicate=True, workers=2, chunksize=1)
+        entries, summary = read_error_file(self.error_file)
+        self.assertEqual([entry['record_index'] for entry in entries], [2, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()